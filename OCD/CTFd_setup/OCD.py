@@ -4,73 +4,383 @@ Will be reading setup.yml
 """
 # Create a directory and get a random string for hashing
 import os
+# Command line flags, e.g. --profile
+import sys
+
+# Fast path for a CTFd which is already set up, checked before anything heavy is imported
+from setup_check import setup_needed, DATABASE_URL
+if __name__ == '__main__' and not setup_needed():
+    quit(1)
+
 # Create a posix path from multiple strings for easier file naming
 import posixpath
 # Convert humanly readable time to epoch format
 import time
 import calendar
-# Copying files to other directory
-import shutil
+# Content hashing of uploaded files and setup.yml fingerprints
+import hashlib
+import hmac
+import json
 # Regex match for hints in setup.yml
 import re
+# Hash passwords on multiple cores and copy files on multiple threads
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, Future
 
 
 # MySQL import to connect to a session, update an existing table and select from SQL tables
-from sqlalchemy import create_engine, update, select
+from sqlalchemy import create_engine, update, select, delete, inspect, bindparam
 from sqlalchemy.orm import sessionmaker
 import pymysql
-# Import of setup.yml and parser
-import yaml
 # Makes sure files aren't maliciously named
 from werkzeug.utils import secure_filename
-# Hashing to hex from string
-from CTFd.utils.encoding import hexencode
+# Hashing of user passwords
+from CTFd.utils.crypto import hash_password
 
 
 # Module containing SQL tables
 from db import *
+# Streaming of users_file rosters
+from roster import read_roster
+# Copying files to other directory
+from placement import place_file
+# Import of setup.yml, parsed by check_yaml.py before
+from yaml_loader import read_setup, merge_challenge_files
+# Stage timings and SQL statement counts
+from instrument import Instrument
+# Point pages and theme files at uploaded files
+from assets import rewrite_assets
+# Precompressed siblings of uploads
+from compress import compress_file
+# Stale keys in the CTFd cache
+from warm_cache import connect, invalidate, RedisError
+
+
+class Settings:
+    """
+    Deployment settings - can be overridden in the deploy section of setup.yml
+    """
+    def __init__(self):
+        self.bulk_insert = 0
+        self.batch_size = 1000
+        self.hash_workers = 0
+        self.upload_workers = 4
+        self.placement = 'auto'
+        self.incremental = 0
+        self.profile = 0
+        self.compress = 'none'
+
+    def load(self, setupDeploy):
+        """
+        Override the defaults with the deploy section
+        """
+        for key in setupDeploy:
+            if hasattr(self, key):
+                setattr(self, key, setupDeploy[key])
+
+
+class Uploads:
+    """
+    Content addressed upload stage - every unique file is copied once
+    Files are hashed and copied on worker threads while rows are built and inserted
+    """
+    def __init__(self):
+        self.executor = None
+        self.digests = dict()
+        self.locations = dict()
+        self.copies = []
+        self.links = []
+        self.filesUploaded = 0
+        self.bytesStored = 0
+        self.bytesSaved = 0
+        self.bytesPlaced = dict()
+        self.bytesCompressed = 0
+
+    def upload(self, filename, owner):
+        """
+        Return the location of a file for one owner, copy it in the background if its content is new
+        CTFd removes the whole folder of a deleted file, so every owner gets a folder of its own
+        """
+        digest, fileLocation = self.location(filename, owner)
+
+        self.filesUploaded += 1
+        if digest in self.locations:
+            # Linked to the first copy once it is placed
+            if fileLocation != self.locations[digest]:
+                self.links.append((self.locations[digest], fileLocation, os.path.getsize(filename)))
+            self.bytesSaved += os.path.getsize(filename)
+            return fileLocation
+
+        self.locations[digest] = fileLocation
+
+        self.copies.append((self.workers().submit(copy_upload, filename, fileLocation),
+                            os.path.getsize(filename)))
+
+        return fileLocation
+
+    def location(self, filename, owner):
+        """
+        Content hash of a file and the location it is uploaded to for one owner, without uploading it
+        """
+        digest = self.digest(filename)
+
+        secFilename = secure_filename(filename[filename.rfind('/') + 1:])
+        folder = hashlib.sha256((digest + '/' + str(owner)).encode()).hexdigest()[:32]
+        return digest, posixpath.join(folder, secFilename)
+
+    def workers(self):
+        """
+        Thread pool hashing and copying files, started when first needed
+        """
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=settings.upload_workers)
+        return self.executor
+
+    def prefetch(self, filenames):
+        """
+        Start hashing files in the background, in the order they will be needed
+        """
+        for filename in filenames:
+            if filename not in self.digests and os.path.isfile(filename):
+                self.digests[filename] = self.workers().submit(file_digest, filename)
+                instrument.count('bytes_hashed', os.path.getsize(filename))
+
+    def digest(self, filename):
+        """
+        Hash of the content of a file, files referenced more than once are only hashed once
+        """
+        if filename not in self.digests:
+            self.digests[filename] = file_digest(filename)
+            instrument.count('bytes_hashed', os.path.getsize(filename))
+
+        # Prefetched files may still be hashing
+        if isinstance(self.digests[filename], Future):
+            self.digests[filename] = self.digests[filename].result()
+        return self.digests[filename]
+
+    def wait(self):
+        """
+        Wait for all copies to finish, raises if a copy failed
+        Rows of files are only committed after this, so a failed copy commits nothing
+        """
+        for copy, size in self.copies:
+            strategy, compressed = copy.result()
+            self.bytesCompressed += compressed
+            self.bytesPlaced[strategy] = self.bytesPlaced.get(strategy, 0) + size
+            if strategy != 'existing':
+                self.bytesStored += size
+        self.copies = []
+
+        # Every copy is placed, so the other references can link to it
+        for copyLocation, fileLocation, size in self.links:
+            strategy = link_upload(copyLocation, fileLocation)
+            self.bytesPlaced[strategy] = self.bytesPlaced.get(strategy, 0) + size
+            if strategy not in ('existing', 'hardlink'):
+                self.bytesStored += size
+                self.bytesSaved -= size
+        self.links = []
+
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def stats(self):
+        """
+        Summary of the uploads for the instrumentation report
+        """
+        return {
+            'files': self.filesUploaded,
+            'unique': len(self.locations),
+            'bytes_stored': self.bytesStored,
+            'bytes_saved': self.bytesSaved,
+            'bytes_placed': self.bytesPlaced,
+            'bytes_compressed': self.bytesCompressed,
+        }
+
+    def report(self):
+        """
+        Print a summary of the uploads
+        """
+        print('Uploaded ' + str(self.filesUploaded) + ' files, ' +
+              str(len(self.locations)) + ' unique: ' +
+              '%.1f MB stored, %.1f MB saved' % (self.bytesStored / 1e6, self.bytesSaved / 1e6))
+        for strategy in self.bytesPlaced:
+            print('  %s: %.1f MB' % (strategy, self.bytesPlaced[strategy] / 1e6))
+        if settings.compress != 'none':
+            print('  %s siblings: %.1f MB smaller' % (settings.compress, self.bytesCompressed / 1e6))
+
+
+def file_digest(filename):
+    """
+    Hash the content of a file without reading it all into memory
+    """
+    digest = hashlib.sha256()
+    with open(filename, 'rb') as content:
+        for block in iter(lambda: content.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def copy_upload(filename, fileLocation):
+    """
+    Place file into the uploads folder, return the strategy used and the bytes saved by compression
+    """
+    filePath = posixpath.join(UPLOAD_FOLDER, fileLocation)
+
+    # Content addressed, so a file from an earlier deploy is already correct
+    if os.path.isfile(filePath) and os.path.getsize(filePath) == os.path.getsize(filename):
+        strategy = 'existing'
+    else:
+        # Make folder to contain file
+        os.makedirs(posixpath.dirname(filePath), exist_ok=True)
+        # Link, clone, or copy file into folder
+        strategy = place_file(filename, filePath, settings.placement)
+
+    # Siblings for nginx gzip_static, skipped when already written by an earlier deploy
+    return strategy, compress_file(filePath, settings.compress)
+
+
+def link_upload(copyLocation, fileLocation):
+    """
+    Place another reference to an uploaded file and its .gz sibling, return the strategy used
+    Both are in the uploads folder, which CTFd never edits in place, so they can share an inode
+    """
+    copyPath = posixpath.join(UPLOAD_FOLDER, copyLocation)
+    filePath = posixpath.join(UPLOAD_FOLDER, fileLocation)
+
+    if os.path.isfile(filePath) and os.path.getsize(filePath) == os.path.getsize(copyPath):
+        strategy = 'existing'
+    else:
+        os.makedirs(posixpath.dirname(filePath), exist_ok=True)
+        strategy = place_file(copyPath, filePath, 'hardlink')
+
+    if os.path.isfile(copyPath + '.gz') and not os.path.isfile(filePath + '.gz'):
+        place_file(copyPath + '.gz', filePath + '.gz', 'hardlink')
+
+    return strategy
+
 
 def check_setup(engine):
     """
-    Check if setup already is done - close if it is
+    Check if setup already is done
     """
     with engine.connect() as conn:
         for row in conn.execute(select([Config]).where(Config.key == 'setup')):
             if row[2] == '1':
-                quit(1)
+                return True
     conn.close()
 
+    return False
+
 
 def read_setup_yaml(YAMLfile):
     """
     Read setup.yml file and return as dictionary
     """
-    with open(YAMLfile, 'r') as setup:
-        return yaml.safe_load(setup)['CTFd']
+    setup = read_setup(YAMLfile)
 
+    # Challenges in their own challenge.yml, check_yaml.py made sure they merge cleanly
+    merge_challenge_files(setup, 'OCD/challenge_files')
+    return setup['CTFd']
 
-def commit_changes(session, commitList):
+
+def get_challenge_ids(session):
+    """
+    Query all challenges once and return a name to id index
+    """
+    return {name: int(chall_id) for chall_id, name in
+            session.execute(select([Challenges.ID, Challenges.name]))}
+
+
+def row_values(rows):
     """
-    Commit changes of a list of changes
+    Column values of objects from one table, as the ORM would insert them
     """
-    session.add_all(commitList)
-    session.commit()
+    # Only the attributes set by the db.py constructors
+    attributes = [attribute for attribute in inspect(type(rows[0])).column_attrs
+                  if any(attribute.key in row.__dict__ for row in rows)]
+
+    return [{attribute.columns[0].key: getattr(row, attribute.key) for attribute in attributes}
+            for row in rows]
 
 
-def upload_file(commitList, TYPE, filename, challenge_id=None):
+def bulk_insert(session, commitList):
     """
-    Upload file to random hashstring folder
+    Insert a list of changes as multi-row INSERTs, table by table, bypassing the ORM
     """
-    secFilename = secure_filename(filename[filename.rfind('/') + 1:])
-    fileFolder = hexencode(os.urandom(16))
-    folderPath = posixpath.join('/', 'var', 'uploads', fileFolder)
-    filePath = posixpath.join(folderPath, secFilename)
-    fileLocation = posixpath.join(fileFolder, secFilename)
+    # Group rows by table, keeping the order they were created in
+    tables = dict()
+    for row in commitList:
+        tables.setdefault(row.__table__, []).append(row)
+
+    for table, rows in tables.items():
+        values = row_values(rows)
+
+        for start in range(0, len(values), settings.batch_size):
+            session.execute(table.insert().values(values[start:start + settings.batch_size]))
 
-    # Make folder to contain file
-    os.makedirs(folderPath)
-    # Copy file into folder
-    shutil.copyfile('OCD/' + filename, filePath)
+
+def add_changes(session, commitList):
+    """
+    Add a list of changes to the transaction, committed once at the end of main
+    """
+    if settings.bulk_insert == 1:
+        bulk_insert(session, commitList)
+    else:
+        session.add_all(commitList)
+        session.flush()
+
+
+def update_rows(session, commitList, rowIDs):
+    """
+    Overwrite existing rows of one table with new objects, in one executemany UPDATE
+    """
+    table = commitList[0].__table__
+    values = row_values(commitList)
+    for value, rowID in zip(values, rowIDs):
+        value['row_id'] = rowID
+
+    session.execute(table.update().where(table.c.id == bindparam('row_id')), values)
+
+
+def setup_files(setupYAML):
+    """
+    Every file setup.yml references, in the order OCD.py reads them
+    """
+    filenames = []
+    if 'logo' in setupYAML['config']:
+        filenames.append('OCD/config_files/' + setupYAML['config']['logo'])
+    filenames += ['OCD/config_files/' + themeFile for themeFile in setupYAML['config'].get('file', [])]
+
+    for setupPage in setupYAML['pages'].values():
+        filenames.append('OCD/pages_files/' + setupPage['page'])
+        filenames += ['OCD/pages_files/' + picture for picture in setupPage.get('file', [])]
+
+    # Handouts are uploaded first, descriptions are only hashed for fingerprints
+    descriptions = []
+    for category in setupYAML['challenges']:
+        for setupChallenge in setupYAML['challenges'][category].values():
+            filenames += ['OCD/challenge_files/' + challengeFile for challengeFile in setupChallenge.get('file', [])]
+            descriptions.append('OCD/challenge_files/' + setupChallenge['description'])
+            descriptions += ['OCD/challenge_files/' + setupChallenge[hint]['description'] for hint in setupChallenge
+                             if re.match(re.compile(r'hint*'), hint)]
+
+    return filenames + descriptions
+
+
+def file_owner(TYPE, challenge_id=None, owner=None):
+    """
+    What an uploaded file belongs to, part of its location
+    """
+    return posixpath.join(TYPE, str(challenge_id if owner is None else owner))
+
+
+def upload_file(commitList, TYPE, filename, challenge_id=None, owner=None):
+    """
+    Upload file to a folder named after the hash of its content and what it belongs to
+    """
+    # Identical files share one copy, each challenge, page, and the config has a location of its own
+    fileLocation = uploads.upload('OCD/' + filename, file_owner(TYPE, challenge_id, owner))
 
     # Add file to queries
     commitList.append(Files(TYPE, fileLocation, challenge_id))
@@ -79,9 +389,28 @@ def upload_file(commitList, TYPE, filename, challenge_id=None):
     return fileLocation
 
 
-def config_setup(session, setupConfig):
+def hash_passwords(passwords):
     """
-    Go through config and commit
+    Hash passwords on a process pool, the hashes keep the order of passwords
+    The workers are started by a forkserver instead of forked from OCD.py, whose upload threads are
+    already running by then, and a fork copies the locks those threads hold without the threads
+    """
+    workers = settings.hash_workers if settings.hash_workers > 0 else os.cpu_count()
+
+    with instrument.stage('hash_passwords'):
+        instrument.count('passwords_hashed', len(passwords))
+        if workers == 1 or len(passwords) < 2:
+            return [hash_password(password) for password in passwords]
+
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('forkserver')) as executor:
+            return list(executor.map(hash_password,
+                                     passwords,
+                                     chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def config_rows(setupConfig):
+    """
+    Go through config and return its rows
     """
     commitList = []
 
@@ -160,6 +489,11 @@ def config_setup(session, setupConfig):
                                                'standard',
                                                'config_files/' + setupConfig['logo']))
 
+    # Files used by the theme, shown on every page so referenced from the root
+    themeLocations = {}
+    for themeFile in setupConfig.get('file', []):
+        themeLocations[themeFile] = upload_file(commitList, 'standard', 'config_files/' + themeFile)
+
     if 'style' in setupConfig:
         with open('OCD/config_files/' + setupConfig['style'], 'r') as style:
             styleHeader += style.read()
@@ -168,27 +502,58 @@ def config_setup(session, setupConfig):
         with open('OCD/config_files/' + setupConfig['theme_header'], 'r') as header:
             styleHeader += header.read()
 
-    commit_to_list('theme_header', styleHeader)
+    commit_to_list('theme_header', rewrite_assets(styleHeader, themeLocations, '/files/'))
 
     if 'theme_footer' in setupConfig:
         with open('OCD/config_files/' + setupConfig['theme_footer'], 'r') as footer:
-            commit_to_list('theme_footer', ''.join(footer.readlines()))
+            commit_to_list('theme_footer', rewrite_assets(footer.read(), themeLocations, '/files/'))
 
-    commit_changes(session, commitList)
+    return commitList
+
+
+def config_setup(session, setupConfig):
+    """
+    Go through config and commit
+    """
+    commitList = config_rows(setupConfig)
+
+    add_changes(session, commitList)
+
+    return commitList
+
+
+def users_rows(setupUsers):
+    """
+    Create users from a list of name and user pairs
+    """
+    passwordHashes = hash_passwords([user['password'] for name, user in setupUsers])
+
+    return [Users(name, password_hash=passwordHash, **user)
+            for (name, user), passwordHash in zip(setupUsers, passwordHashes)]
 
 
 def users_setup(session, setupUsers):
     """
     Go through users and commit
     """
-    commitList = [Users(user, **setupUsers[user]) for user in setupUsers]
+    commitList = users_rows(list(setupUsers.items()))
 
-    commit_changes(session, commitList)
+    add_changes(session, commitList)
 
 
-def pages_setup(session, setupPages):
+def users_file_setup(session, usersFile):
     """
-    Go through pages and commit
+    Stream users from the users_file roster and commit them chunk by chunk
+    """
+    for chunk in read_roster('OCD/config_files/' + usersFile, settings.batch_size):
+        commitList = users_rows([(name, user) for line, name, user in chunk])
+
+        add_changes(session, commitList)
+
+
+def pages_rows(setupPages):
+    """
+    Go through pages and return their rows and uploaded files
     """
     commitList = []
 
@@ -198,21 +563,30 @@ def pages_setup(session, setupPages):
             page = pageFile.read()
 
         # Go through extra settings
-        if 'file' in setupPages[route]:
-            for picture in setupPages[route]['file']:
-                pictureLocaiton = upload_file(commitList, 'page', 'pages_files/' + picture)
-                # Replace the filename with new random folder from upload
-                page = page.replace('src="' + picture + '"', 'src="files/' + pictureLocaiton + '"')
-                page = page.replace("src='" + picture + "'", "src='files/" + pictureLocaiton + "'")
+        pictureLocations = {}
+        for picture in setupPages[route].get('file', []):
+            pictureLocations[picture] = upload_file(commitList, 'page', 'pages_files/' + picture, owner=route)
+
+        # Replace every reference to a file with its new random folder from upload, in one pass
+        page = rewrite_assets(page, pictureLocations, 'files/')
 
         commitList.append(Pages(route, page, **setupPages[route]))
 
-    commit_changes(session, commitList)
+    return commitList
 
 
-def challenges_setup(session, setupChallenges):
+def pages_setup(session, setupPages):
     """
-    Go through challenges and commit
+    Go through pages and commit
+    """
+    commitList = pages_rows(setupPages)
+
+    add_changes(session, commitList)
+
+
+def challenges_rows(setupChallenges):
+    """
+    Go through challenges and return their rows
     """
     commitList = []
 
@@ -233,23 +607,28 @@ def challenges_setup(session, setupChallenges):
                                          setupChallenges[category][challenge]['value'], 
                                          **kwargs))
 
-    commit_changes(session, commitList)
+    return commitList
 
 
-def extras_for_challenges(engine, session, setupChallenges):
+def challenges_setup(session, setupChallenges):
     """
-    Assign flags, tags, hints, files, and requirements to challenges
+    Go through challenges and commit
     """
-    commitList = []
+    commitList = challenges_rows(setupChallenges)
+
+    add_changes(session, commitList)
 
-    # Query for challenge id
-    def get_challenge_id(challenge):
-        with engine.connect() as conn:
-            for row in conn.execute(select([Challenges]).where(Challenges.name == challenge)):
-                chall_id = int(row[0])
-        conn.close()
 
-        return chall_id
+def extras_rows(session, setupChallenges):
+    """
+    Go through flags, tags, hints, files, and requirements of challenges and return their rows
+    Requirements are returned as the values of an UPDATE of the challenges
+    """
+    commitList = []
+    requirementsList = []
+
+    # Challenge ids are resolved from a single query
+    challengeIDs = get_challenge_ids(session)
 
     # Setup flags
     def flags_setup(category, challenge):
@@ -261,13 +640,13 @@ def extras_for_challenges(engine, session, setupChallenges):
             if setupChallenges[category][challenge]['flag']['case'] == 'insensitive':
                 kwargs['case'] = 'case_insensitive'
 
-        commitList.append(Flags(get_challenge_id(challenge), setupChallenges[category][challenge]['flag']['flag'], **kwargs))
+        commitList.append(Flags(challengeIDs[challenge], setupChallenges[category][challenge]['flag']['flag'], **kwargs))
 
 
     # Setup tags
     def tags_setup(category, challenge):
         if 'tag' in setupChallenges[category][challenge]:
-            chal_id = get_challenge_id(challenge)
+            chal_id = challengeIDs[challenge]
             for tag in setupChallenges[category][challenge]['tag']:
                 commitList.append(Tags(chal_id, tag))
 
@@ -275,7 +654,7 @@ def extras_for_challenges(engine, session, setupChallenges):
     # Setup challenge files
     def file_setup(category, challenge):
         if 'file' in setupChallenges[category][challenge]:
-            chal_id = get_challenge_id(challenge)
+            chal_id = challengeIDs[challenge]
             for challengeFile in setupChallenges[category][challenge]['file']:
                 upload_file(commitList,
                             'challenge',
@@ -287,7 +666,7 @@ def extras_for_challenges(engine, session, setupChallenges):
     def hint_setup(category, challenge):
         matches = [hint for hint in setupChallenges[category][challenge]
                    if re.match(re.compile(r'hint*'), hint)]
-        chal_id = get_challenge_id(challenge)
+        chal_id = challengeIDs[challenge]
 
         for hint in matches:
             kwargs = dict()
@@ -306,15 +685,12 @@ def extras_for_challenges(engine, session, setupChallenges):
             requirementsJSON = dict()
             reqIDs = []
             for reqChal in setupChallenges[category][challenge]['requirements']:
-                reqIDs.append(get_challenge_id(reqChal))
+                reqIDs.append(challengeIDs[reqChal])
 
             requirementsJSON['prerequisites'] = reqIDs
 
-            with engine.connect() as conn:
-                conn.execute(update(Challenges)
-                             .where(Challenges.name == challenge)
-                             .values(requirements=requirementsJSON))
-            conn.close()
+            requirementsList.append({'chal_id': challengeIDs[challenge],
+                                     'chal_requirements': requirementsJSON})
 
 
     # Update challenges
@@ -332,47 +708,558 @@ def extras_for_challenges(engine, session, setupChallenges):
             # Setup hints
             hint_setup(category, challenge)
 
-            # Setup hints
+            # Setup requirements
             requirements_setup(category, challenge)
 
-    commit_changes(session, commitList)
+    return commitList, requirementsList
 
 
-def main():
-    # Create connection
-    engine = create_engine('mysql+pymysql://root:ctfd@db/ctfd')
+def update_requirements(session, requirementsList):
+    """
+    Update all requirements in one statement by primary key
+    """
+    if requirementsList:
+        session.execute(update(Challenges.__table__)
+                        .where(Challenges.__table__.c.id == bindparam('chal_id'))
+                        .values(requirements=bindparam('chal_requirements',
+                                                       type_=Challenges.requirements.type)),
+                        requirementsList)
 
-    # Create session
-    Base.metadata.create_all(bind=engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
 
-    # Check if setup is needed
-    check_setup(engine)
+def extras_for_challenges(session, setupChallenges):
+    """
+    Assign flags, tags, hints, files, and requirements to challenges
+    """
+    commitList, requirementsList = extras_rows(session, setupChallenges)
 
-    # Read YAML
-    setupYAML = read_setup_yaml('OCD/setup.yml')
+    update_requirements(session, requirementsList)
+
+    add_changes(session, commitList)
+
+
+def secret_key():
+    """
+    Secret key of CTFd, keeps password fingerprints from being brute-forced
+    None without a key which stays the same between deploys, CTFd then makes a new one at every start
+    """
+    if os.environ.get('SECRET_KEY'):
+        return os.environ['SECRET_KEY'].encode()
+
+    if os.path.isfile('.ctfd_secret_key'):
+        with open('.ctfd_secret_key', 'rb') as secret:
+            return secret.read()
+
+    return None
+
+
+def fingerprint(setupKeys, files=()):
+    """
+    Hash of a setup.yml section together with the content of the files it references
+    """
+    digest = hashlib.sha256(json.dumps(setupKeys, sort_keys=True, default=str).encode())
+    for filename in files:
+        digest.update(uploads.digest('OCD/' + filename).encode())
+
+    return digest.hexdigest()
 
+
+def user_fingerprint(user, key):
+    """
+    Fingerprint of a user, the password is only included as a keyed hash
+    Without a secret key the fingerprint is unknown, a random key would make every user look changed
+    """
+    if key is None:
+        return UNKNOWN_FINGERPRINT
+
+    userKeys = dict(user)
+    userKeys['password'] = hmac.new(key, str(userKeys.get('password')).encode(), hashlib.sha256).hexdigest()
+
+    return fingerprint(userKeys)
+
+
+def page_fingerprint(setupPage):
+    """
+    Fingerprint of a page, its page file, and its pictures
+    """
+    return fingerprint(setupPage,
+                       ['pages_files/' + setupPage['page']] +
+                       ['pages_files/' + picture for picture in setupPage.get('file', [])])
+
+
+def challenge_fingerprint(category, setupChallenge):
+    """
+    Fingerprint of a challenge, its description, hint descriptions, and files
+    """
+    files = [setupChallenge['description']]
+    files += [setupChallenge[hint]['description'] for hint in setupChallenge
+              if re.match(re.compile(r'hint*'), hint)]
+    files += setupChallenge.get('file', [])
+
+    return fingerprint([category, setupChallenge], ['challenge_files/' + filename for filename in files])
+
+
+def config_fingerprints(commitList):
+    """
+    Fingerprint of every config key from the config rows
+    """
+    return {row.key: fingerprint([row.key, row.value]) for row in commitList if isinstance(row, Config)}
+
+
+def user_sources(setupYAML):
+    """
+    Yield users from setup.yml and the users_file roster as lists of name and user pairs
+    """
+    if 'users' in setupYAML:
+        yield list(setupYAML['users'].items())
+
+    if 'users_file' in setupYAML:
+        for chunk in read_roster('OCD/config_files/' + setupYAML['users_file'], settings.batch_size):
+            yield [(name, user) for line, name, user in chunk]
+
+
+def file_fingerprints(setupYAML):
+    """
+    Content hash of every file uploaded for the config and the pages, by location
+    Lets a later deploy find the files of replaced config files and of changed or removed pages
+    """
+    uploaded = [('config_files/' + setupYAML['config']['logo'], file_owner('standard'))] \
+        if 'logo' in setupYAML['config'] else []
+    uploaded += [('config_files/' + themeFile, file_owner('standard')) for themeFile in setupYAML['config'].get('file', [])]
+    for route in setupYAML['pages']:
+        uploaded += [('pages_files/' + picture, file_owner('page', owner=route))
+                     for picture in setupYAML['pages'][route].get('file', [])]
+
+    return {location: digest for digest, location in
+            (uploads.location('OCD/' + filename, owner) for filename, owner in uploaded)}
+
+
+def setup_fingerprints(setupYAML, configRows):
+    """
+    Fingerprint of every config key, user, page, and challenge in setup.yml,
+    and of the files uploaded for the config and the pages
+    """
+    key = secret_key()
+    if key is None:
+        print('No SECRET_KEY or .ctfd_secret_key, changed users can not be found on an incremental deploy')
+
+    fingerprints = dict()
+    fingerprints['config'] = config_fingerprints(configRows)
+    fingerprints['users'] = {name: user_fingerprint(user, key)
+                             for chunk in user_sources(setupYAML) for name, user in chunk}
+    fingerprints['pages'] = {route: page_fingerprint(setupYAML['pages'][route])
+                             for route in setupYAML['pages']}
+    fingerprints['challenges'] = {challenge: challenge_fingerprint(category, setupYAML['challenges'][category][challenge])
+                                  for category in setupYAML['challenges']
+                                  for challenge in setupYAML['challenges'][category]}
+    fingerprints['files'] = file_fingerprints(setupYAML)
+
+    return fingerprints
+
+
+def load_fingerprints(session):
+    """
+    Query all stored fingerprints once
+    """
+    fingerprints = {'config': dict(), 'users': dict(), 'pages': dict(), 'challenges': dict(), 'files': dict()}
+    for kind, name, digest in session.execute(select([Fingerprints.kind, Fingerprints.name, Fingerprints.digest])):
+        fingerprints.setdefault(kind, dict())[name] = digest
+
+    return fingerprints
+
+
+def save_fingerprints(session, fingerprints):
+    """
+    Replace the stored fingerprints with the current ones
+    """
+    session.execute(delete(Fingerprints.__table__))
+
+    commitList = [Fingerprints(kind, name, fingerprints[kind][name])
+                  for kind in fingerprints for name in fingerprints[kind]]
+    if commitList:
+        bulk_insert(session, commitList)
+
+
+def diff_fingerprints(stored, current):
+    """
+    Names which are new, changed, and removed between two sets of fingerprints
+    """
+    new = [name for name in current if name not in stored]
+    changed = [name for name in current if name in stored and stored[name] != current[name]]
+    removed = [name for name in stored if name not in current]
+
+    return new, changed, removed
+
+
+def incremental_config(session, configRows, stored, current):
+    """
+    Replace changed config keys, add new keys, and delete removed keys
+    Keys set in CTFd itself which are new in setup.yml are replaced, CTFd reads one row per key
+    """
+    new, changed, removed = diff_fingerprints(stored, current)
+
+    conflicts = sorted({key for key, in session.execute(select([Config.key]).where(Config.key.in_(new)))})
+    if conflicts:
+        print('Config keys already set in CTFd, replaced: ' + ', '.join(conflicts))
+
+    if changed or removed or conflicts:
+        session.execute(delete(Config.__table__).where(Config.key.in_(changed + removed + conflicts)))
+
+    commitList = [row for row in configRows if isinstance(row, Config) and row.key in new + changed]
+
+    # Uploaded files of the logo and theme, unless an earlier deploy already added them
+    existing = {location for location, in session.execute(
+        select([Files.location]).where(Files.TYPE == 'standard'))}
+    commitList += [row for row in configRows if isinstance(row, Files) and row.location not in existing]
+
+    if commitList:
+        add_changes(session, commitList)
+
+    return len(new), len(changed), len(removed)
+
+
+def incremental_users(session, setupYAML, stored, current):
+    """
+    Update changed users in place, add new users, and delete removed users
+    Users made in CTFd itself with the name of a new user are left alone, and dropped from current
+    """
+    seen = set()
+    userIDs = {name: int(user_id) for user_id, name in session.execute(select([Users.ID, Users.name]))}
+    newCount = changedCount = unknownCount = 0
+    conflicts = []
+
+    for chunk in user_sources(setupYAML):
+        seen.update(name for name, user in chunk)
+        pending = []
+        for name, user in chunk:
+            if name in userIDs and name not in stored:
+                conflicts.append(name)
+            elif name in userIDs and UNKNOWN_FINGERPRINT in (stored[name], current[name]):
+                # Without the secret key of both deploys a changed password can't be told apart
+                unknownCount += 1
+            elif stored.get(name) != current[name]:
+                pending.append((name, user))
+        if not pending:
+            continue
+
+        commitList = users_rows(pending)
+        changedRows = [row for row in commitList if row.name in stored and row.name in userIDs]
+        newRows = [row for row in commitList if not (row.name in stored and row.name in userIDs)]
+
+        if changedRows:
+            update_rows(session, changedRows, [userIDs[row.name] for row in changedRows])
+        if newRows:
+            add_changes(session, newRows)
+
+        newCount += len(newRows)
+        changedCount += len(changedRows)
+
+    # Not deployed from setup.yml, so never updated or removed by a later deploy either
+    for name in conflicts:
+        del current[name]
+    if conflicts:
+        print('Users already in CTFd, skipped: ' + ', '.join(conflicts))
+    if unknownCount:
+        print('Users not compared without a secret key, left as they are: %d' % unknownCount)
+
+    removed = [name for name in stored if name not in seen]
+    if removed:
+        session.execute(delete(Users.__table__).where(Users.name.in_(removed)))
+
+    return newCount, changedCount, len(removed)
+
+
+def incremental_pages(session, setupPages, stored, current):
+    """
+    Replace changed pages, add new pages, and delete removed pages
+    Pages made in CTFd itself on the route of a new page are left alone, and dropped from current
+    """
+    new, changed, removed = diff_fingerprints(stored, current)
+
+    # Not deployed from setup.yml, so never updated or removed by a later deploy either
+    conflicts = [route for route, in session.execute(select([Pages.route]).where(Pages.route.in_(new)))]
+    for route in conflicts:
+        new.remove(route)
+        del current[route]
+    if conflicts:
+        print('Pages already in CTFd, skipped: ' + ', '.join(conflicts))
+
+    if changed or removed:
+        session.execute(delete(Pages.__table__).where(Pages.route.in_(changed + removed)))
+
+    if new or changed:
+        commitList = pages_rows({route: setupPages[route] for route in new + changed})
+
+        # Pictures which did not change are already uploaded
+        existing = {location for location, in session.execute(select([Files.location])
+                                                               .where(Files.challenge_id.is_(None)))}
+        commitList = [row for row in commitList if not (isinstance(row, Files) and row.location in existing)]
+
+        add_changes(session, commitList)
+
+    return len(new), len(changed), len(removed)
+
+
+def replace_extras(session, commitList, challengeIDs):
+    """
+    Update the flags, tags, hints, and files of challenges in place, matched by their position
+    Unlocks, solves, and submissions point at their ids, so only the difference is inserted or deleted
+    """
+    for table in (Flags, Tags, Hints, Files):
+        liveIDs = dict()
+        for rowID, challengeID in session.execute(select([table.ID, table.challenge_id])
+                                                  .where(table.challenge_id.in_(challengeIDs))
+                                                  .order_by(table.ID)):
+            liveIDs.setdefault(challengeID, []).append(int(rowID))
+
+        rows = dict()
+        for row in commitList:
+            if isinstance(row, table):
+                rows.setdefault(row.challenge_id, []).append(row)
+
+        updated, updatedIDs, inserted, deletedIDs = [], [], [], []
+        for challengeID in challengeIDs:
+            live, setup = liveIDs.get(challengeID, []), rows.get(challengeID, [])
+            updated += setup[:len(live)]
+            updatedIDs += live[:len(setup)]
+            inserted += setup[len(live):]
+            deletedIDs += live[len(setup):]
+
+        if updated:
+            update_rows(session, updated, updatedIDs)
+        if deletedIDs:
+            session.execute(delete(table.__table__).where(table.ID.in_(deletedIDs)))
+        if inserted:
+            add_changes(session, inserted)
+
+
+def incremental_challenges(session, setupChallenges, stored, current):
+    """
+    Update changed challenges and their flags, tags, hints, and files in place,
+    add new challenges, and delete removed challenges
+    """
+    new, changed, removed = diff_fingerprints(stored, current)
+    challengeIDs = get_challenge_ids(session)
+
+    # Solves point at the challenge id, so changed challenges keep theirs
+    changed = [challenge for challenge in changed if challenge in challengeIDs]
+    removedIDs = [challengeIDs[challenge] for challenge in removed if challenge in challengeIDs]
+
+    if removedIDs:
+        for table in (Flags.__table__, Tags.__table__, Hints.__table__, Files.__table__):
+            session.execute(delete(table).where(table.c.challenge_id.in_(removedIDs)))
+        session.execute(delete(Challenges.__table__).where(Challenges.ID.in_(removedIDs)))
+
+    def subset(names):
+        return {category: {challenge: setupChallenges[category][challenge]
+                           for challenge in setupChallenges[category] if challenge in names}
+                for category in setupChallenges}
+
+    if changed:
+        commitList = challenges_rows(subset(changed))
+        update_rows(session, commitList, [challengeIDs[row.name] for row in commitList])
+
+    if new:
+        challenges_setup(session, subset(new))
+
+    if new or changed:
+        commitList, requirementsList = extras_rows(session, subset(new + changed))
+        update_requirements(session, requirementsList)
+
+        changedIDs = [challengeIDs[challenge] for challenge in changed]
+        replace_extras(session, [row for row in commitList if row.challenge_id in changedIDs], changedIDs)
+
+        newRows = [row for row in commitList if row.challenge_id not in changedIDs]
+        if newRows:
+            add_changes(session, newRows)
+
+    return len(new), len(changed), len(removed)
+
+
+def incremental_setup(session, setupYAML, configRows, fingerprints):
+    """
+    Apply only what changed in setup.yml since the last deploy, return the kinds of rows which changed
+    """
+    stored = load_fingerprints(session)
+
+    counts = dict()
+    counts['config'] = incremental_config(session, configRows, stored['config'], fingerprints['config'])
+    counts['users'] = incremental_users(session, setupYAML, stored['users'], fingerprints['users'])
+    counts['pages'] = incremental_pages(session, setupYAML['pages'], stored['pages'], fingerprints['pages'])
+    counts['challenges'] = incremental_challenges(session, setupYAML['challenges'],
+                                                  stored['challenges'], fingerprints['challenges'])
+
+    # Files of replaced config files and of changed or removed pages, challenge files are updated in place
+    staleFiles = [location for location in stored['files'] if location not in fingerprints['files']]
+    if staleFiles:
+        session.execute(delete(Files.__table__).where(Files.challenge_id.is_(None))
+                        .where(Files.location.in_(staleFiles)))
+
+    for kind in counts:
+        print('Incremental ' + kind + ': %d new, %d changed, %d removed' % counts[kind])
+
+    return [kind for kind in counts if sum(counts[kind])]
+
+
+def full_setup(session, setupYAML):
+    """
+    Fill an empty database with everything in setup.yml, return the fingerprints of what was added
+    Used by main and by compile_setup.py
+    """
     # Config setup
-    config_setup(session, setupYAML['config'])
+    with instrument.stage('config_setup'):
+        configRows = config_setup(session, setupYAML['config'])
 
     # Users setup
-    users_setup(session, setupYAML['users'])
+    if 'users' in setupYAML:
+        with instrument.stage('users_setup'):
+            users_setup(session, setupYAML['users'])
+
+    # Users from roster file
+    if 'users_file' in setupYAML:
+        with instrument.stage('users_file_setup'):
+            users_file_setup(session, setupYAML['users_file'])
 
     # Pages setup
-    pages_setup(session, setupYAML['pages'])
+    with instrument.stage('pages_setup'):
+        pages_setup(session, setupYAML['pages'])
 
     # Challenges setup
-    challenges_setup(session, setupYAML['challenges'])
+    with instrument.stage('challenges_setup'):
+        challenges_setup(session, setupYAML['challenges'])
 
     # Assign tags, hints, files, and requirements to challenges
-    extras_for_challenges(engine, session, setupYAML['challenges'])
+    with instrument.stage('extras_for_challenges'):
+        extras_for_challenges(session, setupYAML['challenges'])
+
+    with instrument.stage('setup_fingerprints'):
+        return setup_fingerprints(setupYAML, configRows)
+
+
+def clear_cache(kinds=None):
+    """
+    Remove what CTFd cached from the database, so the new rows are read
+    An incremental deploy passes the kinds of rows it changed and keeps sessions, users keep their ids
+    """
+    if not os.environ.get('REDIS_URL'):
+        return
+    try:
+        client = connect(os.environ['REDIS_URL'])
+        print('Removed %d stale keys from the CTFd cache' % invalidate(client, keepSessions=kinds is not None,
+                                                                        kinds=kinds))
+        client.close()
+    except (OSError, RedisError) as cacheError:
+        # start.sh removes them once CTFd is up if it still shows its setup form
+        print('Could not clear the CTFd cache: ' + (str(cacheError) or type(cacheError).__name__))
+
+
+def write_report():
+    """
+    Write the instrumentation report and profile, and print a summary at the end of the log
+    """
+    reportFile = posixpath.join(LOG_FOLDER, 'OCD-report.json')
+    profileFile = posixpath.join(LOG_FOLDER, 'OCD.prof')
+    try:
+        stats = instrument.stop_profile(profileFile)
+        instrument.write(reportFile, uploads=uploads.stats())
+        print('OCD.py stages, report written to ' + reportFile)
+    except OSError:
+        stats = None
+        print('OCD.py stages, report could not be written to ' + LOG_FOLDER)
+    instrument.summary()
+
+    if stats is not None:
+        print('Profile written to ' + profileFile)
+        stats.sort_stats('cumulative').print_stats(15)
+
+
+# Fingerprint of a user deployed without a secret key
+UNKNOWN_FINGERPRINT = ''
+
+# Folder CTFd serves uploaded files from
+UPLOAD_FOLDER = posixpath.join('/', 'var', 'uploads')
+
+# Folder of the CTFd logs, kept on the host in .data/CTFd/logs
+LOG_FOLDER = posixpath.join('/', 'var', 'log', 'CTFd')
+
+# Global deployment settings
+settings = Settings()
+
+# Global upload stage
+uploads = Uploads()
+
+# Global instrumentation of the run
+instrument = Instrument()
+
+def main():
+    # Profile the whole run if asked for on the command line
+    if '--profile' in sys.argv[1:]:
+        instrument.start_profile()
+
+    # Create connection
+    engine = create_engine(DATABASE_URL)
+    instrument.attach(engine)
+
+    # Create session
+    Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(bind=engine)
+    session = Session()
+
+    # Check if setup is needed
+    setupDone = check_setup(engine)
+
+    # Read YAML
+    with instrument.stage('read_setup_yaml'):
+        setupYAML = read_setup_yaml('OCD/setup.yml')
+
+    # Deployment settings
+    if 'deploy' in setupYAML:
+        settings.load(setupYAML['deploy'])
+    if settings.profile == 1:
+        instrument.start_profile()
+
+    if setupDone and settings.incremental != 1:
+        quit(1)
+
+    if setupDone and not any(load_fingerprints(session).values()):
+        # Incremental deploy needs to know what the last deploy did
+        print('No fingerprints from an earlier deploy, run start.sh --clean for a full deploy')
+        quit(1)
+
+    # Hash files on the upload workers while the database is filled, only once there is something to fill
+    uploads.prefetch(setup_files(setupYAML))
+
+    if setupDone:
+        configRows = config_rows(setupYAML['config'])
+        with instrument.stage('setup_fingerprints'):
+            fingerprints = setup_fingerprints(setupYAML, configRows)
+        with instrument.stage('incremental_setup'):
+            changes = incremental_setup(session, setupYAML, configRows, fingerprints)
+    else:
+        fingerprints = full_setup(session, setupYAML)
+        changes = None
+
+    # Remember what was deployed for the next incremental deploy
+    with instrument.stage('save_fingerprints'):
+        save_fingerprints(session, fingerprints)
+
+    # Wait for uploads to be copied, then commit everything at once
+    with instrument.stage('uploads'):
+        uploads.wait()
+    with instrument.stage('commit'):
+        session.commit()
+    uploads.report()
+
+    # Everything cached is stale after a full deploy, only what it changed after an incremental one
+    if changes is None or changes:
+        with instrument.stage('clear_cache'):
+            clear_cache(changes)
 
     # Close session
     session.close()
 
+    write_report()
+
 
 if __name__ == '__main__':
     main()
-
-quit(0)
+    quit(0)
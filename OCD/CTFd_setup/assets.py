@@ -0,0 +1,52 @@
+"""
+Rewrites references to uploaded files in pages and theme files in a single pass
+Covers src, href, and srcset attributes, and CSS url()
+"""
+import re
+
+
+# Quoted src, href, or srcset attribute, or a CSS url() with or without quotes
+ASSET_PATTERN = re.compile(
+    r'(?P<attribute>\b(?:src|href|srcset)\s*=\s*)(?P<quote>["\'])(?P<value>.*?)(?P=quote)'
+    r'|(?P<function>\burl\(\s*)(?P<urlQuote>["\']?)(?P<url>[^"\'()]*)(?P=urlQuote)(?P<close>\s*\))',
+    re.IGNORECASE | re.DOTALL)
+
+
+def rewrite_assets(content, locations, prefix):
+    """
+    Replace every reference to a filename in locations with prefix and its upload location
+    """
+    if not locations:
+        return content
+
+    def asset_url(value):
+        filename = value.strip()
+        if filename.startswith('./'):
+            filename = filename[2:]
+        if filename in locations:
+            return prefix + locations[filename]
+        return value
+
+    def srcset_urls(value):
+        # Candidates are "url descriptor" separated by commas
+        candidates = []
+        for candidate in value.split(','):
+            parts = candidate.strip().split(None, 1)
+            if parts:
+                parts[0] = asset_url(parts[0])
+            candidates.append(' '.join(parts))
+        return ', '.join(candidates)
+
+    def replace(match):
+        if match.group('attribute') is not None:
+            value = match.group('value')
+            if match.group('attribute').lower().startswith('srcset'):
+                value = srcset_urls(value)
+            else:
+                value = asset_url(value)
+            return match.group('attribute') + match.group('quote') + value + match.group('quote')
+
+        return (match.group('function') + match.group('urlQuote') + asset_url(match.group('url')) +
+                match.group('urlQuote') + match.group('close'))
+
+    return ASSET_PATTERN.sub(replace, content)
@@ -0,0 +1,482 @@
+"""
+Benchmarks for the slow parts of provisioning CTFd with OCD.py
+Run from the CTFd folder inside the CTFd container, next to OCD.py and db.py
+"""
+import os
+import sys
+import time
+import json
+import random
+import secrets
+import shutil
+import argparse
+import tempfile
+
+
+def timed(func, *args):
+    """
+    Run func and return the time it took together with its result
+    """
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def sqlite_types():
+    """
+    Let SQLite create the MySQL types of db.py, for databases without a MySQL server
+    """
+    from sqlalchemy.dialects.mysql import TINYINT
+    from sqlalchemy.ext.compiler import compiles
+
+    @compiles(TINYINT, 'sqlite')
+    def compile_tinyint(type_, compiler, **kw):
+        return 'INTEGER'
+
+
+def hashing_benchmark(args):
+    """
+    Compare serial and parallel password hashing over a generated user list
+    """
+    # OCD imports CTFd, only needed for this benchmark
+    import OCD
+
+    passwords = [os.urandom(8).hex() for _ in range(args.users)]
+
+    OCD.settings.hash_workers = 1
+    serialTime, serialHashes = timed(OCD.hash_passwords, passwords)
+
+    OCD.settings.hash_workers = args.workers
+    parallelTime, parallelHashes = timed(OCD.hash_passwords, passwords)
+
+    workers = args.workers if args.workers > 0 else os.cpu_count()
+    print('Hashed ' + str(args.users) + ' passwords')
+    print('  serial:   %.2fs' % serialTime)
+    print('  parallel: %.2fs (%d workers)' % (parallelTime, workers))
+    print('  speedup:  %.2fx' % (serialTime / parallelTime))
+
+    if len(serialHashes) != len(parallelHashes):
+        print('Parallel hashing lost passwords')
+        quit(1)
+
+
+def place_all(strategy, sources, folder):
+    """
+    Place every source file into folder with one strategy
+    """
+    for source in sources:
+        strategy(source, os.path.join(folder, os.path.basename(source)))
+
+
+def placement_benchmark(args):
+    """
+    Compare file placement strategies over generated large files
+    """
+    import placement
+
+    sourceFolder = tempfile.mkdtemp(dir=args.source)
+    targetFolder = tempfile.mkdtemp(dir=args.target)
+    try:
+        # Generate files, random content so nothing can be compressed or deduplicated
+        sources = []
+        for number in range(args.files):
+            source = os.path.join(sourceFolder, 'handout' + str(number))
+            with open(source, 'wb') as handout:
+                for _ in range(args.size):
+                    handout.write(os.urandom(1024 * 1024))
+            sources.append(source)
+
+        totalSize = args.files * args.size
+        print('Placed ' + str(args.files) + ' files of ' + str(args.size) + ' MB')
+        for name in placement.STRATEGIES:
+            strategyFolder = os.path.join(targetFolder, name)
+            os.makedirs(strategyFolder)
+            try:
+                placeTime, _ = timed(place_all, placement.STRATEGIES[name], sources, strategyFolder)
+                print('  %-16s %7.2fs %9.1f MB/s' % (name + ':', placeTime, totalSize / max(placeTime, 1e-9)))
+            except OSError as placeError:
+                print('  %-16s unsupported, %s' % (name + ':', placeError.strerror))
+            shutil.rmtree(strategyFolder)
+    finally:
+        shutil.rmtree(sourceFolder)
+        shutil.rmtree(targetFolder)
+
+
+def generated_setup(users=0, categories=20, challenges=2000, hints=1, tags=0, files=1,
+                    requirements=1.0, seed=0):
+    """
+    setup.yml shaped document of a synthetic event
+    requirements is the chance that a challenge requires an earlier one
+    """
+    generator = random.Random(seed)
+
+    setupUsers = {}
+    for number in range(users):
+        setupUsers['user' + str(number)] = {
+            'password': 'password' + str(number),
+            'email': 'user' + str(number) + '@bench.test',
+            'type': 'admin' if number == 0 else 'user',
+            'hidden': 0,
+        }
+
+    setupCategories = {}
+    for number in range(challenges):
+        name = 'challenge' + str(number)
+        challenge = {
+            'value': 100,
+            'description': name + '.md',
+            'flag': {'flag': 'CTF{' + os.urandom(8).hex() + '}', 'type': 'static', 'case': 'sensitive'},
+        }
+        if files:
+            challenge['file'] = [name + '_' + str(fileNumber) + '.bin' for fileNumber in range(files)]
+        if tags:
+            challenge['tag'] = ['tag' + str(tagNumber) for tagNumber in range(tags)]
+        for hintNumber in range(hints):
+            challenge['hint' + str(hintNumber)] = {'description': name + '_hint' + str(hintNumber) + '.md', 'cost': 10}
+        if number > 0 and generator.random() < requirements:
+            challenge['requirements'] = ['challenge' + str(generator.randrange(number))]
+        setupCategories.setdefault('category' + str(number % max(categories, 1)), {})[name] = challenge
+
+    setup = {
+        'config': {
+            'name': 'Benchmark',
+            'description': 'Synthetic event',
+            'user_mode': 'users',
+            'start': '01/01/2030 10:00',
+            'end': '02/01/2030 10:00',
+        },
+        'pages': {'index': {'page': 'index.html'}},
+        'challenges': setupCategories,
+    }
+    if setupUsers:
+        setup['users'] = setupUsers
+    return {'CTFd': setup}
+
+
+def write_event(folder, setup, fileSize):
+    """
+    Write setup.yml and every file it references into folder/OCD, handouts are fileSize KB
+    """
+    import yaml
+
+    for subfolder in ('config_files', 'pages_files', 'challenge_files'):
+        os.makedirs(os.path.join(folder, 'OCD', subfolder), exist_ok=True)
+
+    with open(os.path.join(folder, 'OCD', 'setup.yml'), 'w') as setupFile:
+        yaml.dump(setup, setupFile, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper))
+
+    # Timezone offset written by start.sh, UTC here
+    with open(os.path.join(folder, 'OCD', 'config_files', 'tz'), 'w') as tz:
+        tz.write('0\n')
+
+    with open(os.path.join(folder, 'OCD', 'pages_files', 'index.html'), 'w') as page:
+        page.write('<h1>Benchmark</h1>\n')
+
+    challengeFolder = os.path.join(folder, 'OCD', 'challenge_files')
+    for challenges in setup['CTFd']['challenges'].values():
+        for name, challenge in challenges.items():
+            markdown = [challenge['description']]
+            markdown += [challenge[key]['description'] for key in challenge if key.startswith('hint')]
+            for filename in markdown:
+                with open(os.path.join(challengeFolder, filename), 'w') as description:
+                    description.write('# ' + name + '\n')
+            # Random content, so uploads can't be deduplicated
+            for filename in challenge.get('file', []):
+                with open(os.path.join(challengeFolder, filename), 'wb') as handout:
+                    handout.write(os.urandom(fileSize * 1024))
+
+
+def event_arguments(parser):
+    """
+    Arguments describing the scale of a generated event
+    """
+    parser.add_argument('--users', type=int, default=100, help='amount of users')
+    parser.add_argument('--categories', type=int, default=10, help='amount of categories')
+    parser.add_argument('--challenges', type=int, default=200, help='amount of challenges')
+    parser.add_argument('--hints', type=int, default=2, help='hints per challenge')
+    parser.add_argument('--tags', type=int, default=2, help='tags per challenge')
+    parser.add_argument('--files', type=int, default=1, help='handout files per challenge')
+    parser.add_argument('--file-size', type=int, default=64, help='size of each handout in KB')
+    parser.add_argument('--requirements', type=float, default=0.3,
+                        help='chance that a challenge requires an earlier one')
+    parser.add_argument('--seed', type=int, default=0, help='seed for the requirements')
+
+
+def event_setup(args):
+    return generated_setup(args.users, args.categories, args.challenges, args.hints,
+                           args.tags, args.files, args.requirements, args.seed)
+
+
+def generate_benchmark(args):
+    """
+    Write a synthetic event, usable by check_yaml.py, OCD.py, and the provision benchmark
+    """
+    write_event(args.folder, event_setup(args), args.file_size)
+    print('Generated an event in ' + os.path.join(args.folder, 'OCD'))
+
+
+def run_stage(name, func, *args):
+    """
+    Run func as a stage of the OCD.py instrumentation
+    """
+    import OCD
+
+    with OCD.instrument.stage(name):
+        return func(*args)
+
+
+def provision_benchmark(args):
+    """
+    Run every stage of OCD.main against a throwaway database and a generated event
+    """
+    # OCD imports CTFd, only needed for this benchmark
+    import OCD
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    workspace = tempfile.mkdtemp(dir=args.folder)
+    cwd = os.getcwd()
+    try:
+        setup = event_setup(args)
+        if args.deploy:
+            setup['CTFd']['deploy'] = args.deploy
+        write_event(workspace, setup, args.file_size)
+
+        # OCD.py reads everything relative to the CTFd folder
+        os.chdir(workspace)
+        OCD.UPLOAD_FOLDER = os.path.join(workspace, 'uploads')
+
+        database = args.database or 'sqlite:///' + os.path.join(workspace, 'ctfd.db')
+        if database.startswith('sqlite'):
+            sqlite_types()
+        engine = create_engine(database)
+        OCD.Base.metadata.create_all(bind=engine)
+        session = sessionmaker(bind=engine)()
+
+        OCD.instrument.attach(engine)
+        print('Provisioned %d users, %d challenges in %d categories on %s' %
+              (args.users, args.challenges, args.categories, engine.dialect.name))
+
+        setupYAML = run_stage('read_setup_yaml', OCD.read_setup_yaml, 'OCD/setup.yml')
+        if 'deploy' in setupYAML:
+            OCD.settings.load(setupYAML['deploy'])
+
+        run_stage('prefetch', OCD.uploads.prefetch, OCD.setup_files(setupYAML))
+
+        # check_yaml.py stays in OCD/CTFd_setup and needs pycountry, which CTFd may not have
+        try:
+            sys.path.append(os.path.join(cwd, 'OCD', 'CTFd_setup'))
+            import check_yaml
+            errors = run_stage('check_yaml', check_yaml.validate, {'CTFd': setupYAML})
+            if errors:
+                print('  check_yaml found ' + str(len(errors)) + ' errors in the generated event')
+        except ImportError as importError:
+            print('  check_yaml skipped, ' + str(importError))
+
+        configRows = run_stage('config_setup', OCD.config_setup, session, setupYAML['config'])
+        run_stage('users_setup', OCD.users_setup, session, setupYAML.get('users', {}))
+        run_stage('pages_setup', OCD.pages_setup, session, setupYAML['pages'])
+        run_stage('challenges_setup', OCD.challenges_setup, session, setupYAML['challenges'])
+        run_stage('extras_for_challenges', OCD.extras_for_challenges, session, setupYAML['challenges'])
+        fingerprints = run_stage('setup_fingerprints', OCD.setup_fingerprints, setupYAML, configRows)
+        run_stage('save_fingerprints', OCD.save_fingerprints, session, fingerprints)
+        run_stage('uploads', OCD.uploads.wait)
+        run_stage('commit', session.commit)
+        session.close()
+
+        OCD.instrument.summary()
+
+        if args.output:
+            OCD.instrument.write(
+                os.path.join(cwd, args.output),
+                benchmark='provision',
+                time=time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                python=sys.version.split()[0],
+                database=engine.dialect.name,
+                event={key: getattr(args, key) for key in
+                       ('users', 'categories', 'challenges', 'hints', 'tags', 'files',
+                        'file_size', 'requirements', 'seed')},
+                deploy=setup['CTFd'].get('deploy', {}),
+                uploads=OCD.uploads.stats(),
+            )
+            print('Wrote ' + args.output)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace)
+
+
+def table_rows(engine, ignore):
+    """
+    Every row of every table of db.py ordered by id, without the columns in ignore
+    """
+    from sqlalchemy import select
+    import OCD
+
+    tables = {}
+    with engine.connect() as connection:
+        for table in OCD.Base.metadata.sorted_tables:
+            columns = [column for column in table.columns if table.name + '.' + column.name not in ignore]
+            query = select(columns).order_by(*table.primary_key.columns)
+            tables[table.name] = [tuple(row) for row in connection.execute(query)]
+    return tables
+
+
+def compile_benchmark(args):
+    """
+    Compare the rows OCD.py inserts with the rows of the dump compile_setup.py writes for the same event
+    """
+    # OCD imports CTFd, only needed for this benchmark
+    import OCD
+    import compile_setup
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    workspace = tempfile.mkdtemp(dir=args.folder)
+    cwd = os.getcwd()
+    try:
+        write_event(workspace, event_setup(args), args.file_size)
+
+        # OCD.py reads everything relative to the CTFd folder
+        os.chdir(workspace)
+        # Password fingerprints are keyed, both runs read the key CTFd would run with
+        with open('.ctfd_secret_key', 'w') as secret:
+            secret.write(secrets.token_hex(32))
+        sqlite_types()
+
+        def provision():
+            OCD.UPLOAD_FOLDER = os.path.join(workspace, 'uploads')
+            engine = create_engine('sqlite:///' + os.path.join(workspace, 'ctfd.db'))
+            OCD.Base.metadata.create_all(bind=engine)
+            session = sessionmaker(bind=engine)()
+
+            setupYAML = OCD.read_setup_yaml('OCD/setup.yml')
+            OCD.uploads.prefetch(OCD.setup_files(setupYAML))
+            OCD.save_fingerprints(session, OCD.full_setup(session, setupYAML))
+            OCD.uploads.wait()
+            session.commit()
+            session.close()
+            return engine
+
+        def compile_dump():
+            engine = compile_setup.compile_rows('OCD/setup.yml', os.path.join(workspace, 'compiled'))
+            return compile_setup.write_dump(engine, 'setup.sql', OCD.settings.batch_size)
+
+        def load_dump():
+            engine = create_engine('sqlite:///' + os.path.join(workspace, 'loaded.db'))
+            OCD.Base.metadata.create_all(bind=engine)
+            # The MySQL tables are made by create_all above, only the rows are loaded
+            with engine.begin() as connection:
+                for statement in compile_setup.dump_statements('setup.sql'):
+                    if statement.startswith('INSERT'):
+                        connection.connection.execute(statement)
+            return engine
+
+        provisionTime, provisioned = timed(provision)
+        OCD.uploads = OCD.Uploads()
+        compileTime, counts = timed(compile_dump)
+        loadTime, loaded = timed(load_dump)
+
+        print('Compiled %d users, %d challenges in %d categories, %d rows' %
+              (args.users, args.challenges, args.categories, sum(counts.values())))
+        print('  %-10s %.2fs' % ('OCD.py:', provisionTime))
+        print('  %-10s %.2fs, %.1f kB' % ('compile:', compileTime, os.path.getsize('setup.sql') / 1e3))
+        print('  %-10s %.2fs' % ('load:', loadTime))
+
+        # Password hashes are salted, so they differ between any two runs
+        expected = table_rows(provisioned, ('users.password',))
+        actual = table_rows(loaded, ('users.password',))
+        different = [table for table in expected if expected[table] != actual[table]]
+        if different:
+            print('Rows of the dump differ from OCD.py in: ' + ', '.join(different))
+            quit(1)
+        print('Rows of the dump match OCD.py')
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workspace)
+
+
+def yaml_benchmark(args):
+    """
+    Compare the pure Python and libyaml loaders and the parsed-document cache
+    """
+    import yaml
+    import yaml_loader
+
+    folder = tempfile.mkdtemp(dir=args.folder)
+    try:
+        setupFile = os.path.join(folder, 'setup.yml')
+        with open(setupFile, 'w') as setup:
+            yaml.dump(generated_setup(challenges=args.challenges), setup, Dumper=getattr(yaml, 'CSafeDumper', yaml.SafeDumper))
+        with open(setupFile, 'rb') as setup:
+            content = setup.read()
+
+        print('Parsed ' + str(content.count(b'\n')) + ' lines of YAML')
+        loaders = [('python', yaml.SafeLoader)]
+        if hasattr(yaml, 'CSafeLoader'):
+            loaders.append(('libyaml', yaml.CSafeLoader))
+        else:
+            print('  libyaml:  unavailable, PyYAML was built without it')
+
+        for name, loader in loaders:
+            loadTime, _ = timed(yaml_loader.load_yaml, content, loader)
+            print('  %-9s %.3fs' % (name + ':', loadTime))
+
+        # First read fills the cache, the second one is what later stages pay
+        yaml_loader.read_setup(setupFile)
+        cacheTime, _ = timed(yaml_loader.read_setup, setupFile)
+        print('  %-9s %.3fs' % ('cached:', cacheTime))
+    finally:
+        shutil.rmtree(folder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark OCD.py provisioning')
+    benchmarks = parser.add_subparsers(dest='benchmark')
+
+    hashing = benchmarks.add_parser('hashing', help='serial vs parallel password hashing')
+    hashing.add_argument('--users', type=int, default=200, help='amount of generated users')
+    hashing.add_argument('--workers', type=int, default=0, help='worker processes, 0 is the CPU count')
+    hashing.set_defaults(func=hashing_benchmark)
+
+    placement = benchmarks.add_parser('placement', help='file placement strategies for uploads')
+    placement.add_argument('--files', type=int, default=4, help='amount of generated files')
+    placement.add_argument('--size', type=int, default=256, help='size of each file in MB')
+    placement.add_argument('--source', default=None, help='folder to generate files in')
+    placement.add_argument('--target', default=None, help='folder to place files in, e.g. /var/uploads')
+    placement.set_defaults(func=placement_benchmark)
+
+    yamlParser = benchmarks.add_parser('yaml', help='YAML loaders and the parsed setup.yml cache')
+    yamlParser.add_argument('--challenges', type=int, default=2000, help='amount of generated challenges')
+    yamlParser.add_argument('--folder', default=None, help='folder to generate setup.yml in')
+    yamlParser.set_defaults(func=yaml_benchmark)
+
+    generate = benchmarks.add_parser('generate', help='write a synthetic event with setup.yml and its files')
+    event_arguments(generate)
+    generate.add_argument('folder', help='folder to write OCD/ into')
+    generate.set_defaults(func=generate_benchmark)
+
+    provision = benchmarks.add_parser('provision', help='every stage of OCD.py on a generated event')
+    event_arguments(provision)
+    provision.add_argument('--deploy', type=json.loads, default=None,
+                           help='deploy section as JSON, e.g. \'{"bulk_insert": 1}\'')
+    provision.add_argument('--database', default=None,
+                           help='throwaway database URL, default is a temporary SQLite file')
+    provision.add_argument('--folder', default=None, help='folder to generate the event in')
+    provision.add_argument('--output', default=None, help='JSON file to write the results to')
+    provision.set_defaults(func=provision_benchmark)
+
+    compileParser = benchmarks.add_parser('compile', help='rows of a compiled setup.sql against OCD.py')
+    event_arguments(compileParser)
+    compileParser.add_argument('--folder', default=None, help='folder to generate the event in')
+    compileParser.set_defaults(func=compile_benchmark)
+
+    args = parser.parse_args()
+    if args.benchmark is None:
+        parser.print_help()
+        sys.exit(1)
+
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
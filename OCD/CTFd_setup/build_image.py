@@ -0,0 +1,118 @@
+"""
+Builds the CTFd image with OCD baked in, used by start.sh when PREBUILT_IMAGE is set
+The CTFd submodule is built once as the base, OCD/CTFd_setup/Dockerfile adds OCD on top
+Prints how long every layer took, cached layers take no time
+"""
+import os
+import re
+import sys
+import time
+import argparse
+import subprocess
+
+
+# Header, cache hit, and end of a step in the plain progress output of BuildKit
+STEP = re.compile(r'^#(\d+) \[([^\]]+)\] (.*)$')
+CACHED = re.compile(r'^#(\d+) CACHED$')
+DONE = re.compile(r'^#(\d+) DONE (\d+(?:\.\d+)?)s$')
+ERROR = re.compile(r'^#(\d+) ERROR')
+
+
+class Step:
+    """
+    A Dockerfile instruction and how its layer was made
+    """
+    def __init__(self, name, instruction):
+        self.name = name
+        self.instruction = instruction
+        self.status = 'running'
+        self.seconds = 0.0
+
+    def __str__(self):
+        if self.status == 'cached':
+            result = 'cached'
+        elif self.status == 'done':
+            result = '%.2fs' % self.seconds
+        else:
+            result = self.status
+        instruction = self.instruction if len(self.instruction) <= 64 else self.instruction[:61] + '...'
+        return '  %-14s %-64s %s' % (self.name, instruction, result)
+
+
+def parse_progress(lines):
+    """
+    Steps of a build from its plain progress output, in the order BuildKit started them
+    Internal steps like loading the Dockerfile are left out
+    """
+    steps = dict()
+    for line in lines:
+        line = line.rstrip('\n')
+        match = STEP.match(line)
+        if match:
+            if match.group(2) != 'internal':
+                steps.setdefault(int(match.group(1)), Step(match.group(2), match.group(3)))
+            continue
+        for pattern, status in ((CACHED, 'cached'), (DONE, 'done'), (ERROR, 'failed')):
+            match = pattern.match(line)
+            if match and int(match.group(1)) in steps:
+                steps[int(match.group(1))].status = status
+                if status == 'done':
+                    steps[int(match.group(1))].seconds = float(match.group(2))
+
+    return [steps[number] for number in sorted(steps)]
+
+
+def docker_build(context, tag, dockerfile=None, buildArgs=None):
+    """
+    Build context as tag with BuildKit and return whether it worked, its time, steps, and output
+    """
+    command = ['docker', 'build', '--progress=plain', '-t', tag]
+    if dockerfile:
+        command += ['-f', dockerfile]
+    for name, value in (buildArgs or {}).items():
+        command += ['--build-arg', name + '=' + value]
+    command.append(context)
+
+    environment = dict(os.environ, DOCKER_BUILDKIT='1')
+    start = time.monotonic()
+    result = subprocess.run(command, env=environment, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output = result.stdout.decode(errors='replace').splitlines()
+    return result.returncode == 0, time.monotonic() - start, parse_progress(output), output
+
+
+def build(name, context, tag, dockerfile=None, buildArgs=None):
+    """
+    Build one image and print the time of each of its layers
+    """
+    built, buildTime, steps, output = docker_build(context, tag, dockerfile, buildArgs)
+
+    print('%s image %s %s in %.2fs' % (name, tag, 'built' if built else 'failed', buildTime))
+    for step in steps:
+        print(step)
+    if not built:
+        print('\n'.join('    ' + line for line in output[-20:]))
+    return built
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the CTFd image with OCD baked in')
+    parser.add_argument('--ctfd', default='CTFd', help='CTFd submodule, built as the base image')
+    parser.add_argument('--ocd', default='OCD', help='OCD folder, the context of OCD/CTFd_setup/Dockerfile')
+    parser.add_argument('--base-tag', default='ctfdeploy/ctfd-base', help='tag of the base image')
+    parser.add_argument('--tag', default='ctfdeploy/ctfd', help='tag of the image with OCD')
+    parser.add_argument('--tz', default='+0', help='time difference of the host, see timezone.py')
+    args = parser.parse_args()
+
+    # The submodule only changes with CTFd itself, so this is cached after the first build
+    if not build('CTFd', args.ctfd, args.base_tag):
+        sys.exit(1)
+
+    buildArgs = {'BASE': args.base_tag, 'TZ_OFFSET': args.tz}
+    dockerfile = os.path.join(args.ocd, 'CTFd_setup', 'Dockerfile')
+    if not build('OCD', args.ocd, args.tag, dockerfile, buildArgs):
+        sys.exit(1)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
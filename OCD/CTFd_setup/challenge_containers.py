@@ -0,0 +1,215 @@
+"""
+Builds and starts the docker challenges in OCD/docker_challenges, used by start.sh
+Images are built on a few workers while CTFd starts, and a service is only rebuilt
+when the hash of its build context changed since its last successful build
+"""
+import os
+import sys
+import json
+import time
+import fnmatch
+import hashlib
+import argparse
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from yaml_loader import load_yaml
+
+
+# Build context hashes of the last successful builds, next to docker-compose.yml
+CACHE_FILE = '.build_cache.json'
+
+
+def read_services(composeFile):
+    """
+    Services of a docker-compose.yml
+    """
+    with open(composeFile, 'rb') as compose:
+        services = load_yaml(compose.read()).get('services') or {}
+    return services
+
+
+def build_settings(service, folder):
+    """
+    Build context folder, Dockerfile, and build args of a service, None if it only uses an image
+    """
+    build = service.get('build')
+    if build is None:
+        return None
+    if isinstance(build, str):
+        build = {'context': build}
+
+    context = os.path.normpath(os.path.join(folder, build.get('context', '.')))
+    return context, build.get('dockerfile', 'Dockerfile'), build.get('args') or {}
+
+
+def ignore_patterns(context):
+    """
+    Patterns of .dockerignore, files docker leaves out of the build context
+    """
+    patterns = ['.git']
+    if os.path.isfile(os.path.join(context, '.dockerignore')):
+        with open(os.path.join(context, '.dockerignore'), 'r') as dockerignore:
+            for line in dockerignore:
+                line = line.strip()
+                if line and not line.startswith('#') and not line.startswith('!'):
+                    patterns.append(line.strip('/'))
+    return patterns
+
+
+def ignored(relativePath, patterns):
+    """
+    Check if a path, or a folder it is in, matches a .dockerignore pattern
+    """
+    parts = relativePath.split('/')
+    for end in range(1, len(parts) + 1):
+        if any(fnmatch.fnmatch('/'.join(parts[:end]), pattern) for pattern in patterns):
+            return True
+    return False
+
+
+def context_hash(context, dockerfile, args):
+    """
+    Hash of every file in a build context, with its path and mode, and the build settings
+    """
+    digest = hashlib.sha256(json.dumps([dockerfile, args], sort_keys=True, default=str).encode())
+    patterns = ignore_patterns(context)
+
+    for root, folders, files in os.walk(context):
+        folders.sort()
+        relativeRoot = os.path.relpath(root, context).replace(os.sep, '/')
+        # Ignored folders are not walked at all
+        folders[:] = [folder for folder in folders
+                      if not ignored(posix_join(relativeRoot, folder), patterns)]
+
+        for filename in sorted(files):
+            relativePath = posix_join(relativeRoot, filename)
+            if ignored(relativePath, patterns) and relativePath != dockerfile:
+                continue
+            path = os.path.join(root, filename)
+            digest.update(relativePath.encode() + b'\0' + str(os.lstat(path).st_mode).encode() + b'\0')
+            if os.path.isfile(path):
+                with open(path, 'rb') as content:
+                    for block in iter(lambda: content.read(1024 * 1024), b''):
+                        digest.update(block)
+
+    return digest.hexdigest()
+
+
+def posix_join(folder, name):
+    return name if folder == '.' else folder + '/' + name
+
+
+def read_cache(folder):
+    try:
+        with open(os.path.join(folder, CACHE_FILE), 'r') as cacheFile:
+            return json.load(cacheFile)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_cache(folder, cache):
+    with open(os.path.join(folder, CACHE_FILE), 'w') as cacheFile:
+        json.dump(cache, cacheFile, indent=2, sort_keys=True)
+
+
+def compose(folder, *args):
+    """
+    Run docker-compose in folder and return its exit code and output
+    """
+    result = subprocess.run(['docker-compose'] + list(args), cwd=folder,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    return result.returncode, result.stdout.decode(errors='replace')
+
+
+def build_service(folder, name):
+    """
+    Build the image of one service and return whether it worked, its time, and its output
+    """
+    start = time.monotonic()
+    returnCode, output = compose(folder, 'build', name)
+    return returnCode == 0, time.monotonic() - start, output
+
+
+def build(composeFile, workers):
+    """
+    Build every service whose build context changed, a few at a time
+    """
+    folder = os.path.dirname(os.path.abspath(composeFile))
+    services = read_services(composeFile)
+    cache = read_cache(folder)
+
+    # Hash every context first, unchanged services aren't built
+    builds = dict()
+    for name in sorted(services):
+        settings = build_settings(services[name], folder)
+        if settings is None:
+            print('  %-24s image only, nothing to build' % (name + ':'))
+            continue
+        hashStart = time.monotonic()
+        contextHash = context_hash(*settings)
+        if cache.get(name) == contextHash:
+            print('  %-24s unchanged, skipped (hashed in %.2fs)' % (name + ':', time.monotonic() - hashStart))
+            continue
+        builds[name] = contextHash
+
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {name: executor.submit(build_service, folder, name) for name in builds}
+        for name, future in futures.items():
+            built, buildTime, output = future.result()
+            if built:
+                cache[name] = builds[name]
+                print('  %-24s built in %.2fs' % (name + ':', buildTime))
+            else:
+                # A failed build is retried on the next run
+                cache.pop(name, None)
+                failed.append(name)
+                print('  %-24s failed after %.2fs' % (name + ':', buildTime))
+                print('\n'.join('    ' + line for line in output.splitlines()[-20:]))
+
+    # Services removed from docker-compose.yml are forgotten
+    write_cache(folder, {name: cache[name] for name in cache if name in services})
+    return not failed
+
+
+def start(composeFile):
+    """
+    Start every service, images missing despite the cache are built by docker-compose
+    """
+    folder = os.path.dirname(os.path.abspath(composeFile))
+    services = read_services(composeFile)
+
+    failed = False
+    for name in sorted(services):
+        startTime = time.monotonic()
+        returnCode, output = compose(folder, 'up', '-d', name)
+        if returnCode == 0:
+            print('  %-24s started in %.2fs' % (name + ':', time.monotonic() - startTime))
+        else:
+            failed = True
+            print('  %-24s failed to start' % (name + ':'))
+            print('\n'.join('    ' + line for line in output.splitlines()[-20:]))
+
+    return not failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build and start the docker challenges')
+    parser.add_argument('action', choices=('build', 'start'))
+    parser.add_argument('--compose', default='OCD/docker_challenges/docker-compose.yml',
+                        help='docker-compose.yml of the challenges')
+    parser.add_argument('--workers', type=int, default=min(4, os.cpu_count() or 1),
+                        help='images built at the same time')
+    args = parser.parse_args()
+
+    if args.action == 'build':
+        done = build(args.compose, args.workers)
+    else:
+        done = start(args.compose)
+
+    sys.exit(0 if done else 1)
+
+
+if __name__ == '__main__':
+    main()
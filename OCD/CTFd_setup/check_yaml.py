@@ -6,24 +6,49 @@ import sys
 import time
 import calendar
 import re
+import json
+import hashlib
 
 import yaml
 import pycountry
 
+import roster
+from roster import read_roster, RosterError
+from placement import STRATEGIES
+from yaml_loader import read_setup, merge_challenge_files, NotConfigured
+
+
+# Patterns are compiled once instead of on every check
+WHITELIST_PATTERN = re.compile(r'^(([a-zA-Z]*\d+\.?)*(\d*[a-zA-Z]+\.?)*)+[^\.]\.[a-zA-Z]+$')
+# Stolen from http://emailregex.com/
+EMAIL_PATTERN = re.compile(r"""(?:[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*|"(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21\x23-\x5b\x5d-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])*")@(?:(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?|\[(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?|[a-z0-9-]*[a-z0-9]:(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21-\x5a\x53-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])+)\])""")
+# Stolen from https://www.regextester.com/93652
+WEBSITE_PATTERN = re.compile(r'^(http:\/\/www\.|https:\/\/www\.|http:\/\/|https:\/\/)?[a-z0-9]+([\-\.]{1}[a-z0-9]+)*\.[a-z]{2,5}(:[0-9]{1,5})?(\/.*)?$')
+HINT_PATTERN = re.compile(r'^hint*')
+# Memory sizes as docker-compose accepts them, e.g. 512m
+MEMORY_PATTERN = re.compile(r'^\d+(\.\d+)?[bkmg]?b?$', re.IGNORECASE)
+
+# Sizes and times as nginx accepts them, e.g. 16k and 1h
+NGINX_SIZE_PATTERN = re.compile(r'^\d+[kmg]?$', re.IGNORECASE)
+NGINX_TIME_PATTERN = re.compile(r'^\d+(ms|s|m|h|d)?$')
+
+# Paths which can go into a location without quoting
+NGINX_PATH_PATTERN = re.compile(r'^/[^\s;{}"\'#]*$')
+
 
 class Error:
     """
-    Global error checker
+    Global error collector
     """
     def __init__(self):
-        self.error = 0
-        self.section = ''
+        self.errors = []
+        self.path = []
 
-    def print_section(self):
+    def add(self, message):
         """
-        Print the error
+        Collect an error under the current YAML path
         """
-        return 'Under ' + self.section + ': '
+        self.errors.append({'path': list(self.path), 'message': message})
 
 
 class Colors:
@@ -39,61 +64,32 @@ def read_setup_yaml(YAMLfile):
     """
     Read setup.yml
     """
-    with open(YAMLfile, 'r') as setup:
-        if setup.read()[:-1] == 'Configure me':
-            print("You need to alter 'setup.yml' before trying to setup CTFd with CTFdeploy")
-            quit(1)
+    try:
+        yamldict = read_setup(YAMLfile)
+    except NotConfigured:
+        print("You need to alter 'setup.yml' before trying to setup CTFd with CTFdeploy")
+        quit(1)
+    except yaml.YAMLError:
+        yamldict = None
+
+    if not isinstance(yamldict, dict):
+        raise Exception('Please format setup.yml correctly')
+    return yamldict
+
+
+def present(keys, key):
+    """
+    Check if key is set to a value, empty values are reported while walking
+    """
+    return key in keys and keys[key] is not None
 
-    with open(YAMLfile, 'r') as setup:
-        try:
-            yamldict = yaml.safe_load(setup)
-            if isinstance(yamldict, dict):
-                return yamldict
-            else:
-                raise yaml.parser.ParserError
-        except yaml.parser.ParserError:
-            raise Exception('Please format setup.yml correctly')
-
-
-def check_error(func):
-    """
-    Check error wrapper - quit if an error was found
-    """
-    def error_quit(*args, **kwargs):
-        func(*args, **kwargs)
-        if error.error == 1:
-            print(Colors().NORMAL, end='')
-            quit(1)
-    return error_quit
-
-
-def check_yaml_none(*args, **kwargs):
-    """
-    Make sure yaml doesn't contain None values
-    """
-    for key in kwargs:
-        if isinstance(kwargs[key], dict):
-            check_yaml_none(*args, key, **kwargs[key])
-        elif isinstance(kwargs[key], list):
-            for item in kwargs[key]:
-                if item is None:
-                    for arg in args:
-                        print(arg, end=', ')
-                    print(key + ': Has an empty value')
-                    error.error = 1
-        elif kwargs[key] is None:
-            for arg in args:
-                print(arg, end=', ')
-            print(key + ': Has an emtpy value')
-            error.error = 1
 
 def check_config_musts(YAMLfile, key):
     """
     Check if key is in YAMLfile
     """
     if key not in YAMLfile:
-        print(error.print_section() + 'missing ' + key)
-        error.error = 1
+        error.add('missing ' + key)
 
 
 def check_if_int(key, value):
@@ -101,12 +97,32 @@ def check_if_int(key, value):
     Check if key is int
     """
     try:
-        int(value)
         if int(value) < 0:
-            raise
-    except:
-        print(error.print_section() + key + ', must be a positive number')
-        error.error = 1
+            raise ValueError
+    except (TypeError, ValueError):
+        error.add(key + ', must be a positive number')
+
+
+def check_if_positive(key, value):
+    """
+    Check if key is an int larger than zero
+    """
+    try:
+        if int(value) < 1:
+            raise ValueError
+    except (TypeError, ValueError):
+        error.add(key + ', must be a number larger than 0')
+
+
+def check_if_number(key, value):
+    """
+    Check if key is a number larger than zero, fractions allowed
+    """
+    try:
+        if isinstance(value, bool) or float(value) <= 0:
+            raise ValueError
+    except (TypeError, ValueError):
+        error.add(key + ', must be a number larger than 0')
 
 
 def check_if_vorv(key, keyvalue, value1, value2):
@@ -115,8 +131,16 @@ def check_if_vorv(key, keyvalue, value1, value2):
     """
     if keyvalue in (value1, value2):
         return
-    print(error.print_section() + key + ', must be either ' + str(value1) + ' or ' + str(value2))
-    error.error = 1
+    error.add(key + ', must be either ' + str(value1) + ' or ' + str(value2))
+
+
+def check_if_one_of(key, keyvalue, values):
+    """
+    Check if keyvalue is one of values and print error
+    """
+    if keyvalue in values:
+        return
+    error.add(key + ', must be one of ' + ', '.join(str(value) for value in values))
 
 
 def check_time(key, timevalue):
@@ -125,61 +149,73 @@ def check_time(key, timevalue):
     """
     try:
         if not calendar.timegm(time.strptime(timevalue, '%d/%m/%Y %H:%M')) >= 0:
-            print(error.print_section() + key + ', must be set to a time later than 01/01/1970 00:00')
-            error.error = 1
-    except ValueError:
-        print(error.print_section() + key + ', is formatted incorrectly')
-        error.error = 1
+            error.add(key + ', must be set to a time later than 01/01/1970 00:00')
+    except (TypeError, ValueError):
+        error.add(key + ', is formatted incorrectly')
 
 
 def check_whitelist(key, domains):
     """
     Check if email domains are formatted correctly
     """
+    if not isinstance(domains, list):
+        error.add(key + ', must be a list of domains')
+        return
+
     for domain in domains:
-        try:
-            if not re.match(re.compile(r'^(([a-zA-Z]*\d+\.?)*(\d*[a-zA-Z]+\.?)*)+[^\.]\.[a-zA-Z]+$'), domain):
-                print(error.print_section() + key + ', is formatted incorrectly, ' + domain)
-                error.error = 1
-        except TypeError:
-            print(error.print_section() + key + ', please check your whitelist members')
-            error.error = 1
+        if domain is None:
+            continue
+        if not isinstance(domain, str):
+            error.add(key + ', please check your whitelist members')
+        elif not WHITELIST_PATTERN.match(domain):
+            error.add(key + ', is formatted incorrectly, ' + domain)
 
 
 def check_email(key, email):
     """
-    Check if email is formatted correctly - stolen from http://emailregex.com/
+    Check if email is formatted correctly
     """
-    if not re.match(re.compile(r"""(?:[a-z0-9!#$%&'*+/=?^_`{|}~-]+(?:\.[a-z0-9!#$%&'*+/=?^_`{|}~-]+)*|"(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21\x23-\x5b\x5d-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])*")@(?:(?:[a-z0-9](?:[a-z0-9-]*[a-z0-9])?\.)+[a-z0-9](?:[a-z0-9-]*[a-z0-9])?|\[(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?|[a-z0-9-]*[a-z0-9]:(?:[\x01-\x08\x0b\x0c\x0e-\x1f\x21-\x5a\x53-\x7f]|\\[\x01-\x09\x0b\x0c\x0e-\x7f])+)\])"""), email):
-        print(error.print_section() + key + ', is formatted incorrectly, ' + email)
-        error.error = 1
+    if not isinstance(email, str) or not EMAIL_PATTERN.match(email):
+        error.add(key + ', is formatted incorrectly, ' + str(email))
 
 
 def check_file(key, folder, keyfile):
     """
     Check if file exists
     """
-    if not os.path.isfile(folder + keyfile):
-        print(error.print_section() + key + ', file does not exist, ' + keyfile)
-        error.error = 1
+    if isinstance(keyfile, str):
+        cache.reference(os.path.dirname(folder + keyfile))
+    if not isinstance(keyfile, str) or not os.path.isfile(folder + keyfile):
+        error.add(key + ', file does not exist, ' + str(keyfile))
+
+
+def check_files(key, folder, keyfiles):
+    """
+    Check if every file in a list exists
+    """
+    if not isinstance(keyfiles, list):
+        error.add(key + ', must be a list of files')
+        return
+
+    for keyfile in keyfiles:
+        if keyfile is not None:
+            check_file(key, folder, keyfile)
 
 
 def check_website(key, website):
     """
-    Check if website is valid format - stolen from https://www.regextester.com/93652
+    Check if website is valid format
     """
-    if not re.match(re.compile(r'^(http:\/\/www\.|https:\/\/www\.|http:\/\/|https:\/\/)?[a-z0-9]+([\-\.]{1}[a-z0-9]+)*\.[a-z]{2,5}(:[0-9]{1,5})?(\/.*)?$'), website):
-        print(error.print_section() + key + ', is formatted incorrectly, ' + website)
-        error.error = 1
+    if not isinstance(website, str) or not WEBSITE_PATTERN.match(website):
+        error.add(key + ', is formatted incorrectly, ' + str(website))
 
 
 def check_countrycode(key, countrycode):
     """
     Check if countrycode is valid
     """
-    if pycountry.countries.get(alpha_2=countrycode) is None:
-        print(error.print_section() + key + ', is formatted incorrectly, ' + countrycode)
-        error.error = 1
+    if not isinstance(countrycode, str) or pycountry.countries.get(alpha_2=countrycode) is None:
+        error.add(key + ', is formatted incorrectly, ' + str(countrycode))
 
 
 def check_challenge(key, requirement, challengesList):
@@ -187,240 +223,584 @@ def check_challenge(key, requirement, challengesList):
     Check if challenge exists
     """
     if requirement not in challengesList:
-        print(error.print_section() + key + ', this challenge is not defined in the setup, ' + requirement)
-        error.error = 1
+        error.add(key + ', this challenge is not defined in the setup, ' + str(requirement))
 
 
-@check_error
-def CTFd_config_check(YAMLfile):
-    check_config_musts(YAMLfile, 'CTFd')
-
-
-@check_error
-def root_config_check(YAMLfile):
+def root_check(configKeys, path):
     """
     Check key configs - config, users, pages, and challenges
     """
-    configKeys = YAMLfile['CTFd']
-
-    # Check if key values exist
     check_config_musts(configKeys, 'config')
-    check_config_musts(configKeys, 'users')
+    if 'users_file' not in configKeys:
+        check_config_musts(configKeys, 'users')
     check_config_musts(configKeys, 'pages')
     check_config_musts(configKeys, 'challenges')
 
 
-def config_check(YAMLfile):
+def config_check(configKeys, path):
     """
     Check keys in config
     """
     # Check if key values exist
-    @check_error
-    def config_key_check():
-        check_config_musts(configKeys, 'name')
-        check_config_musts(configKeys, 'description')
-        check_config_musts(configKeys, 'user_mode')
-        check_config_musts(configKeys, 'start')
-        check_config_musts(configKeys, 'end')
+    check_config_musts(configKeys, 'name')
+    check_config_musts(configKeys, 'description')
+    check_config_musts(configKeys, 'user_mode')
+    check_config_musts(configKeys, 'start')
+    check_config_musts(configKeys, 'end')
 
     # Check if syntax is correct
-    @check_error
-    def syntax_check():
+    if present(configKeys, 'start'):
         check_time('start', configKeys['start'])
+
+    if present(configKeys, 'end'):
         check_time('end', configKeys['end'])
 
+    if present(configKeys, 'user_mode'):
         check_if_vorv('user_mode', configKeys['user_mode'], 'users', 'teams')
 
+    if present(configKeys, 'team_size'):
+        check_if_int('team_size', configKeys['team_size'])
 
-        if 'team_size' in configKeys:
-            check_if_int('team_size', configKeys['team_size'])
+    if present(configKeys, 'name_changes'):
+        check_if_vorv('name_changes', configKeys['name_changes'], 1, 0)
 
-        if 'name_changes' in configKeys:
-            check_if_vorv('name_changes', configKeys['name_changes'], 1, 0)
+    if present(configKeys, 'whitelist'):
+        check_whitelist('whitelist', configKeys['whitelist'])
 
-        if 'whitelist' in configKeys:
-            check_whitelist('whitelist', configKeys['whitelist'])
+    for configFile in ('logo', 'style', 'theme_header', 'theme_footer'):
+        if present(configKeys, configFile):
+            check_file(configFile, 'OCD/config_files/', configKeys[configFile])
 
-        if 'logo' in configKeys:
-            check_file('logo', 'OCD/config_files/', configKeys['logo'])
+    if present(configKeys, 'file'):
+        check_files('file', 'OCD/config_files/', configKeys['file'])
+
+
+def user_check(userKeys, path):
+    """
+    Check keys in a user
+    """
+    # Check if key values exist
+    check_config_musts(userKeys, 'password')
+    check_config_musts(userKeys, 'email')
+    check_config_musts(userKeys, 'type')
 
-        if 'style' in configKeys:
-            check_file('style', 'OCD/config_files/', configKeys['style'])
+    # Check if syntax is correct
+    if present(userKeys, 'email'):
+        check_email('email', userKeys['email'])
 
-        if 'theme_header' in configKeys:
-            check_file('theme_header', 'OCD/config_files/', configKeys['theme_header'])
+    if present(userKeys, 'type'):
+        check_if_vorv('type', userKeys['type'], 'admin', 'user')
 
-        if 'theme_footer' in configKeys:
-            check_file('theme_footer', 'OCD/config_files/', configKeys['theme_footer'])
+    if present(userKeys, 'hidden'):
+        check_if_vorv('hidden', userKeys['hidden'], 1, 0)
 
+    if present(userKeys, 'website'):
+        check_website('website', userKeys['website'])
 
-    configKeys = YAMLfile['CTFd']['config']
-    config_key_check()
-    syntax_check()
+    if present(userKeys, 'country'):
+        check_countrycode('country', userKeys['country'])
 
 
-def users_check(YAMLfile):
+def users_file_check(usersFile, path):
     """
-    Check keys in users
+    Check users in the users_file roster, one chunk at a time
     """
-    # Check if key values exist
-    @check_error
-    def users_key_check(user):
-        check_config_musts(usersKeys[user], 'password')
-        check_config_musts(usersKeys[user], 'email')
-        check_config_musts(usersKeys[user], 'type')
+    # The roster itself is not part of setup.yml, its contents are followed by mtime and size
+    # Followed before it is checked, so a missing roster is checked again once it is created
+    if isinstance(usersFile, str):
+        cache.reference('OCD/config_files/' + usersFile)
 
+    if not isinstance(usersFile, str) or not os.path.isfile('OCD/config_files/' + usersFile):
+        error.add('file does not exist, ' + str(usersFile))
+        return
 
-    # Check if syntax is correct
-    @check_error
-    def syntax_check(user):
-        check_email('email', usersKeys[user]['email'])
-        check_if_vorv('type', usersKeys[user]['type'], 'admin', 'user')
-
-        if 'hidden' in usersKeys[user]:
-            check_if_vorv('hidden', usersKeys[user]['hidden'], 1, 0)
+    # Lines which could not be read, reported as the roster is streamed
+    rosterErrors = []
+    def report_roster_errors():
+        for rosterError in rosterErrors:
+            error.path = path + ['line ' + str(rosterError.line)]
+            error.add(rosterError.message)
+        rosterErrors.clear()
 
-        if 'website' in usersKeys[user]:
-            check_website('website', usersKeys[user]['website'])
+    try:
+        for chunk in read_roster('OCD/config_files/' + usersFile, errors=rosterErrors):
+            report_roster_errors()
 
-        if 'country' in usersKeys[user]:
-            check_countrycode('country', usersKeys[user]['country'])
+            for line, name, userKeys in chunk:
+                error.path = path + ['line ' + str(line)]
+                if not isinstance(name, str) or not name:
+                    error.add('missing name')
+                    continue
 
+                error.path.append(name)
+                user_check(userKeys, error.path)
 
-    # Loop through all users
-    usersKeys = YAMLfile['CTFd']['users']
-    for user in usersKeys:
-        error.section = 'users, ' + user
-        users_key_check(user)
-        syntax_check(user)
+        report_roster_errors()
+    except RosterError as rosterError:
+        error.path = path
+        error.add(rosterError.message)
 
 
-def pages_check(YAMLfile):
+def pages_check(pagesKeys, path):
     """
     Check keys in pages
     """
+    check_config_musts(pagesKeys, 'index')
+
+
+def page_check(pageKeys, path):
+    """
+    Check keys in a page
+    """
     # Check if key values exist
-    @check_error
-    def pages_key_check(page):
-        check_config_musts(pagesKeys[page], 'page')
+    check_config_musts(pageKeys, 'page')
 
     # Check if syntax is correct
-    @check_error
-    def syntax_check(page):
-        if 'file' in pagesKeys[page]:
-            for pagefile in pagesKeys[page]['file']:
-                check_file('file', 'OCD/pages_files/', pagefile)
-        if 'auth_required' in pagesKeys[page]:
-            check_if_vorv('auth_required', pagesKeys[page]['auth_required'], 1, 0)
+    if present(pageKeys, 'page'):
+        check_file('page', 'OCD/pages_files/', pageKeys['page'])
 
+    if present(pageKeys, 'file'):
+        check_files('file', 'OCD/pages_files/', pageKeys['file'])
 
-    # Loop through all pages
-    pagesKeys = YAMLfile['CTFd']['pages']
-    check_config_musts(pagesKeys, 'index')
-    for page in pagesKeys:
-        error.section = 'pages, ' + page
-        pages_key_check(page)
-        syntax_check(page)
+    if present(pageKeys, 'auth_required'):
+        check_if_vorv('auth_required', pageKeys['auth_required'], 1, 0)
 
 
-def challenges_check(YAMLfile):
+def challenge_check(challengeKeys, path):
     """
-    check keys in challenges
+    Check keys in a challenge
     """
     # Check if key values exist
-    @check_error
-    def challenges_key_check(category, challenge):
-        check_config_musts(challengesKeys[category][challenge], 'value')
-        check_config_musts(challengesKeys[category][challenge], 'description')
-        check_config_musts(challengesKeys[category][challenge], 'flag')
+    check_config_musts(challengeKeys, 'value')
+    check_config_musts(challengeKeys, 'description')
+    check_config_musts(challengeKeys, 'flag')
 
     # Check if syntax is correct
-    @check_error
-    def syntax_check(category, challenge):
-        # Check if flag syntax is valid
-        @check_error
-        def flag_check(flag):
-            error.section = 'challenges, ' + category + ', ' + challenge + ', flag'
-            check_config_musts(flag, 'flag')
+    if present(challengeKeys, 'value'):
+        check_if_int('value', challengeKeys['value'])
 
-            if 'type' in flag:
-                check_if_vorv('type', flag['type'], 'static', 'regex')
-            if 'case' in flag:
-                check_if_vorv('type', flag['case'], 'insensitive', 'sensitive')
+    if present(challengeKeys, 'description'):
+        check_file('description', 'OCD/challenge_files/', challengeKeys['description'])
 
-        # Check if hint syntax is valid
-        @check_error
-        def hint_check(hint):
-            error.section = 'challenges, ' + category + ', ' + challenge + ', ' + hint
-            check_config_musts(challengesKeys[category][challenge][hint], 'description')
+    if present(challengeKeys, 'max_attempts'):
+        check_if_int('max_attempts', challengeKeys['max_attempts'])
 
-            if 'description' in challengesKeys[category][challenge][hint]:
-                check_file('description', 'OCD/challenge_files/', challengesKeys[category][challenge][hint]['description'])
-            if 'cost' in challengesKeys[category][challenge][hint]:
-                check_if_int('cost', challengesKeys[category][challenge][hint]['cost'])
+    if present(challengeKeys, 'file'):
+        check_files('file', 'OCD/challenge_files/', challengeKeys['file'])
 
+    # Requirements are checked once every challenge has been seen
+    validation.add_challenge(path[-1])
+    if present(challengeKeys, 'requirements'):
+        if not isinstance(challengeKeys['requirements'], list):
+            error.add('requirements, must be a list of challenges')
+        else:
+            for requirement in challengeKeys['requirements']:
+                validation.add_requirement(list(path), requirement)
 
-        if 'max_attempts' in challengesKeys[category][challenge]:
-            check_if_int('max_attempts', challengesKeys[category][challenge]['max_attempts'])
 
-        if 'file' in challengesKeys[category][challenge]:
-            for challengeFile in challengesKeys[category][challenge]['file']:
-                check_file('file', 'OCD/challenge_files/', challengeFile)
+def flag_check(flagKeys, path):
+    """
+    Check keys in a flag
+    """
+    check_config_musts(flagKeys, 'flag')
+
+    if present(flagKeys, 'type'):
+        check_if_vorv('type', flagKeys['type'], 'static', 'regex')
 
-        if 'requirements' in challengesKeys[category][challenge]:
-            for requirement in challengesKeys[category][challenge]['requirements']:
-                check_challenge('requirements', requirement, challengesList)
+    if present(flagKeys, 'case'):
+        check_if_vorv('case', flagKeys['case'], 'insensitive', 'sensitive')
 
 
-        hintmatches = [hint for hint in challengesKeys[category][challenge] if re.match(re.compile('^hint*'), hint)]
-        for hint in hintmatches:
-            hint_check(hint)
+def hint_check(hintKeys, path):
+    """
+    Check keys in a hint
+    """
+    check_config_musts(hintKeys, 'description')
+
+    if present(hintKeys, 'description'):
+        check_file('description', 'OCD/challenge_files/', hintKeys['description'])
 
-        flag_check(challengesKeys[category][challenge]['flag'])
+    if present(hintKeys, 'cost'):
+        check_if_int('cost', hintKeys['cost'])
 
 
-    challengesKeys = YAMLfile['CTFd']['challenges']
+def deploy_check(deployKeys, path):
+    """
+    Check keys in deploy
+    """
+    if present(deployKeys, 'bulk_insert'):
+        check_if_vorv('bulk_insert', deployKeys['bulk_insert'], 1, 0)
 
-    # Get a list of all challenges
-    challengesList = []
-    for challenges in [challengesKeys[challenge] for challenge in [category for category in challengesKeys]]:
-        for name in challenges.keys():
-            challengesList.append(name)
+    if present(deployKeys, 'batch_size'):
+        check_if_positive('batch_size', deployKeys['batch_size'])
 
-    # Loop through all the challenges
-    for category in challengesKeys:
-        for challenge in challengesKeys[category]:
-            error.section = 'challenges, ' + category + ', ' + challenge
-            challenges_key_check(category, challenge)
-            syntax_check(category, challenge)
+    if present(deployKeys, 'hash_workers'):
+        check_if_int('hash_workers', deployKeys['hash_workers'])
 
+    if present(deployKeys, 'upload_workers'):
+        check_if_positive('upload_workers', deployKeys['upload_workers'])
 
-# Global error tracker
-error = Error()
+    if present(deployKeys, 'incremental'):
+        check_if_vorv('incremental', deployKeys['incremental'], 1, 0)
 
-def main():
-    print(Colors().FAIL, end='')
-    YAMLfile = read_setup_yaml(sys.argv[1])
+    if present(deployKeys, 'profile'):
+        check_if_vorv('profile', deployKeys['profile'], 1, 0)
 
-    check_yaml_none(**YAMLfile)
+    if present(deployKeys, 'placement'):
+        check_if_one_of('placement', deployKeys['placement'], ('auto',) + tuple(STRATEGIES))
 
-    error.section = 'Base'
-    CTFd_config_check(YAMLfile)
+    if present(deployKeys, 'compress'):
+        check_if_one_of('compress', deployKeys['compress'], ('none', 'gzip'))
 
-    error.section = 'CTFd'
-    root_config_check(YAMLfile)
 
-    error.section = 'config'
-    config_check(YAMLfile)
+def monitor_check(monitorKeys, path):
+    """
+    Check keys in monitor
+    """
+    for key in ('interval', 'inspect_interval', 'max_backoff'):
+        if present(monitorKeys, key):
+            check_if_number(key, monitorKeys[key])
 
-    error.section = 'users'
-    users_check(YAMLfile)
+    if present(monitorKeys, 'output') and not isinstance(monitorKeys['output'], str):
+        error.add('output, must be a filename')
 
-    error.section = 'pages'
-    pages_check(YAMLfile)
 
-    error.section = 'challenges'
-    challenges_check(YAMLfile)
+def nginx_check(nginxKeys, path):
+    """
+    Check keys in nginx
+    """
+    if present(nginxKeys, 'worker_processes') and nginxKeys['worker_processes'] != 'auto':
+        check_if_positive('worker_processes', nginxKeys['worker_processes'])
+
+    for key in ('worker_connections', 'keepalive_timeout'):
+        if present(nginxKeys, key):
+            check_if_positive(key, nginxKeys[key])
+
+    for key in ('keepalive', 'cache'):
+        if present(nginxKeys, key):
+            check_if_int(key, nginxKeys[key])
+
+    for key in ('buffer_size', 'client_max_body_size', 'cache_size', 'ssl_session_cache'):
+        if present(nginxKeys, key) and not NGINX_SIZE_PATTERN.match(str(nginxKeys[key])):
+            error.add(key + ', must be a size like 16k or 4G, ' + str(nginxKeys[key]))
+
+    if present(nginxKeys, 'ssl_session_timeout') and not NGINX_TIME_PATTERN.match(str(nginxKeys['ssl_session_timeout'])):
+        error.add('ssl_session_timeout, must be a time like 1h, ' + str(nginxKeys['ssl_session_timeout']))
+
+    if present(nginxKeys, 'cache_paths'):
+        cachePaths = nginxKeys['cache_paths']
+        if not isinstance(cachePaths, list):
+            error.add('cache_paths, must be a list of paths')
+        else:
+            for cachePath in cachePaths:
+                if not isinstance(cachePath, str) or not NGINX_PATH_PATTERN.match(cachePath):
+                    error.add('cache_paths, must start with / and hold no spaces, quotes, or ;{}#, ' + str(cachePath))
+            if len(set(map(str, cachePaths))) != len(cachePaths):
+                error.add('cache_paths, each path can only be listed once')
+
+
+def limit_check(limitKeys, path):
+    """
+    Check the resource limits of a docker challenge
+    """
+    if present(limitKeys, 'memory'):
+        memory = limitKeys['memory']
+        if isinstance(memory, bool) or not (isinstance(memory, int) and memory > 0 or
+                                            isinstance(memory, str) and MEMORY_PATTERN.match(memory)):
+            error.add('memory, must be bytes or a size like 512m, ' + str(memory))
+
+    if present(limitKeys, 'cpus'):
+        check_if_number('cpus', limitKeys['cpus'])
+
+    if present(limitKeys, 'pids'):
+        check_if_positive('pids', limitKeys['pids'])
+
+
+class Validation:
+    """
+    State shared between checks during one walk of setup.yml
+    """
+    def __init__(self):
+        self.challenges = set()
+        self.requirements = []
+        # What the subtree being cached added, so a cache hit can add it again
+        self.added = {'challenges': [], 'requirements': []}
+
+    def add_challenge(self, name):
+        self.challenges.add(name)
+        self.added['challenges'].append(name)
+
+    def add_requirement(self, path, requirement):
+        self.requirements.append((path, requirement))
+        self.added['requirements'].append((path, requirement))
+
+
+class Cache:
+    """
+    Validation results per subtree of setup.yml, kept between runs
+
+    A subtree is keyed by a hash of its path and contents. Checks only look at whether
+    files exist, so instead of every referenced file the cache follows the mtime of the
+    folders they are in, which changes whenever a file in it is added, removed or renamed
+    """
+    def __init__(self):
+        self.filename = None
+        self.version = None
+        self.entries = {}
+        self.used = {}
+        self.stats = {}
+        self.referenced = None
+        self.hits = 0
+        self.misses = 0
+
+    def load(self, filename):
+        """
+        Load the cache, which is thrown away when check_yaml.py or roster.py change
+        """
+        self.filename = filename
+        versionHash = hashlib.sha256()
+        for module in (__file__, roster.__file__):
+            with open(module, 'rb') as source:
+                versionHash.update(source.read())
+        self.version = versionHash.hexdigest()
+
+        try:
+            with open(filename, 'r') as cacheFile:
+                cached = json.load(cacheFile)
+            if cached.get('version') == self.version:
+                self.entries = cached['entries']
+        except (OSError, ValueError, KeyError, AttributeError):
+            self.entries = {}
+
+    def save(self):
+        """
+        Write the entries used in this run, entries of removed subtrees are dropped
+        """
+        if self.filename is None or (self.misses == 0 and len(self.used) == len(self.entries)):
+            return
+
+        try:
+            temporary = self.filename + '.tmp'
+            with open(temporary, 'w') as cacheFile:
+                json.dump({'version': self.version, 'entries': self.used}, cacheFile)
+            os.replace(temporary, self.filename)
+        except OSError:
+            # A read-only checkout only loses the cache
+            pass
+
+    def stat(self, filename):
+        """
+        mtime and size of filename, or None if it doesn't exist, once per run
+        """
+        if filename not in self.stats:
+            try:
+                fileStat = os.stat(filename)
+                self.stats[filename] = [fileStat.st_mtime_ns, fileStat.st_size]
+            except OSError:
+                self.stats[filename] = None
+        return self.stats[filename]
+
+    def reference(self, filename):
+        """
+        Follow filename for the subtree being checked
+        """
+        if self.referenced is not None:
+            self.referenced.add(filename)
+
+    def key(self, node, path):
+        return hashlib.sha256(repr((path, node)).encode()).hexdigest()
+
+    def lookup(self, key):
+        """
+        Return the entry of key if none of the files it followed changed
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+
+        for filename, fileStat in entry['stats'].items():
+            if self.stat(filename) != fileStat:
+                return None
+
+        return entry
+
+    def store(self, key, entry):
+        self.used[key] = entry
+
+
+# Checks for the nodes of setup.yml, by path - '*' is any key and patterns match keys
+# The type is what the node must be, users_file is a filename rather than a dictionary
+# Nodes in CACHED are validated as a whole and their results are cached between runs
+CACHED = [
+    ('CTFd', 'config'),
+    ('CTFd', 'users', '*'),
+    ('CTFd', 'users_file'),
+    ('CTFd', 'pages', '*'),
+    ('CTFd', 'challenges', '*', '*'),
+]
+
+RULES = [
+    (('CTFd',), root_check, dict),
+    (('CTFd', 'config'), config_check, dict),
+    (('CTFd', 'users'), None, dict),
+    (('CTFd', 'users', '*'), user_check, dict),
+    (('CTFd', 'users_file'), users_file_check, str),
+    (('CTFd', 'pages'), pages_check, dict),
+    (('CTFd', 'pages', '*'), page_check, dict),
+    (('CTFd', 'challenges'), None, dict),
+    (('CTFd', 'challenges', '*'), None, dict),
+    (('CTFd', 'challenges', '*', '*'), challenge_check, dict),
+    (('CTFd', 'challenges', '*', '*', 'flag'), flag_check, dict),
+    (('CTFd', 'challenges', '*', '*', HINT_PATTERN), hint_check, dict),
+    (('CTFd', 'deploy'), deploy_check, dict),
+    (('CTFd', 'monitor'), monitor_check, dict),
+    (('CTFd', 'monitor', 'limits'), None, dict),
+    (('CTFd', 'monitor', 'limits', '*'), limit_check, dict),
+    (('CTFd', 'nginx'), nginx_check, dict),
+]
+
+
+def rule_matches(pattern, path):
+    """
+    Check if a rule pattern matches a YAML path
+    """
+    if len(pattern) != len(path):
+        return False
+
+    for part, key in zip(pattern, path):
+        if part == '*':
+            continue
+        if isinstance(part, str):
+            if part != key:
+                return False
+        elif not isinstance(key, str) or not part.match(key):
+            return False
+
+    return True
+
+
+def walk(node, path):
+    """
+    Visit every node of setup.yml once, cached subtrees are only visited when they changed
+    """
+    if not any(rule_matches(pattern, path) for pattern in CACHED):
+        check_node(node, path)
+        return
+
+    key = cache.key(node, path)
+    entry = cache.lookup(key)
+    if entry is not None:
+        cache.hits += 1
+        error.errors.extend(entry['errors'])
+        for name in entry['challenges']:
+            validation.add_challenge(name)
+        for requirementPath, requirement in entry['requirements']:
+            validation.add_requirement(requirementPath, requirement)
+        cache.store(key, entry)
+        return
+
+    # Record everything the subtree adds while it is checked
+    cache.misses += 1
+    errorCount = len(error.errors)
+    validation.added = {'challenges': [], 'requirements': []}
+    cache.referenced = set()
+
+    check_node(node, path)
+
+    cache.store(key, {
+        'errors': error.errors[errorCount:],
+        'challenges': validation.added['challenges'],
+        'requirements': validation.added['requirements'],
+        'stats': {filename: cache.stat(filename) for filename in cache.referenced},
+    })
+    cache.referenced = None
+
+
+def check_node(node, path):
+    """
+    Report empty values, run the checks of the node and walk its children
+    """
+    error.path = path
+    if node is None:
+        error.add('has an empty value')
+        return
+
+    for pattern, check, nodeType in RULES:
+        if rule_matches(pattern, path):
+            if not isinstance(node, nodeType):
+                error.add('must be a ' + ('dictionary' if nodeType is dict else 'filename'))
+                return
+            if check is not None:
+                check(node, path)
+                error.path = path
+
+    if isinstance(node, dict):
+        for key in node:
+            walk(node[key], path + [str(key)])
+    elif isinstance(node, list):
+        for index, item in enumerate(node):
+            if item is None:
+                error.path = path
+                error.add('list member ' + str(index + 1) + ' has an empty value')
+
+
+def validate(YAMLfile, mergeErrors=()):
+    """
+    Validate setup.yml in one walk and return every error found with its YAML path
+    mergeErrors are the challenge.yml files which could not be merged into setup.yml
+    """
+    error.errors = []
+    error.path = []
+    validation.challenges = set()
+    validation.requirements = []
+
+    for path, message in mergeErrors:
+        error.path = path
+        error.add(message)
+
+    if 'CTFd' not in YAMLfile:
+        error.add('missing CTFd')
+        return error.errors
+
+    walk(YAMLfile['CTFd'], ['CTFd'])
+
+    # Check requirements now every challenge name is known
+    for path, requirement in validation.requirements:
+        error.path = path
+        check_challenge('requirements', requirement, validation.challenges)
+
+    return error.errors
+
+
+# Global error collector
+error = Error()
+
+# Global state of the current validation
+validation = Validation()
+
+# Global cache of validation results
+cache = Cache()
+
+def main():
+    YAMLfile = read_setup_yaml(sys.argv[1])
+    mergeErrors = merge_challenge_files(YAMLfile, 'OCD/challenge_files')
+
+    # The cache lives next to setup.yml, --no-cache validates everything
+    if '--no-cache' not in sys.argv[2:]:
+        cache.load(os.path.join(os.path.dirname(sys.argv[1]), '.check_cache.json'))
+
+    errors = validate(YAMLfile, mergeErrors)
+    cache.save()
+    if cache.filename is not None:
+        print('Validation cache: ' + str(cache.hits) + ' hits, ' + str(cache.misses) + ' misses')
+
+    if errors:
+        print(Colors().FAIL, end='')
+        for pathError in errors:
+            print('Under ' + '.'.join(pathError['path']) + ': ' + pathError['message'])
+        print(str(len(errors)) + ' errors found in setup.yml')
+        print(Colors().NORMAL, end='')
+        quit(1)
 
     print(Colors().SUCCES, end='')
     print('setup.yml seems good')
@@ -0,0 +1,188 @@
+"""
+Compiles setup.yml into a SQL dump and a prepared uploads folder, without a running database
+The stages of OCD.py run against an in-memory SQLite database, whose rows are written as MySQL
+The tables of CTFd are made by its migrations, load into a migrated database with:
+docker-compose exec -T db mysql -uroot -pctfd ctfd < setup.sql
+"""
+import os
+import sys
+import time
+import argparse
+import datetime
+
+from sqlalchemy import create_engine, select
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
+
+import OCD
+from db import Base, Fingerprints
+from benchmark import sqlite_types
+
+
+# Strings are quoted the standard way, so backslashes in them are kept as they are
+HEADER = """-- setup.yml compiled by compile_setup.py, load into a database migrated by CTFd with: mysql -uroot -pctfd ctfd < setup.sql
+SET NAMES utf8mb4;
+SET SESSION sql_mode = 'STRICT_ALL_TABLES,NO_BACKSLASH_ESCAPES,NO_AUTO_VALUE_ON_ZERO';
+"""
+
+
+class NoSecretKey(Exception):
+    """
+    No secret key to fingerprint the users of the dump with
+    """
+
+
+def compile_rows(setupFile, uploadFolder):
+    """
+    Run the stages of OCD.py against an in-memory database and place the uploads in uploadFolder
+    Returns the engine of the database, raises NoSecretKey without the secret key CTFd will run with
+    """
+    # Fingerprints made with another key make the first incremental deploy rehash every user
+    if OCD.secret_key() is None:
+        raise NoSecretKey('No SECRET_KEY or .ctfd_secret_key to compile with')
+
+    sqlite_types()
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+
+    OCD.UPLOAD_FOLDER = uploadFolder
+    OCD.instrument.attach(engine)
+
+    with OCD.instrument.stage('read_setup_yaml'):
+        setupYAML = OCD.read_setup_yaml(setupFile)
+    if 'deploy' in setupYAML:
+        OCD.settings.load(setupYAML['deploy'])
+    OCD.uploads.prefetch(OCD.setup_files(setupYAML))
+
+    fingerprints = OCD.full_setup(session, setupYAML)
+    with OCD.instrument.stage('save_fingerprints'):
+        OCD.save_fingerprints(session, fingerprints)
+    with OCD.instrument.stage('uploads'):
+        OCD.uploads.wait()
+    session.commit()
+    session.close()
+
+    return engine
+
+
+def sql_literal(value):
+    """
+    MySQL literal of a column value, for a session with NO_BACKSLASH_ESCAPES
+    """
+    if value is None:
+        return 'NULL'
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, (int, float)):
+        return repr(value)
+    if isinstance(value, datetime.datetime):
+        value = value.isoformat(' ')
+    if isinstance(value, bytes):
+        return "X'" + value.hex() + "'"
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def table_inserts(engine, table, batchSize):
+    """
+    Multi-row INSERTs of every row of table ordered by id, with values as MySQL would bind them
+    """
+    dialect = mysql.dialect()
+    processors = [column.type.dialect_impl(dialect).bind_processor(dialect) for column in table.columns]
+    columns = ', '.join('`' + column.name + '`' for column in table.columns)
+
+    with engine.connect() as connection:
+        rows = connection.execute(select([table]).order_by(*table.primary_key.columns)).fetchall()
+
+    values = []
+    for row in rows:
+        literals = []
+        for processor, value in zip(processors, row):
+            if processor is not None and value is not None:
+                value = processor(value)
+            literals.append(sql_literal(value))
+        values.append('(' + ', '.join(literals) + ')')
+
+    statements = []
+    for start in range(0, len(values), batchSize):
+        statements.append('INSERT INTO `' + table.name + '` (' + columns + ') VALUES\n' +
+                          ',\n'.join(values[start:start + batchSize]) + ';\n')
+    return statements, len(rows)
+
+
+def write_dump(engine, filename, batchSize):
+    """
+    Write the rows of the tables of db.py as a SQL script, the same rows always give the same script
+    Only ocd_fingerprints is created, every other table is left to the migrations of CTFd
+    Password hashes are salted, so two compiles of one setup.yml differ in users.password
+    Returns the rows written per table
+    """
+    counts = dict()
+    temporary = filename + '.tmp'
+    with open(temporary, 'w', encoding='utf-8') as dump:
+        dump.write(HEADER)
+
+        # The one table of OCD.py itself, as create_all makes it in OCD.py, DDL commits on its own in MySQL
+        create = str(CreateTable(Fingerprints.__table__).compile(dialect=mysql.dialect())).strip()
+        dump.write('\n' + create.replace('CREATE TABLE ', 'CREATE TABLE IF NOT EXISTS ', 1) + ';\n')
+
+        dump.write('\nSTART TRANSACTION;\n')
+        for table in Base.metadata.sorted_tables:
+            statements, counts[table.name] = table_inserts(engine, table, batchSize)
+            for statement in statements:
+                dump.write('\n' + statement)
+        dump.write('\nCOMMIT;\n')
+
+    os.replace(temporary, filename)
+    return counts
+
+
+def dump_statements(filename):
+    """
+    The statements of a dump written by write_dump, for loading it without the mysql client
+    """
+    with open(filename, 'r', encoding='utf-8') as dump:
+        content = dump.read()
+
+    statements = []
+    statement = ''
+    quoted = False
+    for character in content:
+        statement += character
+        if character == "'":
+            # A doubled quote inside a string closes and opens it again
+            quoted = not quoted
+        elif character == ';' and not quoted:
+            statements.append('\n'.join(line for line in statement.strip().splitlines()
+                                        if not line.startswith('--')))
+            statement = ''
+    return statements
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compile setup.yml into a SQL dump and an uploads folder')
+    parser.add_argument('--setup', default='OCD/setup.yml', help='setup.yml to compile')
+    parser.add_argument('--output', default='setup.sql', help='SQL dump to write')
+    parser.add_argument('--uploads', default=OCD.UPLOAD_FOLDER, help='uploads folder to fill')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    try:
+        engine = compile_rows(args.setup, args.uploads)
+    except NoSecretKey as secretError:
+        print(str(secretError) + ', CTFd has to run with the key the users are fingerprinted with')
+        sys.exit(1)
+    counts = write_dump(engine, args.output, OCD.settings.batch_size)
+    OCD.uploads.report()
+
+    print('Compiled %d rows into %s in %.2fs, %.1f kB' % (
+        sum(counts.values()), args.output, time.monotonic() - start, os.path.getsize(args.output) / 1e3))
+    for table in counts:
+        if counts[table]:
+            print('  %-18s %d rows' % (table + ':', counts[table]))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
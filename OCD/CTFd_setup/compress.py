@@ -0,0 +1,92 @@
+"""
+Writes precompressed .gz siblings of text assets for nginx gzip_static
+Used by OCD.py for uploads and by start.sh for the CTFd themes
+"""
+import os
+import sys
+import gzip
+import argparse
+
+
+# Extensions worth compressing, images and archives are compressed already
+COMPRESSIBLE = ('.css', '.js', '.mjs', '.map', '.json', '.html', '.htm', '.xml', '.svg', '.txt',
+                '.md', '.csv', '.ttf', '.otf', '.eot', '.wasm', '.ico', '.py', '.c', '.h', '.sh')
+
+# Smaller files gain nothing from a sibling
+MIN_SIZE = 256
+
+# A sibling is only kept when it saves at least this share of the size
+MIN_SAVING = 0.1
+
+
+def compressible(filename):
+    return filename.lower().endswith(COMPRESSIBLE) and os.path.getsize(filename) >= MIN_SIZE
+
+
+def up_to_date(filename, sibling):
+    return os.path.isfile(sibling) and os.path.getmtime(sibling) >= os.path.getmtime(filename)
+
+
+def write_sibling(filename, sibling, compressor):
+    """
+    Compress filename into sibling through a temporary file, return the bytes saved
+    """
+    temporary = sibling + '.tmp'
+    with open(filename, 'rb') as source, open(temporary, 'wb') as target:
+        compressor(source, target)
+
+    size = os.path.getsize(filename)
+    saved = size - os.path.getsize(temporary)
+    if saved < size * MIN_SAVING:
+        os.remove(temporary)
+        return 0
+
+    os.replace(temporary, sibling)
+    return saved
+
+
+def gzip_file(source, target):
+    # No name or time in the header, so the same content gives the same .gz
+    with gzip.GzipFile(filename='', mode='wb', fileobj=target, compresslevel=9, mtime=0) as compressed:
+        for block in iter(lambda: source.read(1024 * 1024), b''):
+            compressed.write(block)
+
+
+def compress_file(filename, method='gzip'):
+    """
+    Write the .gz sibling of a compressible file, method is gzip or none, return the bytes saved
+    """
+    if method != 'gzip' or not compressible(filename) or up_to_date(filename, filename + '.gz'):
+        return 0
+
+    return write_sibling(filename, filename + '.gz', gzip_file)
+
+
+def compress_folder(folder, method='gzip'):
+    """
+    Write the siblings of every compressible file in folder, return files and bytes saved
+    """
+    files = saved = 0
+    for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+            fileSaved = compress_file(os.path.join(root, filename), method)
+            if fileSaved:
+                files += 1
+                saved += fileSaved
+    return files, saved
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Write .gz siblings of text assets')
+    parser.add_argument('folders', nargs='+', help='folders to compress, e.g. CTFd/CTFd/themes')
+    args = parser.parse_args()
+
+    for folder in args.folders:
+        files, saved = compress_folder(folder)
+        print('Compressed %d files in %s, %.1f MB saved' % (files, folder, saved / 1e6))
+
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
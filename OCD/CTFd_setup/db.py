@@ -9,6 +9,7 @@ from CTFd.utils.crypto import hash_password
 
 Base = declarative_base()
 
+
 class Config(Base):
     """
     Config
@@ -48,7 +49,8 @@ class Users(Base):
 
     def __init__(self, name, **kwargs):
         self.name = name
-        self.password = hash_password(kwargs['password'])
+        # Password can be hashed beforehand, see hash_passwords in OCD.py
+        self.password = kwargs['password_hash'] if 'password_hash' in kwargs else hash_password(kwargs['password'])
         self.email = kwargs['email']
         self.TYPE = kwargs['type']
 
@@ -187,3 +189,20 @@ class Tags(Base):
     def __init__(self, challenge_id, value):
         self.challenge_id = challenge_id
         self.value = value
+
+
+class Fingerprints(Base):
+    """
+    Fingerprints of what OCD.py deployed, used by incremental deploys
+    """
+    __tablename__ = "ocd_fingerprints"
+
+    ID = Column('id', INTEGER(11), primary_key=True, nullable=False)
+    kind = Column('kind', VARCHAR(32))
+    name = Column('name', VARCHAR(255))
+    digest = Column('digest', VARCHAR(64))
+
+    def __init__(self, kind, name, digest):
+        self.kind = kind
+        self.name = name
+        self.digest = digest
@@ -0,0 +1,135 @@
+"""
+Timing of OCD.py stages, SQL statements, and uploads, with optional cProfile
+Used by OCD.py for the report at the end of the container log and by benchmark.py
+"""
+import time
+import json
+import pstats
+import cProfile
+import resource
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+
+def peak_memory():
+    """
+    Peak resident memory in KB of this process and of its finished children, e.g. hash workers
+    Peaks since the process started, a stage only shows in how much it raised them
+    """
+    return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+
+class Instrument:
+    """
+    Collects stage timings, SQL statement counts and times, and counters
+    """
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.stages = []
+        self.depth = 0
+        self.queries = 0
+        self.queryTime = 0.0
+        self.statements = dict()
+        self.counters = dict()
+        self.profiler = None
+
+    def attach(self, engine):
+        """
+        Count and time every statement sent through engine
+        """
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+
+    def before_execute(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('ocd_query_start', []).append(time.perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.queries += 1
+        self.queryTime += time.perf_counter() - conn.info['ocd_query_start'].pop()
+        # Kind of statement, e.g. INSERT or SELECT
+        kind = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else 'OTHER'
+        self.statements[kind] = self.statements.get(kind, 0) + 1
+
+    def count(self, name, amount=1):
+        """
+        Add to a counter, e.g. bytes hashed
+        """
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a stage, stages can be nested, e.g. password hashing inside users_setup
+        """
+        # Added when it starts, so stages are listed in the order they ran
+        stage = {'stage': name, 'depth': self.depth}
+        self.stages.append(stage)
+
+        queries = self.queries
+        queryTime = self.queryTime
+        selfStart, childStart = peak_memory()
+        stageStart = time.perf_counter()
+        self.depth += 1
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            selfMemory, childMemory = peak_memory()
+            stage.update({
+                'seconds': round(time.perf_counter() - stageStart, 6),
+                'queries': self.queries - queries,
+                'query_seconds': round(self.queryTime - queryTime, 6),
+                # A stage which stays below an earlier peak raises it by 0
+                'peak_rss_growth_kb': selfMemory - selfStart,
+                'children_peak_rss_growth_kb': childMemory - childStart,
+                'process_peak_rss_kb': selfMemory,
+                'children_process_peak_rss_kb': childMemory,
+            })
+
+    def start_profile(self):
+        if self.profiler is None:
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def stop_profile(self, filename):
+        """
+        Stop profiling and dump the statistics, readable with pstats or snakeviz
+        """
+        if self.profiler is None:
+            return None
+
+        self.profiler.disable()
+        self.profiler.dump_stats(filename)
+        return pstats.Stats(self.profiler)
+
+    def report(self, **extra):
+        """
+        Machine readable report of the run
+        """
+        report = {
+            'seconds': round(time.perf_counter() - self.start, 6),
+            'queries': self.queries,
+            'query_seconds': round(self.queryTime, 6),
+            'statements': self.statements,
+            'counters': self.counters,
+            'stages': self.stages,
+        }
+        report.update(extra)
+        return report
+
+    def write(self, filename, **extra):
+        with open(filename, 'w') as reportFile:
+            json.dump(self.report(**extra), reportFile, indent=2)
+
+    def summary(self):
+        """
+        Print a short summary of every stage
+        """
+        for stage in self.stages:
+            print('  %-24s %8.3fs %7d queries %8.3fs in SQL %+9d KB peak' %
+                  ('  ' * stage['depth'] + stage['stage'] + ':', stage['seconds'],
+                   stage['queries'], stage['query_seconds'], stage['peak_rss_growth_kb']))
+        print('  %-24s %8.3fs %7d queries %8.3fs in SQL %9d KB peak' %
+              ('total:', time.perf_counter() - self.start, self.queries, self.queryTime, peak_memory()[0]))
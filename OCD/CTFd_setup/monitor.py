@@ -0,0 +1,437 @@
+"""
+Monitors the docker challenges in OCD/docker_challenges, used by start.sh
+Samples CPU, memory, and pids straight from the cgroup files of every container,
+keeps the limits from setup.yml or docker-compose.yml applied, restarts containers
+which stopped or are unhealthy with backoff, and writes a JSON Lines time series
+"""
+import os
+import sys
+import json
+import time
+import signal
+import argparse
+import subprocess
+
+from yaml_loader import load_yaml, read_setup, NotConfigured
+
+
+# Memory units accepted in limits, as docker-compose accepts them
+SIZE_UNITS = {'b': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+# cgroup v1 reports no memory limit as a huge number
+NO_LIMIT = 2 ** 62
+
+# The kernel stores memory limits rounded down to whole pages
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+class Settings:
+    """
+    Monitor settings - can be overridden in the monitor section of setup.yml
+    """
+    def __init__(self):
+        self.interval = 5
+        self.inspect_interval = 30
+        self.max_backoff = 300
+        self.output = 'OCD/docker_challenges/monitor.jsonl'
+        self.limits = dict()
+
+    def load(self, setupMonitor):
+        """
+        Override the defaults with the monitor section
+        """
+        for key in setupMonitor:
+            if hasattr(self, key):
+                setattr(self, key, setupMonitor[key])
+
+
+def parse_size(value):
+    """
+    Bytes of a memory size such as 512m or 1g
+    """
+    if isinstance(value, int):
+        return value
+    value = str(value).strip().lower().rstrip('b') or '0'
+    if value[-1] in SIZE_UNITS:
+        return int(float(value[:-1]) * SIZE_UNITS[value[-1]])
+    return int(value)
+
+
+def page_rounded(size):
+    """
+    Bytes of a memory limit as its cgroup reports it
+    """
+    return size - size % PAGE_SIZE
+
+
+def compose_limits(service):
+    """
+    Limits of a docker-compose.yml service, from mem_limit, cpus, pids_limit or deploy
+    """
+    limits = dict()
+    deployLimits = ((service.get('deploy') or {}).get('resources') or {}).get('limits') or {}
+
+    for key, composeKeys in (('memory', ('mem_limit', 'memory')),
+                             ('cpus', ('cpus',)),
+                             ('pids', ('pids_limit', 'pids'))):
+        for composeKey in composeKeys:
+            if composeKey in service:
+                limits[key] = service[composeKey]
+            elif composeKey in deployLimits:
+                limits[key] = deployLimits[composeKey]
+
+    return limits
+
+
+def read_limits(services, settings):
+    """
+    Limits of every service, setup.yml overrides docker-compose.yml
+    """
+    limits = dict()
+    for name in services:
+        limits[name] = compose_limits(services[name])
+        limits[name].update(settings.limits.get(name) or {})
+        if 'memory' in limits[name]:
+            limits[name]['memory'] = parse_size(limits[name]['memory'])
+    return limits
+
+
+def docker(*args):
+    """
+    Run docker and return its output, empty if it failed
+    """
+    result = subprocess.run(['docker'] + list(args), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return result.stdout.decode() if result.returncode == 0 else ''
+
+
+def discover(folder):
+    """
+    Inspect the containers of the docker-compose project in folder
+    """
+    result = subprocess.run(['docker-compose', 'ps', '-q'], cwd=folder,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    containerIDs = result.stdout.decode().split()
+    if not containerIDs:
+        return []
+
+    containers = []
+    for inspect in json.loads(docker('inspect', *containerIDs) or '[]'):
+        state = inspect['State']
+        containers.append({
+            'id': inspect['Id'],
+            'service': inspect['Config']['Labels'].get('com.docker.compose.service', inspect['Name'].lstrip('/')),
+            'pid': state.get('Pid', 0),
+            'running': state.get('Running', False),
+            'health': (state.get('Health') or {}).get('Status'),
+        })
+    return containers
+
+
+def cgroup_mounts():
+    """
+    Mount point of every cgroup v1 controller, and of cgroup v2 under ''
+    """
+    mounts = dict()
+    with open('/proc/self/mountinfo', 'r') as mountinfo:
+        for line in mountinfo:
+            fields = line.split()
+            separator = fields.index('-')
+            fileSystem, superOptions = fields[separator + 1], fields[separator + 3]
+            if fileSystem == 'cgroup2':
+                mounts.setdefault('', fields[4])
+            elif fileSystem == 'cgroup':
+                for option in superOptions.split(','):
+                    mounts[option] = fields[4]
+    return mounts
+
+
+class Cgroup:
+    """
+    Open cgroup files of one process, read again on every sample without reopening
+    """
+    def __init__(self, pid, mounts):
+        self.files = dict()
+        paths = dict()
+        with open('/proc/' + str(pid) + '/cgroup', 'r') as cgroups:
+            for line in cgroups:
+                _, controllers, path = line.rstrip('\n').split(':', 2)
+                for controller in controllers.split(','):
+                    paths[controller] = path
+
+        # cgroup v1 when its memory controller is mounted, else the unified hierarchy
+        if 'memory' in mounts and 'memory' in paths:
+            self.version = 1
+            self.open('cpu', mounts.get('cpuacct'), paths.get('cpuacct'), 'cpuacct.usage')
+            self.open('memory', mounts['memory'], paths['memory'], 'memory.usage_in_bytes')
+            self.open('memory_limit', mounts['memory'], paths['memory'], 'memory.limit_in_bytes')
+            self.open('oom', mounts['memory'], paths['memory'], 'memory.oom_control')
+            self.open('pids', mounts.get('pids'), paths.get('pids'), 'pids.current')
+        else:
+            self.version = 2
+            folder = paths.get('')
+            self.open('cpu', mounts.get(''), folder, 'cpu.stat')
+            self.open('memory', mounts.get(''), folder, 'memory.current')
+            self.open('memory_limit', mounts.get(''), folder, 'memory.max')
+            self.open('oom', mounts.get(''), folder, 'memory.events')
+            self.open('pids', mounts.get(''), folder, 'pids.current')
+
+    def open(self, name, mount, path, filename):
+        if mount is None or path is None:
+            return
+        try:
+            self.files[name] = os.open(os.path.join(mount, path.lstrip('/'), filename), os.O_RDONLY)
+        except OSError:
+            pass
+
+    def read(self, name):
+        if name not in self.files:
+            return None
+        return os.pread(self.files[name], 4096, 0).decode()
+
+    def keyed(self, name, key):
+        """
+        Value of a key in a file of "key value" lines, e.g. cpu.stat
+        """
+        content = self.read(name)
+        for line in (content or '').splitlines():
+            fields = line.split()
+            if len(fields) == 2 and fields[0] == key:
+                return int(fields[1])
+        return None
+
+    def sample(self):
+        """
+        CPU time in nanoseconds, memory and its limit in bytes, pids, and OOM kills
+        """
+        if self.version == 1:
+            cpu = self.read('cpu')
+            cpu = int(cpu) if cpu else None
+        else:
+            cpu = self.keyed('cpu', 'usage_usec')
+            cpu = cpu * 1000 if cpu is not None else None
+
+        memory = self.read('memory')
+        memoryLimit = (self.read('memory_limit') or '').strip()
+        pids = self.read('pids')
+        return {
+            'cpu_ns': cpu,
+            'memory': int(memory) if memory else None,
+            'memory_limit': int(memoryLimit) if memoryLimit.isdigit() and int(memoryLimit) < NO_LIMIT else None,
+            'pids': int(pids) if pids else None,
+            'oom_kills': self.keyed('oom', 'oom_kill'),
+        }
+
+    def close(self):
+        for fileDescriptor in self.files.values():
+            os.close(fileDescriptor)
+        self.files = dict()
+
+
+def apply_limits(containerID, limits):
+    """
+    Apply limits to a running container with docker update, return if it worked
+    """
+    arguments = []
+    if 'memory' in limits:
+        # Swap is limited too, or a container can simply swap past its memory limit
+        arguments += ['--memory', str(limits['memory']), '--memory-swap', str(limits['memory'])]
+    if 'cpus' in limits:
+        arguments += ['--cpus', str(limits['cpus'])]
+    if 'pids' in limits:
+        arguments += ['--pids-limit', str(limits['pids'])]
+    if not arguments:
+        return True
+    return docker('update', *arguments, containerID) != ''
+
+
+class Monitor:
+    """
+    Samples every container on an interval and restarts the unhealthy ones
+    """
+    def __init__(self, folder, settings, limits, output):
+        self.folder = folder
+        self.settings = settings
+        self.limits = limits
+        self.output = output
+        self.mounts = cgroup_mounts()
+        self.containers = dict()
+        self.cgroups = dict()
+        self.previous = dict()
+        self.restarts = dict()
+        self.limitFailures = dict()
+        self.running = True
+
+    def record(self, entry):
+        entry['time'] = round(time.time(), 3)
+        self.output.write(json.dumps(entry) + '\n')
+
+    def refresh(self):
+        """
+        Inspect the containers again, open the cgroups of new ones, and apply their limits
+        """
+        containers = {container['id']: container for container in discover(self.folder)}
+        for containerID, container in containers.items():
+            known = self.containers.get(containerID)
+            # A restarted container has a new process and a new cgroup
+            if known is None or known['pid'] != container['pid']:
+                self.close(containerID)
+                if container['running'] and container['pid']:
+                    try:
+                        self.cgroups[containerID] = Cgroup(container['pid'], self.mounts)
+                    except OSError:
+                        pass
+                    self.set_limits(container)
+
+        for containerID in set(self.containers) - set(containers):
+            self.close(containerID)
+        self.containers = containers
+
+    def set_limits(self, container):
+        """
+        Apply the limits of a container, waiting longer after every failed docker update
+        """
+        limits = self.limits.get(container['service'])
+        if not limits:
+            return
+
+        now = time.monotonic()
+        failures, nextUpdate = self.limitFailures.get(container['id'], (0, 0))
+        if now < nextUpdate:
+            return
+
+        if apply_limits(container['id'], limits):
+            self.limitFailures.pop(container['id'], None)
+            self.record({'event': 'limits', 'service': container['service'], 'limits': limits})
+            return
+
+        failures += 1
+        backoff = min(self.settings.max_backoff, 2 ** failures)
+        self.limitFailures[container['id']] = (failures, now + backoff)
+        self.record({'event': 'limits_failed', 'service': container['service'], 'limits': limits,
+                     'failures': failures, 'backoff': backoff})
+        print('Could not apply the limits of %s, next try in %ds at the earliest' % (container['service'], backoff))
+
+    def close(self, containerID):
+        if containerID in self.cgroups:
+            self.cgroups.pop(containerID).close()
+        self.previous.pop(containerID, None)
+        # A new process of the container gets its limits right away
+        self.limitFailures.pop(containerID, None)
+
+    def sample(self):
+        """
+        Record one sample of every container, CPU is the share of one core since the last one
+        """
+        now = time.monotonic()
+        for containerID, cgroup in list(self.cgroups.items()):
+            container = self.containers[containerID]
+            try:
+                stats = cgroup.sample()
+            except OSError:
+                # The cgroup is gone, the container stopped
+                self.close(containerID)
+                container['running'] = False
+                continue
+
+            entry = {'service': container['service'], 'container': containerID[:12]}
+            entry.update(stats)
+            previous = self.previous.get(containerID)
+            if previous is not None and stats['cpu_ns'] is not None and previous[1]['cpu_ns'] is not None:
+                entry['cpu_percent'] = round(100 * (stats['cpu_ns'] - previous[1]['cpu_ns']) /
+                                             ((now - previous[0]) * 1e9), 2)
+            if previous is not None and (stats['oom_kills'] or 0) > (previous[1]['oom_kills'] or 0):
+                self.record({'event': 'oom_kill', 'service': container['service'],
+                             'oom_kills': stats['oom_kills']})
+
+            # Memory limit changed behind our back, e.g. docker-compose up recreated it
+            limit = (self.limits.get(container['service']) or {}).get('memory')
+            if limit is not None and stats['memory_limit'] not in (None, page_rounded(limit)):
+                self.set_limits(container)
+
+            self.previous[containerID] = (now, stats)
+            del entry['cpu_ns']
+            self.record(entry)
+
+    def heal(self):
+        """
+        Restart stopped and unhealthy containers, waiting longer after every restart of a service
+        """
+        now = time.monotonic()
+        for container in self.containers.values():
+            service = container['service']
+            failures, nextRestart, lastRestart = self.restarts.get(service, (0, 0, 0))
+
+            if container['running'] and container['health'] != 'unhealthy':
+                # Healthy long enough after the last restart, start backoff over
+                if failures and now - lastRestart > self.settings.max_backoff:
+                    self.restarts[service] = (0, 0, 0)
+                continue
+
+            if now < nextRestart:
+                continue
+
+            reason = 'unhealthy' if container['running'] else 'stopped'
+            docker('restart', container['id'])
+            failures += 1
+            backoff = min(self.settings.max_backoff, 2 ** failures)
+            self.restarts[service] = (failures, now + backoff, now)
+            self.record({'event': 'restart', 'service': service, 'reason': reason,
+                         'restarts': failures, 'backoff': backoff})
+            print('Restarted %s, %s, next restart in %ds at the earliest' % (service, reason, backoff))
+
+    def run(self, duration):
+        """
+        Sample until stopped, inspecting containers every inspect_interval seconds
+        """
+        start = time.monotonic()
+        nextInspect = start
+        while self.running and (not duration or time.monotonic() - start < duration):
+            tick = time.monotonic()
+            if tick >= nextInspect:
+                self.refresh()
+                self.heal()
+                nextInspect = tick + self.settings.inspect_interval
+            self.sample()
+            self.output.flush()
+            time.sleep(max(0, self.settings.interval - (time.monotonic() - tick)))
+
+        for containerID in list(self.cgroups):
+            self.close(containerID)
+
+    def stop(self, *args):
+        self.running = False
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Monitor the docker challenges')
+    parser.add_argument('--compose', default='OCD/docker_challenges/docker-compose.yml',
+                        help='docker-compose.yml of the challenges')
+    parser.add_argument('--setup', default='OCD/setup.yml', help='setup.yml with the monitor section')
+    parser.add_argument('--duration', type=float, default=0, help='seconds to monitor, 0 is until stopped')
+    args = parser.parse_args()
+
+    # Settings from the monitor section of setup.yml
+    settings = Settings()
+    try:
+        setupMonitor = (read_setup(args.setup).get('CTFd') or {}).get('monitor')
+        if setupMonitor:
+            settings.load(setupMonitor)
+    except (OSError, NotConfigured):
+        pass
+
+    with open(args.compose, 'rb') as compose:
+        services = load_yaml(compose.read()).get('services') or {}
+    limits = read_limits(services, settings)
+
+    with open(settings.output, 'a') as output:
+        monitor = Monitor(os.path.dirname(os.path.abspath(args.compose)), settings, limits, output)
+        signal.signal(signal.SIGTERM, monitor.stop)
+        signal.signal(signal.SIGINT, monitor.stop)
+        print('Monitoring %d services every %ss, writing to %s' % (len(services), settings.interval, settings.output))
+        monitor.run(args.duration)
+
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
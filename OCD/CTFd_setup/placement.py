@@ -0,0 +1,94 @@
+"""
+Places files into the uploads folder with the cheapest method the filesystem supports
+"""
+import os
+import errno
+import fcntl
+import shutil
+
+
+# ioctl request to share the blocks of a file, from linux/fs.h
+FICLONE = 0x40049409
+
+
+def hardlink(source, target):
+    """
+    Link target to the same inode as source, needs the same filesystem
+    """
+    os.link(source, target)
+
+
+def reflink(source, target):
+    """
+    Copy-on-write clone of source, needs btrfs, XFS, or similar
+    """
+    with open(source, 'rb') as sourceFile, open(target, 'wb') as targetFile:
+        fcntl.ioctl(targetFile.fileno(), FICLONE, sourceFile.fileno())
+
+
+def copy_range(source, target):
+    """
+    Copy inside the kernel with copy_file_range
+    """
+    if not hasattr(os, 'copy_file_range'):
+        raise OSError(errno.ENOSYS, 'copy_file_range is not available')
+
+    with open(source, 'rb') as sourceFile, open(target, 'wb') as targetFile:
+        remaining = os.fstat(sourceFile.fileno()).st_size
+        while remaining > 0:
+            copied = os.copy_file_range(sourceFile.fileno(), targetFile.fileno(), remaining)
+            if copied == 0:
+                # Some filesystems copy nothing instead of failing, the next strategy copies it all
+                raise OSError(errno.EIO, 'copy_file_range stopped with %d bytes left' % remaining)
+            remaining -= copied
+
+
+def send_file(source, target):
+    """
+    Copy inside the kernel with sendfile
+    """
+    with open(source, 'rb') as sourceFile, open(target, 'wb') as targetFile:
+        offset = 0
+        size = os.fstat(sourceFile.fileno()).st_size
+        while offset < size:
+            sent = os.sendfile(targetFile.fileno(), sourceFile.fileno(), offset, size - offset)
+            if sent == 0:
+                raise OSError(errno.EIO, 'sendfile stopped with %d bytes left' % (size - offset))
+            offset += sent
+
+
+def copy(source, target):
+    """
+    Plain copy through userspace buffers
+    """
+    shutil.copyfile(source, target)
+
+
+# Strategies from cheapest to most expensive, each one falls back to the next
+# A hardlink shares the inode with the source, which may still be edited, so auto starts after it
+STRATEGIES = {
+    'hardlink': hardlink,
+    'reflink': reflink,
+    'copy_file_range': copy_range,
+    'sendfile': send_file,
+    'copy': copy,
+}
+
+
+def place_file(source, target, strategy='auto'):
+    """
+    Place source at target and return the name of the strategy which worked
+    """
+    names = list(STRATEGIES)
+    names = names[names.index('reflink' if strategy == 'auto' else strategy):]
+
+    for name in names:
+        try:
+            STRATEGIES[name](source, target)
+            return name
+        except OSError:
+            # Remove what a failed strategy left behind before trying the next
+            if name == 'copy':
+                raise
+            if os.path.lexists(target):
+                os.remove(target)
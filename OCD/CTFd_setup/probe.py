@@ -0,0 +1,189 @@
+"""
+Waits for CTFd, MySQL, and Redis to be ready, used by start.sh
+Run inside the CTFd container: docker-compose exec -T ctfd python OCD/CTFd_setup/probe.py
+Exits with 0 when CTFd is set up, 3 when CTFd shows its setup form, and 1 on failure
+"""
+import os
+import sys
+import time
+import random
+import socket
+import argparse
+import http.client
+from urllib.parse import urlsplit
+
+
+# Exit code for a CTFd which still needs to be set up
+SETUP_FORM = 3
+
+
+class NotReady(Exception):
+    """
+    Component which answered, or failed to, in a way that isn't ready yet
+    """
+
+
+def check_mysql(host, port, timeout):
+    """
+    MySQL is ready when it sends its handshake, an error packet means it refuses connections
+    """
+    with socket.create_connection((host, port), timeout=timeout) as connection:
+        header = connection.recv(5)
+    if len(header) < 5:
+        raise NotReady('connection closed before the handshake')
+    # Payload starts with the protocol version, or 0xff for an error packet
+    if header[4] == 0xff:
+        raise NotReady('refuses connections')
+    if header[4] != 10:
+        raise NotReady('unexpected handshake, protocol ' + str(header[4]))
+
+
+def check_redis(host, port, timeout):
+    """
+    Redis is ready when it answers PING, it answers LOADING while reading its dump
+    """
+    with socket.create_connection((host, port), timeout=timeout) as connection:
+        connection.sendall(b'PING\r\n')
+        reply = connection.recv(64)
+    if reply.startswith(b'+PONG') or reply.startswith(b'-NOAUTH'):
+        return
+    raise NotReady(reply.decode(errors='replace').strip() or 'connection closed')
+
+
+class HTTPProbe:
+    """
+    Checks CTFd over one keep-alive connection, reopened only when it breaks
+    """
+    def __init__(self, host, port, timeout):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self.connection = None
+        self.setupForm = False
+
+    def get(self, path):
+        if self.connection is None:
+            self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+        try:
+            self.connection.request('GET', path)
+            response = self.connection.getresponse()
+            return response.status, response.getheader('Location'), response.read()
+        except (OSError, http.client.HTTPException):
+            self.connection.close()
+            self.connection = None
+            raise
+
+    def __call__(self):
+        """
+        CTFd is ready when / or where it redirects to answers 200
+        """
+        path = '/'
+        for _ in range(5):
+            status, location, body = self.get(path)
+            if status in (301, 302, 303, 307, 308) and location:
+                # Only the path, CTFd may redirect to the hostname it was configured with
+                path = urlsplit(location).path or '/'
+                continue
+            if status != 200:
+                raise NotReady('HTTP ' + str(status))
+            self.setupForm = b'id="setup-form"' in body
+            return
+        raise NotReady('too many redirects')
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+
+
+def backoff(attempt, base, cap):
+    """
+    Exponential backoff with jitter, so retries don't line up with a slow component
+    """
+    return random.uniform(0.5, 1) * min(cap, base * 2 ** attempt)
+
+
+def wait_until_ready(checks, deadline, base=0.1, cap=5.0):
+    """
+    Poll every check until all are ready or the deadline passes
+    Returns the seconds until each check was ready, and the last error of those which weren't
+    """
+    start = time.monotonic()
+    ready = dict()
+    errors = dict()
+    attempt = 0
+
+    while True:
+        for name, check in checks:
+            if name in ready:
+                continue
+            try:
+                check()
+                ready[name] = time.monotonic() - start
+                errors.pop(name, None)
+            except (OSError, http.client.HTTPException, NotReady) as checkError:
+                errors[name] = str(checkError) or type(checkError).__name__
+
+        remaining = start + deadline - time.monotonic()
+        if len(ready) == len(checks) or remaining <= 0:
+            return ready, errors
+
+        time.sleep(min(backoff(attempt, base, cap), remaining))
+        attempt += 1
+
+
+def address(url, defaultHost, defaultPort):
+    """
+    Host and port from a URL such as DATABASE_URL or REDIS_URL
+    """
+    parts = urlsplit(url) if url else None
+    if parts is None or not parts.hostname:
+        return defaultHost, defaultPort
+    return parts.hostname, parts.port or defaultPort
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Wait for CTFd, MySQL, and Redis to be ready')
+    parser.add_argument('--deadline', type=float, default=300, help='seconds to wait at most')
+    parser.add_argument('--timeout', type=float, default=5, help='seconds for a single check')
+    parser.add_argument('--http', default='localhost:8000', help='host:port of CTFd')
+    parser.add_argument('--mysql', default=None, help='host:port of MySQL, default from DATABASE_URL')
+    parser.add_argument('--redis', default=None, help='host:port of Redis, default from REDIS_URL')
+    parser.add_argument('--skip', action='append', default=[], choices=('mysql', 'redis', 'http'),
+                        help='component not to check')
+    args = parser.parse_args()
+
+    # Defaults are the services of the CTFd docker-compose.yml
+    mysqlHost, mysqlPort = address(os.environ.get('DATABASE_URL'), 'db', 3306)
+    redisHost, redisPort = address(os.environ.get('REDIS_URL'), 'cache', 6379)
+    if args.mysql:
+        mysqlHost, mysqlPort = address('//' + args.mysql, mysqlHost, 3306)
+    if args.redis:
+        redisHost, redisPort = address('//' + args.redis, redisHost, 6379)
+    httpHost, httpPort = address('//' + args.http, 'localhost', 8000)
+
+    httpProbe = HTTPProbe(httpHost, httpPort, args.timeout)
+    checks = [
+        ('mysql', lambda: check_mysql(mysqlHost, mysqlPort, args.timeout)),
+        ('redis', lambda: check_redis(redisHost, redisPort, args.timeout)),
+        ('http', httpProbe),
+    ]
+    checks = [(name, check) for name, check in checks if name not in args.skip]
+
+    ready, errors = wait_until_ready(checks, args.deadline)
+    httpProbe.close()
+
+    for name, _ in checks:
+        if name in ready:
+            print('  %-6s ready after %.2fs' % (name + ':', ready[name]))
+        else:
+            print('  %-6s not ready after %ds, %s' % (name + ':', args.deadline, errors[name]))
+
+    if errors:
+        sys.exit(1)
+    if httpProbe.setupForm:
+        sys.exit(SETUP_FORM)
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
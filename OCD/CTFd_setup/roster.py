@@ -0,0 +1,100 @@
+"""
+Streams users from a CSV or JSONL roster in fixed-size chunks
+Used by both check_yaml.py and OCD.py so large rosters never sit in memory at once
+"""
+import csv
+import json
+
+
+# Columns which are numbers in setup.yml but read as strings from CSV
+NUMBER_KEYS = ('hidden', 'verified', 'banned')
+
+
+class RosterError(Exception):
+    """
+    Roster line which could not be read
+    """
+    def __init__(self, line, message):
+        super().__init__('line ' + str(line) + ', ' + message)
+        self.line = line
+        self.message = message
+
+
+def skip_line(rosterError, errors):
+    """
+    Collect a bad line if asked to, so the rest of the roster can be checked
+    """
+    if errors is None:
+        raise rosterError
+    errors.append(rosterError)
+
+
+def csv_users(rosterFile, errors):
+    """
+    Yield line number and user dictionary for every CSV row
+    """
+    reader = csv.DictReader(rosterFile, strict=True)
+    while True:
+        # A row with an unclosed quote is only found to be broken at the end of the file
+        rowLine = reader.line_num + 1
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as csvError:
+            skip_line(RosterError(rowLine, 'is not valid CSV, ' + str(csvError)), errors)
+            continue
+
+        # Cells past the header are kept under None by DictReader
+        if None in row:
+            skip_line(RosterError(reader.line_num, 'has more cells than the header'), errors)
+            continue
+
+        # Empty cells are left out, as missing keys are in setup.yml
+        user = {key: value for key, value in row.items() if key and value not in (None, '')}
+        for key in NUMBER_KEYS:
+            if key in user and user[key].isdigit():
+                user[key] = int(user[key])
+        yield reader.line_num, user
+
+
+def jsonl_users(rosterFile, errors):
+    """
+    Yield line number and user dictionary for every JSON line
+    """
+    for lineNumber, line in enumerate(rosterFile, 1):
+        if not line.strip():
+            continue
+        try:
+            user = json.loads(line)
+        except ValueError:
+            skip_line(RosterError(lineNumber, 'is not valid JSON'), errors)
+            continue
+        if not isinstance(user, dict):
+            skip_line(RosterError(lineNumber, 'must be a JSON object'), errors)
+            continue
+
+        yield lineNumber, user
+
+
+def read_roster(filename, chunkSize=1000, errors=None):
+    """
+    Yield lists of (line number, name, user) with at most chunkSize users
+    Lines which can't be read raise RosterError, or are appended to errors if given
+    """
+    if filename.endswith('.csv'):
+        reader = csv_users
+    elif filename.endswith('.jsonl'):
+        reader = jsonl_users
+    else:
+        raise RosterError(0, 'roster must be a .csv or .jsonl file')
+
+    with open(filename, 'r', newline='') as rosterFile:
+        chunk = []
+        for lineNumber, user in reader(rosterFile, errors):
+            chunk.append((lineNumber, user.pop('name', None), user))
+            if len(chunk) == chunkSize:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
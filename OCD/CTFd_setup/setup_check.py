@@ -0,0 +1,71 @@
+"""
+Decides if OCD.py has anything to do, before it imports SQLAlchemy, CTFd, and PyYAML
+OCD.py runs on every start of the CTFd container, and an already set up CTFd usually only needs this
+Exits with 1 when run on a set up CTFd and 2 when MySQL can't be asked, used by start.sh before loading a compiled setup
+"""
+import sys
+from urllib.parse import urlsplit
+
+import pymysql
+
+from yaml_loader import read_setup, NotConfigured
+
+
+# Database of the CTFd docker-compose.yml
+DATABASE_URL = 'mysql+pymysql://root:ctfd@db/ctfd'
+
+# MySQL error for a table which doesn't exist yet
+NO_SUCH_TABLE = 1146
+
+# Exit code when the database can't be queried, 1 already means set up
+DATABASE_ERROR = 2
+
+
+def setup_done():
+    """
+    Check the setup flag of CTFd with a single query, a database without tables isn't set up
+    """
+    database = urlsplit(DATABASE_URL)
+    connection = pymysql.connect(host=database.hostname, port=database.port or 3306, user=database.username,
+                                 password=database.password, database=database.path.lstrip('/'),
+                                 connect_timeout=10)
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT value FROM config WHERE `key` = 'setup'")
+            row = cursor.fetchone()
+    except pymysql.err.ProgrammingError as queryError:
+        if queryError.args[0] != NO_SUCH_TABLE:
+            raise
+        row = None
+    finally:
+        connection.close()
+
+    return row is not None and row[0] == '1'
+
+
+def setup_needed(setupFile='OCD/setup.yml'):
+    """
+    Check if the database has to be filled or updated
+    A set up CTFd only changes with incremental deploys, read from the parsed setup.yml check_yaml.py left behind
+    """
+    try:
+        if not setup_done():
+            return True
+    except pymysql.err.MySQLError:
+        # Let the full run report why the database can't be used
+        return True
+
+    try:
+        setupDeploy = (read_setup(setupFile).get('CTFd') or {}).get('deploy') or {}
+    except (OSError, NotConfigured):
+        return False
+    return setupDeploy.get('incremental') == 1
+
+
+if __name__ == '__main__':
+    try:
+        done = setup_done()
+    except pymysql.err.MySQLError as databaseError:
+        print('Could not check if CTFd is set up: ' + str(databaseError))
+        sys.exit(DATABASE_ERROR)
+    sys.exit(1 if done else 0)
@@ -1,12 +1,289 @@
+"""
+Generates the nginx config of CTFd from the nginx section of setup.yml, used by start.sh
+Writes CTFd/conf/nginx/http.conf, or CTFd/conf/nginx/nginx.conf with SSL
+"""
+import os
 import sys
+import argparse
 
-def main(hostname,cert,key):
-    with open('OCD/ssl_cert/nginx.conf','r') as f:
-        nginxfile = f.read() 
-        nginxfile = nginxfile % (hostname,hostname,hostname,cert,key)
+from yaml_loader import read_setup, NotConfigured
 
-    with open('CTFd/conf/nginx/nginx.conf','w') as f:
+
+# Pages which look the same to every visitor without a session
+CACHE_PATHS = ['/', '/scoreboard', '/api/v1/scoreboard', '/api/v1/scoreboard/top/10']
+
+
+class Settings:
+    """
+    nginx settings - can be overridden in the nginx section of setup.yml
+    """
+    def __init__(self):
+        # nginx runs on the same host, one worker per core
+        self.worker_processes = os.cpu_count() or 1
+        self.worker_connections = 4096
+        self.keepalive = 32
+        self.keepalive_timeout = 1
+        self.buffer_size = '16k'
+        self.client_max_body_size = '4G'
+        self.cache = 1
+        self.cache_size = '64m'
+        self.cache_paths = list(CACHE_PATHS)
+        self.ssl_session_cache = '10m'
+        self.ssl_session_timeout = '1h'
+
+    def load(self, setupNginx):
+        """
+        Override the defaults with the nginx section
+        """
+        for key in setupNginx:
+            if hasattr(self, key):
+                setattr(self, key, setupNginx[key])
+
+
+MAIN = """worker_processes %(worker_processes)s;
+# A proxied request holds two connections, one to the browser and one to CTFd
+worker_rlimit_nofile %(worker_rlimit_nofile)s;
+
+events {
+
+  worker_connections %(worker_connections)s;
+  multi_accept on;
+}
+
+http {
+
+  # The mime.types of the image is hidden when the conf/nginx folder is mounted
+  types {
+    text/html                     html htm;
+    text/css                      css;
+    text/plain                    txt md;
+    application/javascript        js mjs;
+    application/json              json map;
+    application/wasm              wasm;
+    image/svg+xml                 svg;
+    image/png                     png;
+    image/jpeg                    jpg jpeg;
+    image/gif                     gif;
+    image/x-icon                  ico;
+    font/woff                     woff;
+    font/woff2                    woff2;
+    font/ttf                      ttf;
+    font/otf                      otf;
+    application/vnd.ms-fontobject eot;
+  }
+  default_type application/octet-stream;
+
+  # Files are sent by the kernel, headers and the start of a file in one packet
+  sendfile on;
+  tcp_nopush on;
+  tcp_nodelay on;
+
+  # Compress proxied responses, files with a .gz sibling are sent as is
+  gzip on;
+  gzip_vary on;
+  gzip_proxied any;
+  gzip_min_length 256;
+  gzip_types text/css text/plain text/xml application/javascript application/json image/svg+xml;
+
+  client_max_body_size %(client_max_body_size)s;
+
+  # Buffers which fit most CTFd pages, so they aren't written to temporary files
+  proxy_buffer_size %(buffer_size)s;
+  proxy_buffers 16 %(buffer_size)s;
+
+  # HTTP/1.1 without a Connection header, so connections to CTFd are kept open
+  proxy_http_version 1.1;
+  proxy_set_header Connection '';
+  proxy_redirect off;
+  proxy_set_header Host $host;
+  proxy_set_header X-Real-IP $remote_addr;
+  proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;
+  proxy_set_header X-Forwarded-Host $server_name;
+%(cache_zone)s
+  # Configuration containing list of application servers
+  upstream app_servers {
+
+    server ctfd:8000;
+%(upstream_keepalive)s  }
+%(servers)s}
+"""
+
+CACHE_ZONE = """
+  # Micro-cache for pages of visitors without a session
+  proxy_cache_path /var/cache/nginx/ocd levels=1:2 keys_zone=ocd:10m max_size=%(cache_size)s inactive=10m use_temp_path=off;
+"""
+
+# gunicorn closes idle connections after 2 seconds, nginx has to close them first
+UPSTREAM_KEEPALIVE = """
+    # Idle connections kept open to CTFd by every worker
+    keepalive %(keepalive)s;
+    keepalive_timeout %(keepalive_timeout)ss;
+"""
+
+HTTP_SERVER = """
+  server {
+
+    listen 80;
+%(locations)s  }
+"""
+
+SSL_SERVERS = """
+  server {
+
+    listen 80;
+
+    server_name %(hostname)s;
+
+    return 301 https://%(hostname)s$request_uri;
+  }
+
+  server {
+
+    listen 443 ssl;
+    server_name %(hostname)s;
+
+    ssl_certificate     /etc/nginx/%(cert)s;
+    ssl_certificate_key /etc/nginx/%(key)s;
+    # Returning browsers resume their TLS session instead of a full handshake
+    ssl_session_cache   shared:SSL:%(ssl_session_cache)s;
+    ssl_session_timeout %(ssl_session_timeout)s;
+    ssl_protocols       TLSv1 TLSv1.1 TLSv1.2;
+    ssl_ciphers         HIGH:!aNULL:!eNULL:!EXPORT:!CAMELLIA:!DES:!MD5:!PSK:RC4;
+    ssl_prefer_server_ciphers on;
+%(locations)s  }
+"""
+
+LOCATIONS = """
+    # Handle Server Sent Events for Notifications
+    location /events {
+
+      proxy_pass http://app_servers;
+      chunked_transfer_encoding off;
+      proxy_buffering off;
+      proxy_cache off;
+    }
+
+    # Proxy connections to the application servers
+    location / {
+
+      proxy_pass http://app_servers;
+    }
+"""
+
+CACHED_LOCATION = """
+    location = %(path)s {
+
+      error_page 418 = @anonymous;
+      if ($cookie_session = '') {
+        return 418;
+      }
+      proxy_pass http://app_servers;
+    }
+"""
+
+ANONYMOUS_LOCATION = """
+    # Visitors without a session share one response for a moment, so a burst reaches CTFd once
+    location @anonymous {
+
+      proxy_pass http://app_servers;
+      proxy_cache ocd;
+      proxy_cache_valid 200 %(cache)ss;
+      proxy_cache_lock on;
+      proxy_cache_use_stale updating error timeout;
+      # CTFd hands every visitor a new session, which must never be cached
+      proxy_ignore_headers Set-Cookie Cache-Control Expires;
+      proxy_hide_header Set-Cookie;
+      add_header X-Cache-Status $upstream_cache_status;
+    }
+"""
+
+# Theme files straight from disk, CTFd busts the cache with a query string on every release
+THEME_LOCATION = """
+    # Theme files and their precompressed siblings straight from disk
+    location ~ ^/themes/([^/]+)/static/(.+)$ {
+
+      alias /opt/CTFd/CTFd/themes/$1/static/$2;
+      gzip_static on;
+      expires 7d;
+      add_header Cache-Control "public";
+    }
+"""
+
+# Uploads are content addressed, so a location never changes content
+UPLOADS_LOCATION = """
+    # Uploads straight from disk, without the access checks of CTFd
+    location /files/ {
+
+      alias /var/uploads/;
+      gzip_static on;
+      expires 30d;
+      add_header Cache-Control "public, immutable";
+    }
+"""
+
+
+def generate(settings, ssl=None, static=False, uploads=False):
+    """
+    nginx config for the settings, ssl is a (hostname, cert, key) tuple or None
+    """
+    values = dict(vars(settings))
+    values['worker_rlimit_nofile'] = 2 * int(settings.worker_connections) + 64
+
+    locations = LOCATIONS
+    if settings.cache:
+        for path in settings.cache_paths:
+            locations += CACHED_LOCATION % {'path': path}
+        locations += ANONYMOUS_LOCATION % values
+    if static:
+        locations += THEME_LOCATION
+    if uploads:
+        locations += UPLOADS_LOCATION
+    values['locations'] = locations
+
+    if ssl is None:
+        values['servers'] = HTTP_SERVER % values
+    else:
+        values['hostname'], values['cert'], values['key'] = ssl
+        values['servers'] = SSL_SERVERS % values
+
+    values['cache_zone'] = CACHE_ZONE % values if settings.cache else ''
+    values['upstream_keepalive'] = UPSTREAM_KEEPALIVE % values if settings.keepalive else ''
+    return MAIN % values
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate the nginx config of CTFd')
+    parser.add_argument('--setup', default='OCD/setup.yml', help='setup.yml with the nginx section')
+    parser.add_argument('--ssl', action='store_true', help='serve HTTPS with the certificate and key')
+    parser.add_argument('--hostname', default='host')
+    parser.add_argument('--cert', default='cert')
+    parser.add_argument('--key', default='key')
+    parser.add_argument('--static', action='store_true', help='serve theme files from nginx')
+    parser.add_argument('--uploads', action='store_true', help='serve uploads from nginx')
+    parser.add_argument('--output', default=None, help='default is the config CTFd mounts into nginx')
+    args = parser.parse_args()
+
+    # Settings from the nginx section of setup.yml
+    settings = Settings()
+    try:
+        setupNginx = (read_setup(args.setup).get('CTFd') or {}).get('nginx')
+        if setupNginx:
+            settings.load(setupNginx)
+    except (OSError, NotConfigured):
+        pass
+
+    ssl = (args.hostname, args.cert, args.key) if args.ssl else None
+    nginxfile = generate(settings, ssl, args.static, args.uploads)
+
+    output = args.output or ('CTFd/conf/nginx/nginx.conf' if args.ssl else 'CTFd/conf/nginx/http.conf')
+    with open(output, 'w') as f:
         f.write(nginxfile)
 
+    print('nginx: %s workers, %s connections, keepalive %s, micro-cache %s' % (
+        settings.worker_processes, settings.worker_connections, settings.keepalive or 'off',
+        str(settings.cache) + 's' if settings.cache else 'off'))
+    sys.exit(0)
+
+
 if __name__ == '__main__':
-    main(sys.argv[1],sys.argv[2],sys.argv[3])
+    main()
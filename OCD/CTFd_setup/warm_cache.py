@@ -0,0 +1,272 @@
+"""
+Invalidates stale keys in the CTFd cache and warms it before the first players arrive, used by start.sh
+Run inside the CTFd container once CTFd is ready: docker-compose exec -T ctfd python warm_cache.py
+"""
+import os
+import sys
+import time
+import socket
+import argparse
+import threading
+import http.client
+from http.cookies import SimpleCookie
+from urllib.parse import urlsplit, unquote
+from concurrent.futures import ThreadPoolExecutor
+
+from yaml_loader import read_setup, NotConfigured
+
+
+# Prefix flask-caching puts in front of every key CTFd caches
+CACHE_PREFIX = b'flask_cache_'
+
+# Sessions of logged in players, cached with the same prefix
+SESSION_PREFIX = CACHE_PREFIX + b'session'
+
+# Pages and API calls every visitor makes first, filling config, pages, and standings
+# Only what OCD.py makes public without a login, challenges are private and would only redirect
+WARM_PATHS = ['/', '/scoreboard', '/api/v1/scoreboard', '/api/v1/scoreboard/top/10',
+              '/users', '/login', '/register']
+
+# Cookie CTFd keeps a session in, the id and its itsdangerous signature: <id>.<signature>
+# Its key in Redis is SESSION_PREFIX and the id, without the signature
+SESSION_COOKIE = 'session'
+
+# Standings are computed from users, challenges, and their values
+STANDINGS = [b'*get_standings_memver', b'*get_user_standings_memver', b'*get_team_standings_memver',
+             b'*get_user_place_memver', b'*get_team_place_memver', b'*get_user_score_memver',
+             b'*get_team_score_memver', b'view/*scoreboard*']
+
+# Keys of what CTFd caches from each kind of row, as its own clear_config, clear_pages, and clear_standings
+# remove them. flask-caching keeps one version key per memoized function, without it every entry is stale
+STALE_KEYS = {
+    'config': [b'*_get_config_memver', b'*get_app_config_memver'],
+    'users': [b'*get_user_attrs_memver', b'*get_team_attrs_memver'] + STANDINGS,
+    'pages': [b'*get_pages_memver', b'*get_page_memver'],
+    'challenges': [b'*get_all_challenges_memver'] + STANDINGS,
+}
+
+
+class RedisError(Exception):
+    """
+    Error reply from Redis
+    """
+
+
+class Redis:
+    """
+    Minimal Redis client over one connection, enough to scan and delete keys
+    """
+    def __init__(self, host, port, password=None, db=0, timeout=5):
+        self.connection = socket.create_connection((host, port), timeout=timeout)
+        self.reader = self.connection.makefile('rb')
+        if password:
+            self.command('AUTH', password)
+        if db:
+            self.command('SELECT', db)
+
+    def command(self, *args):
+        request = b'*' + str(len(args)).encode() + b'\r\n'
+        for arg in args:
+            arg = arg if isinstance(arg, bytes) else str(arg).encode()
+            request += b'$' + str(len(arg)).encode() + b'\r\n' + arg + b'\r\n'
+        self.connection.sendall(request)
+        return self.reply()
+
+    def reply(self):
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('connection closed by Redis')
+        kind, value = line[:1], line[1:-2]
+
+        if kind == b'+':
+            return value.decode()
+        if kind == b'-':
+            raise RedisError(value.decode(errors='replace'))
+        if kind == b':':
+            return int(value)
+        if kind == b'$':
+            if int(value) < 0:
+                return None
+            return self.reader.read(int(value) + 2)[:-2]
+        if kind == b'*':
+            if int(value) < 0:
+                return None
+            return [self.reply() for _ in range(int(value))]
+        raise RedisError('unexpected reply ' + repr(line))
+
+    def scan(self, pattern):
+        """
+        Every key matching pattern, without blocking Redis like KEYS does
+        """
+        cursor = b'0'
+        while True:
+            cursor, keys = self.command('SCAN', cursor, 'MATCH', pattern, 'COUNT', 1000)
+            for key in keys:
+                yield key
+            if cursor == b'0':
+                return
+
+    def exists(self, key):
+        return self.command('EXISTS', key) == 1
+
+    def delete(self, keys):
+        """
+        Delete keys in chunks, UNLINK frees them in the background on Redis 4 and newer
+        """
+        deleted = 0
+        for start in range(0, len(keys), 500):
+            chunk = keys[start:start + 500]
+            try:
+                deleted += self.command('UNLINK', *chunk)
+            except RedisError:
+                deleted += self.command('DEL', *chunk)
+        return deleted
+
+    def close(self):
+        self.reader.close()
+        self.connection.close()
+
+
+def connect(url):
+    """
+    Redis client from a URL such as REDIS_URL, redis://:password@cache:6379/0
+    """
+    parts = urlsplit(url)
+    db = parts.path.strip('/')
+    password = unquote(parts.password) if parts.password else None
+    return Redis(parts.hostname or 'cache', parts.port or 6379, password, int(db) if db else 0)
+
+
+def cache_keys(client):
+    """
+    Keys CTFd cached, sessions not included
+    """
+    return [key for key in client.scan(CACHE_PREFIX + b'*') if not key.startswith(SESSION_PREFIX)]
+
+
+def invalidate(client, keepSessions=False, kinds=None):
+    """
+    Delete what CTFd cached from the database and return the amount of keys deleted
+    With kinds, e.g. ['config', 'pages'], only what CTFd cached from those rows is deleted
+    Sessions are kept when the users stayed the same, other keys in Redis are never touched
+    """
+    if kinds is not None:
+        patterns = {pattern for kind in kinds for pattern in STALE_KEYS[kind]}
+        stale = {key for pattern in patterns for key in client.scan(CACHE_PREFIX + pattern)}
+        return client.delete(sorted(stale))
+
+    if keepSessions:
+        stale = cache_keys(client)
+    else:
+        stale = list(client.scan(CACHE_PREFIX + b'*'))
+    return client.delete(stale)
+
+
+def remove_sessions(client, cookies):
+    """
+    Delete the sessions of signed session cookies, return the amount of keys deleted
+    """
+    keys = [SESSION_PREFIX + cookie.rsplit('.', 1)[0].encode() for cookie in sorted(cookies)]
+    return client.delete([key for key in keys if client.exists(key)])
+
+
+def warm_paths(setupYAML):
+    """
+    Paths to request, the default ones and the pages of setup.yml visitors can see without a login
+    """
+    paths = list(WARM_PATHS)
+    if (setupYAML.get('config') or {}).get('user_mode') == 'teams':
+        paths.append('/teams')
+
+    setupPages = setupYAML.get('pages') or {}
+    for route in setupPages:
+        if setupPages[route] and (setupPages[route].get('hidden') or setupPages[route].get('auth_required')):
+            continue
+        path = '/' if route == 'index' else '/' + route
+        if path not in paths:
+            paths.append(path)
+    return paths
+
+
+def warm(host, port, paths, workers, timeout):
+    """
+    Request every path with a few workers, each keeping its connection and session open
+    Returns the status of each path, or the error of those which failed, and the sessions CTFd made
+    """
+    local = threading.local()
+    sessions = set()
+
+    def request(path):
+        if getattr(local, 'connection', None) is None:
+            local.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        # CTFd stores a session for every visitor without one, each worker reuses its first
+        headers = {'Cookie': SESSION_COOKIE + '=' + local.session} if getattr(local, 'session', None) else {}
+        try:
+            local.connection.request('GET', path, headers=headers)
+            response = local.connection.getresponse()
+            response.read()
+            cookie = SimpleCookie(', '.join(response.headers.get_all('Set-Cookie') or []))
+            if SESSION_COOKIE in cookie and cookie[SESSION_COOKIE].value:
+                local.session = cookie[SESSION_COOKIE].value
+                sessions.add(local.session)
+            return response.status
+        except (OSError, http.client.HTTPException) as requestError:
+            local.connection.close()
+            local.connection = None
+            return str(requestError) or type(requestError).__name__
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        statuses = dict(zip(paths, executor.map(request, paths)))
+    return statuses, sessions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Invalidate stale keys in the CTFd cache and warm it')
+    parser.add_argument('--setup', default='OCD/setup.yml', help='setup.yml with the pages to warm')
+    parser.add_argument('--http', default='localhost:8000', help='host:port of CTFd')
+    parser.add_argument('--redis', default=os.environ.get('REDIS_URL', 'redis://cache:6379'),
+                        help='URL of Redis, default is REDIS_URL')
+    parser.add_argument('--invalidate', choices=('none', 'cache', 'all'), default='none',
+                        help='delete what CTFd cached first, all includes sessions')
+    parser.add_argument('--workers', type=int, default=4, help='requests made at the same time')
+    parser.add_argument('--timeout', type=float, default=10, help='seconds for a single request')
+    args = parser.parse_args()
+
+    try:
+        setupYAML = read_setup(args.setup).get('CTFd') or {}
+    except (OSError, NotConfigured):
+        setupYAML = {}
+
+    try:
+        client = connect(args.redis)
+        if args.invalidate != 'none':
+            deleted = invalidate(client, keepSessions=args.invalidate == 'cache')
+            print('Removed %d stale keys from the CTFd cache' % deleted)
+        keysBefore = len(cache_keys(client))
+
+        paths = warm_paths(setupYAML)
+        httpParts = urlsplit('//' + args.http)
+        start = time.monotonic()
+        statuses, sessions = warm(httpParts.hostname, httpParts.port or 8000, paths, args.workers, args.timeout)
+        warmTime = time.monotonic() - start
+
+        # Sessions of the warming itself, no player ever uses them
+        remove_sessions(client, sessions)
+        keysFilled = len(cache_keys(client)) - keysBefore
+        client.close()
+    except (OSError, RedisError) as redisError:
+        print('Warming the CTFd cache failed: ' + (str(redisError) or type(redisError).__name__))
+        sys.exit(1)
+
+    for path in paths:
+        print('  %-28s %s' % (path, statuses[path]))
+    failed = [path for path in paths if statuses[path] != 200]
+    if failed:
+        print('Not cached, no 200 from CTFd: ' + ', '.join(failed))
+    print('Warmed %d paths in %.2fs with %d workers, %d cache keys filled' % (
+        len(paths) - len(failed), warmTime, args.workers, keysFilled))
+    sys.exit(0)
+
+
+if __name__ == '__main__':
+    main()
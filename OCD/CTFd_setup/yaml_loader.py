@@ -0,0 +1,232 @@
+"""
+Reads setup.yml once for both check_yaml.py and OCD.py
+Uses the libyaml C loader when PyYAML was built with it, and keeps the parsed document
+next to setup.yml so later stages skip parsing an unchanged file
+Challenges can also be defined in their own challenge.yml, these are merged into setup.yml
+"""
+import os
+import re
+import marshal
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+
+
+# Bump when the cached document changes shape
+CACHE_FORMAT = 2
+
+# Name of challenge definitions in OCD/challenge_files/<category>/<name>/
+CHALLENGE_FILE = 'challenge.yml'
+
+# Hint keys of a challenge, as matched by check_yaml.py and OCD.py
+HINT_PATTERN = re.compile(r'^hint*')
+
+# Fewer challenge files than this are parsed without starting worker processes
+POOL_THRESHOLD = 32
+
+
+class NotConfigured(Exception):
+    """
+    setup.yml still holds the placeholder it is shipped with
+    """
+
+
+def load_yaml(text, loader=None):
+    """
+    Parse a YAML document with the fastest safe loader
+    PyYAML is only imported once a document has to be parsed, a cached setup.yml doesn't need it
+    """
+    import yaml
+
+    # libyaml is several times faster, the pure Python loader is used if it is missing
+    return yaml.load(text, Loader=loader or getattr(yaml, 'CSafeLoader', yaml.SafeLoader))
+
+
+def cache_filename(filename):
+    """
+    Where the parsed document of filename is kept, e.g. OCD/.setup.yml.cache
+    """
+    folder, name = os.path.split(filename)
+    return os.path.join(folder, '.' + name + '.cache')
+
+
+def cache_header(contentHash):
+    """
+    First line of a cache file, compared before anything else of the file is read
+    """
+    return b'OCD setup cache ' + str(CACHE_FORMAT).encode() + b' ' + contentHash.encode() + b'\n'
+
+
+def read_cache(filename, contentHash):
+    """
+    Return the cached document of filename, or None if it is missing or stale
+    The cache ships with the content of the CTF, so only a document with a matching header is loaded,
+    with marshal, which only builds plain values
+    """
+    try:
+        with open(cache_filename(filename), 'rb') as cacheFile:
+            if cacheFile.readline() != cache_header(contentHash):
+                return None
+            document = marshal.load(cacheFile)
+        if isinstance(document, dict):
+            return document
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    return None
+
+
+def write_cache(filename, contentHash, document):
+    """
+    Store the parsed document, skipped on read-only folders such as the CTFd container mount
+    Documents with values marshal can't store, such as YAML timestamps, aren't cached
+    """
+    try:
+        payload = marshal.dumps(document)
+        temporary = cache_filename(filename) + '.tmp'
+        with open(temporary, 'wb') as cacheFile:
+            cacheFile.write(cache_header(contentHash) + payload)
+        os.replace(temporary, cache_filename(filename))
+    except (OSError, ValueError):
+        pass
+
+
+def read_setup(filename, cache=True):
+    """
+    Read and parse setup.yml, reading the file only once
+    Raises NotConfigured for the placeholder and yaml.YAMLError for broken YAML
+    """
+    with open(filename, 'rb') as setup:
+        content = setup.read()
+
+    if content.rstrip(b'\n') == b'Configure me':
+        raise NotConfigured
+
+    contentHash = hashlib.sha256(content).hexdigest()
+    if cache:
+        document = read_cache(filename, contentHash)
+        if document is not None:
+            return document
+
+    document = load_yaml(content)
+    if cache:
+        write_cache(filename, contentHash, document)
+    return document
+
+
+def find_challenge_files(folder):
+    """
+    Return (category, name) of every <category>/<name>/challenge.yml in folder, sorted
+    """
+    found = []
+    with os.scandir(folder) as categories:
+        for category in categories:
+            if category.name.startswith('.') or not category.is_dir():
+                continue
+            with os.scandir(category.path) as challenges:
+                for challenge in challenges:
+                    if (not challenge.name.startswith('.') and challenge.is_dir()
+                            and os.path.isfile(os.path.join(challenge.path, CHALLENGE_FILE))):
+                        found.append((category.name, challenge.name))
+    return sorted(found)
+
+
+def parse_challenge_file(filename):
+    """
+    Parse one challenge.yml and return the challenge, or None and why it can't be used
+    """
+    import yaml
+
+    try:
+        with open(filename, 'rb') as challengeFile:
+            challenge = load_yaml(challengeFile.read())
+    except yaml.YAMLError:
+        return None, CHALLENGE_FILE + ' is not valid YAML'
+
+    if not isinstance(challenge, dict):
+        return None, CHALLENGE_FILE + ' must be a dictionary'
+    return challenge, None
+
+
+def relocate_challenge(challenge, prefix):
+    """
+    Make filenames in a challenge.yml, which are relative to its folder, relative to challenge_files
+    """
+    if isinstance(challenge.get('description'), str):
+        challenge['description'] = prefix + challenge['description']
+
+    if isinstance(challenge.get('file'), list):
+        challenge['file'] = [prefix + filename if isinstance(filename, str) else filename
+                             for filename in challenge['file']]
+
+    for key, hint in challenge.items():
+        if HINT_PATTERN.match(str(key)) and isinstance(hint, dict) and isinstance(hint.get('description'), str):
+            hint['description'] = prefix + hint['description']
+
+
+def read_challenge_files(folder, workers=0):
+    """
+    Parse every challenge.yml in folder, on a process pool when there are many
+    Returns a list of (category, name, challenge, error)
+    """
+    if not os.path.isdir(folder):
+        return []
+
+    found = find_challenge_files(folder)
+    filenames = [os.path.join(folder, category, name, CHALLENGE_FILE) for category, name in found]
+
+    workers = workers or os.cpu_count()
+    if workers > 1 and len(filenames) >= POOL_THRESHOLD:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            parsed = list(executor.map(parse_challenge_file, filenames,
+                                       chunksize=max(1, len(filenames) // (workers * 4))))
+    else:
+        parsed = [parse_challenge_file(filename) for filename in filenames]
+
+    return [(category, name, challenge, message)
+            for (category, name), (challenge, message) in zip(found, parsed)]
+
+
+def merge_challenge_files(setup, folder, workers=0):
+    """
+    Merge the challenge.yml files in folder into CTFd.challenges of setup
+    Returns the (YAML path, message) of every challenge which could not be merged
+    """
+    errors = []
+    challengeFiles = read_challenge_files(folder, workers)
+    if not challengeFiles or not isinstance(setup.get('CTFd'), dict):
+        return errors
+
+    if setup['CTFd'].get('challenges') is None:
+        setup['CTFd']['challenges'] = {}
+    setupChallenges = setup['CTFd']['challenges']
+    if not isinstance(setupChallenges, dict):
+        return errors
+
+    # Challenge names are unique over every category, as requirements refer to them by name
+    names = {}
+    for category, challenges in setupChallenges.items():
+        if isinstance(challenges, dict):
+            for name in challenges:
+                names[str(name)] = 'setup.yml'
+
+    for category, name, challenge, message in challengeFiles:
+        path = ['CTFd', 'challenges', category, name]
+        source = category + '/' + name + '/' + CHALLENGE_FILE
+        if message is not None:
+            errors.append((path, message))
+            continue
+
+        if name in names:
+            errors.append((path, 'defined in both ' + names[name] + ' and ' + source))
+            continue
+
+        if setupChallenges.get(category) is None:
+            setupChallenges[category] = {}
+        if not isinstance(setupChallenges[category], dict):
+            errors.append((path[:3], 'must be a dictionary to add ' + source))
+            continue
+
+        relocate_challenge(challenge, category + '/' + name + '/')
+        setupChallenges[category][name] = challenge
+        names[name] = source
+
+    return errors
@@ -3,6 +3,8 @@
 
 # Are you using docker-compose challenge containers? Set to 1.
 CHALLENGE_COMPOSE=0
+# Monitor and restart the challenge containers in the background? Set to 1.
+CHALLENGE_MONITOR=0
 
 
 # Are you using an SSL Certificate? Set to 1.
@@ -13,6 +15,18 @@ hostname='host'
 cert='cert'
 # /Set key to your private key filename.
 key='key'
+# Serve theme files and their precompressed siblings from nginx? Set to 1.
+NGINX_STATIC=0
+# Serve uploads from nginx too? Skips the access checks of CTFd on files. Set to 1.
+NGINX_UPLOADS=0
+
+
+# Compile setup.yml into a SQL dump and load it before CTFd starts, instead of OCD.py filling MySQL? Set to 1.
+SQL_DUMP=0
+# Build a CTFd image with OCD baked in, instead of copying OCD into CTFd at every start? Set to 1.
+PREBUILT_IMAGE=0
+# Seconds to wait for CTFd to start, the first start of a large setup.yml can take longer.
+PROBE_DEADLINE=300
 
 
 
@@ -31,6 +45,7 @@ Options:
 Read README.md and docs if in doupt.
 Remember to configure setup.yml.
 Set 'CHALLENGE_COMPOSE=1' if 'docker-compose up' for challenges is wanted.
+Set 'CHALLENGE_MONITOR=1' to monitor the challenge containers as well.
 " 
 
 printf '%s' "$USAGE"
@@ -56,6 +71,12 @@ git checkout -- .
 }
 
 
+# Secret key of CTFd which stays the same between deploys, needed to find changed users, in the CTFd folder
+secretkey(){
+[ -f .ctfd_secret_key ] || python3 -c 'import secrets; print(secrets.token_hex(32), end="")' > .ctfd_secret_key
+}
+
+
 # Timezone annoyance, needed for accurate timesetup in CTFd
 tz(){
 python3 OCD/CTFd_setup/timezone.py > OCD/config_files/tz
@@ -84,7 +105,90 @@ sed -ir 's/^(\s*)- \.\/conf\/nginx\/http\.conf:\/etc\/nginx\/nginx\.conf$/\1- \.
 grep -E '\s*- 443:443' || sed -i 's/^      - 80:80(\n      - 443:443)*/      - 80:80\n      - 443:443/' CTFd/docker-compose.yml
 
 rm CTFd/conf/nginx/http.conf 2> /dev/null
-python3 OCD/CTFd_setup/setup_nginx.py "$hostname" "$cert" "$key"
+}
+
+
+# nginx config from the nginx section of setup.yml
+nginxconf(){
+NGINXFLAGS=''
+[ $NGINX_SSL -eq 1 ] && NGINXFLAGS='--ssl'
+[ $NGINX_STATIC -eq 1 ] && nginxstatic && NGINXFLAGS="$NGINXFLAGS --static"
+[ $NGINX_UPLOADS -eq 1 ] && nginxuploads && NGINXFLAGS="$NGINXFLAGS --uploads"
+python3 OCD/CTFd_setup/setup_nginx.py --hostname "$hostname" --cert "$cert" --key "$key" $NGINXFLAGS || error 'Generating the nginx config failed'
+}
+
+
+# Theme files for nginx, with .gz siblings for gzip_static
+nginxstatic(){
+printf 'Compressing theme files\n'
+python3 OCD/CTFd_setup/compress.py CTFd/CTFd/themes || error 'Compressing theme files failed'
+grep -q '/opt/CTFd/CTFd/themes' CTFd/docker-compose.yml || sed -i 's/^\(\s*\)- \.\/conf\/nginx\(.*\)$/&\n\1- .\/CTFd\/themes:\/opt\/CTFd\/CTFd\/themes:ro/' CTFd/docker-compose.yml
+}
+
+
+# Uploads for nginx, set 'compress: gzip' in the deploy section of setup.yml for .gz siblings
+nginxuploads(){
+grep -q ':/var/uploads:ro' CTFd/docker-compose.yml || sed -i 's/^\(\s*\)- \.\/conf\/nginx\(.*\)$/&\n\1- .data\/CTFd\/uploads:\/var\/uploads:ro/' CTFd/docker-compose.yml
+}
+
+
+# setup.yml compiled into .data/OCD/setup.sql and loaded into MySQL migrated by CTFd, in the CTFd folder
+compiledsetup(){
+printf 'Compiling setup.yml\n'
+mkdir -p .data/OCD
+# Users are fingerprinted with .ctfd_secret_key, mounted into the ctfd service in both modes
+docker-compose run --rm --no-deps -T -v "$(pwd)/.data/OCD:/var/ocd" --entrypoint python ctfd compile_setup.py --output /var/ocd/setup.sql || error 'Compiling setup.yml failed'
+
+printf 'Loading the compiled setup\n'
+docker-compose up -d db > /dev/null
+docker-compose run --rm --no-deps -T --entrypoint python ctfd OCD/CTFd_setup/probe.py --deadline "$PROBE_DEADLINE" --skip redis --skip http || error 'MySQL did not start, see docker-compose logs'
+docker-compose run --rm --no-deps -T --entrypoint python ctfd setup_check.py
+SETUP=$?
+
+case $SETUP
+in
+    0) # The dump only holds rows, the tables and alembic_version come from the migrations of CTFd
+       printf 'Creating the tables of CTFd\n'
+       docker-compose run --rm -T --entrypoint python ctfd manage.py db upgrade || error 'Migrating the CTFd database failed, see docker-compose logs'
+       docker-compose exec -T db mysql -uroot -pctfd ctfd < .data/OCD/setup.sql || error 'Loading the compiled setup failed' ;;
+    1) printf 'Setup already done, compiled setup not loaded\n' ;;
+    *) error 'Checking if CTFd is set up failed, see docker-compose logs' ;;
+esac
+}
+
+
+# OCD copied into CTFd, which is rebuilt with it, in the CTFd folder
+patchctfd(){
+tz
+mv OCD/CTFd_setup/OCD.py .
+mv OCD/CTFd_setup/db.py .
+mv OCD/CTFd_setup/roster.py .
+mv OCD/CTFd_setup/placement.py .
+mv OCD/CTFd_setup/benchmark.py .
+mv OCD/CTFd_setup/yaml_loader.py .
+mv OCD/CTFd_setup/instrument.py .
+mv OCD/CTFd_setup/assets.py .
+mv OCD/CTFd_setup/compress.py .
+mv OCD/CTFd_setup/warm_cache.py .
+mv OCD/CTFd_setup/setup_check.py .
+mv OCD/CTFd_setup/compile_setup.py .
+
+# Needed for YAML in docker
+grep -q 'PyYAML>=4.2b1' requirements.txt || printf 'PyYAML>=4.2b1\n' >> requirements.txt
+
+# Needed for docker CTFd to call OCD.py
+grep -q "# Create the database" docker-entrypoint.sh || sed -i "s/^# Start CTFd$/$INSERTENTRY/" docker-entrypoint.sh
+}
+
+
+# CTFd image with OCD baked in, only the layers from the first change on are rebuilt
+prebuiltimage(){
+sed -i 's/^\(\s*\)build: \.$/\1image: ctfdeploy\/ctfd/' CTFd/docker-compose.yml
+# Only the secret key is mounted instead of the CTFd folder, so CTFd and OCD.py keep using the same key
+sed -i 's/^\(\s*\)- \.:\/opt\/CTFd:ro$/\1- .\/.ctfd_secret_key:\/opt\/CTFd\/.ctfd_secret_key:ro/' CTFd/docker-compose.yml
+
+printf 'Building the CTFd image\n'
+python3 OCD/CTFd_setup/build_image.py --tz="$(python3 OCD/CTFd_setup/timezone.py)" || error 'Building the CTFd image failed'
 }
 
 
@@ -93,72 +197,101 @@ start(){
 printf 'Checking setup.yml syntax\n'
 python3 OCD/CTFd_setup/check_yaml.py OCD/setup.yml || exit 1
 
+# Build challenge images while CTFd starts
+[ $CHALLENGE_COMPOSE -eq 1 ] && buildchallenges
+
 printf 'Making sure CTFd is stopped\n'
 cd CTFd || error 'You need CTFd to use this script'
 docker-compose down || error 'You need to pull the submodule down first'
 cd .. || error 'Something went wrong'
 
-printf 'Copying files into CTFd\n'
-cp -r --preserve OCD CTFd
+if [ $PREBUILT_IMAGE -eq 1 ]
+then
+    prebuiltimage
+else
+    printf 'Copying files into CTFd\n'
+    # Without the docker challenges, whose build log and cache are still written in the background
+    rm -rf CTFd/OCD/docker_challenges
+    mkdir -p CTFd/OCD
+    find OCD -mindepth 1 -maxdepth 1 ! -name docker_challenges -exec cp -r --preserve {} CTFd/OCD \;
+fi
 
 # Check for SSL setup
 [ $NGINX_SSL -eq 1 ] && nginxssl
 
+# Generate the nginx config
+nginxconf
+
 # In CTFd directory
 cd CTFd || error 'You need CTFd to use this script'
 
 # Setup for entry
-tz
-mv OCD/CTFd_setup/OCD.py .
-mv OCD/CTFd_setup/db.py .
-
-# Needed for YAML in docker
-grep -q 'PyYAML>=4.2b1' requirements.txt || printf 'PyYAML>=4.2b1\n' >> requirements.txt
+secretkey
+[ $PREBUILT_IMAGE -eq 1 ] || patchctfd
 
-# Needed for docker CTFd to call OCD.py
-grep -q "# Create the database" docker-entrypoint.sh || sed -i "s/^# Start CTFd$/$INSERTENTRY/" docker-entrypoint.sh
+# Load the compiled setup, OCD.py then finds CTFd set up
+[ $SQL_DUMP -eq 1 ] && compiledsetup
 
 # Start
 printf 'Starting CTF\n'
 docker-compose up -d > /dev/null
 
-# Wait for website to be running
+# Wait for MySQL, Redis, and the website to be running
 printf 'Waiting for CTFd to be running\n'
-while ! curl -sL localhost:8000 > /dev/null
-do
-    printf '.'
-    sleep 1
-done
-
-# Restart cache on setup, skip if already setup
-WSITE=$(curl -sL localhost:8000)
-
-case "$WSITE"
-in 
-    *id=\"setup-form\"*) printf '\nSkipping setup\n' ; 
-                         docker-compose rm -sf cache ; 
-                         rm -rf .data/redis ;
-                         docker-compose up -d cache > /dev/null ;;
-    *) printf '\nSetup already done\n' ;;
+docker-compose exec -T ctfd python OCD/CTFd_setup/probe.py --deadline "$PROBE_DEADLINE"
+PROBE=$?
+
+# A setup form comes from a stale cache, skip it by removing what CTFd cached
+case $PROBE
+in
+    3) printf 'Skipping setup\n' ;
+       INVALIDATE='all' ;;
+    0) printf 'Setup already done\n' ;
+       INVALIDATE='none' ;;
+    *) error 'CTFd did not start, see docker-compose logs' ;;
 esac
 
+# Fill the CTFd cache before the first players arrive
+printf 'Warming CTFd cache\n'
+docker-compose exec -T ctfd python warm_cache.py --invalidate "$INVALIDATE" || printf 'Warming failed, CTFd fills its cache on first use\n'
+
 printf 'CTFd setup done\n'
 
 [ $CHALLENGE_COMPOSE -eq 1 ] && dockerchallenges
 }
 
 
+buildchallenges(){
+[ -f OCD/docker_challenges/docker-compose.yml ] || error 'No docker-compose.yml found in OCD/docker_challenges.'
+
+printf 'Building challenge containers in the background\n'
+python3 OCD/CTFd_setup/challenge_containers.py build > OCD/docker_challenges/build.log 2>&1 &
+BUILD_PID=$!
+}
+
+
 dockerchallenges(){
 cd ..
 
 # In CTFdeploy
-[ -f OCD/docker_challenges/docker-compose.yml ] || error 'No docker-compose.yml found in OCD/docker_challenges.'
-cd OCD/docker_challenges || error 'OCD/docker_challenges is missing' 
+printf 'Waiting for challenge containers to be built\n'
+wait $BUILD_PID
+BUILD=$?
+cat OCD/docker_challenges/build.log
+[ $BUILD -eq 0 ] || error 'Building challenge containers failed'
 
 printf 'Starting challenge containers\n'
-docker-compose up -d
+python3 OCD/CTFd_setup/challenge_containers.py start || error 'Starting challenge containers failed'
 
 printf 'Docker challenge containers done\n'
+
+[ $CHALLENGE_MONITOR -eq 1 ] && monitorchallenges
+}
+
+
+monitorchallenges(){
+nohup python3 OCD/CTFd_setup/monitor.py > OCD/docker_challenges/monitor.log 2>&1 &
+printf 'Monitoring challenge containers, stop with: kill %s\n' "$!"
 }
 
 
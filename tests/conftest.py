@@ -0,0 +1,76 @@
+"""
+Shared fixtures, the modules of OCD/CTFd_setup are imported the way start.sh places them next to CTFd
+Run from the repository root: python -m pytest -q tests
+"""
+import os
+import sys
+import types
+import hashlib
+
+import pytest
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'OCD', 'CTFd_setup'))
+
+# CTFd is only installed in its container, outside of it OCD.py only needs its password hashing
+try:
+    import CTFd.utils.crypto
+except ImportError:
+    def hash_password(password):
+        # Salted like the bcrypt hashes of CTFd, so two hashes of one password differ
+        salt = os.urandom(8).hex()
+        return 'stub$' + salt + '$' + hashlib.sha256((salt + password).encode()).hexdigest()
+
+    for name in ('CTFd', 'CTFd.utils', 'CTFd.utils.crypto'):
+        sys.modules[name] = types.ModuleType(name)
+    sys.modules['CTFd.utils.crypto'].hash_password = hash_password
+
+import OCD
+import benchmark
+
+
+# Password hashes are salted, the only column which differs between two runs of the same event
+SALTED = ('users.password',)
+
+
+@pytest.fixture
+def event(tmp_path, monkeypatch):
+    """
+    A small generated event in tmp_path/OCD, the working directory of the test, with fresh OCD.py globals
+    """
+    setup = benchmark.generated_setup(users=12, categories=3, challenges=15, hints=1, tags=1, files=1,
+                                      requirements=0.5)
+    benchmark.write_event(str(tmp_path), setup, 1)
+    monkeypatch.chdir(tmp_path)
+
+    monkeypatch.setattr(OCD, 'settings', OCD.Settings())
+    monkeypatch.setattr(OCD, 'uploads', OCD.Uploads())
+    monkeypatch.setattr(OCD, 'instrument', OCD.Instrument())
+    monkeypatch.setattr(OCD, 'UPLOAD_FOLDER', str(tmp_path / 'uploads'))
+    monkeypatch.setenv('SECRET_KEY', 'test secret key')
+    benchmark.sqlite_types()
+    return tmp_path
+
+
+def provision(database, deploy=None):
+    """
+    Run a full deploy of OCD.py on the event in the working directory and return its engine
+    """
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+
+    engine = create_engine(database)
+    OCD.Base.metadata.create_all(bind=engine)
+    session = sessionmaker(bind=engine)()
+
+    setupYAML = OCD.read_setup_yaml('OCD/setup.yml')
+    OCD.settings.load(deploy or {})
+    OCD.uploads.prefetch(OCD.setup_files(setupYAML))
+    OCD.save_fingerprints(session, OCD.full_setup(session, setupYAML))
+    OCD.uploads.wait()
+    session.commit()
+    session.close()
+
+    # The next run starts with an empty upload stage, as a new OCD.py process would
+    OCD.uploads = OCD.Uploads()
+    return engine
@@ -0,0 +1,163 @@
+"""
+Local stand-ins for the services of the CTFd docker-compose.yml: MySQL, Redis, and CTFd itself
+Each one listens on a free port of 127.0.0.1 in a background thread
+"""
+import fnmatch
+import threading
+import socketserver
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+# Start of the MySQL handshake: 3 byte payload length, sequence id, protocol version 10
+MYSQL_HANDSHAKE = b'\x4a\x00\x00\x00\x0a' + b'5.7.0-standin\x00' + b'\x00' * 56
+
+# Error packet MySQL sends to a host it refuses
+MYSQL_REFUSED = b'\x17\x00\x00\x00\xff\x6a\x04Host is not allowed'
+
+# Page of a CTFd which still needs to be set up
+SETUP_FORM_PAGE = b'<form method="post" id="setup-form"></form>'
+
+
+class StandIn:
+    """
+    Server running in a background thread until stopped
+    """
+    def __init__(self, server):
+        self.server = server
+        self.port = server.server_address[1]
+        self.thread = threading.Thread(target=server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def address(self):
+        return '127.0.0.1:' + str(self.port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class ThreadingTCPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def mysql(greeting=MYSQL_HANDSHAKE):
+    """
+    MySQL which sends greeting to every connection
+    """
+    class Handler(socketserver.BaseRequestHandler):
+        def handle(self):
+            self.request.sendall(greeting)
+
+    return StandIn(ThreadingTCPServer(('127.0.0.1', 0), Handler))
+
+
+class RedisStore:
+    """
+    Keys of the Redis stand-in and the commands it was sent
+    """
+    def __init__(self, keys=None, loading=False, unlink=True):
+        self.keys = dict(keys or {})
+        self.loading = loading
+        self.unlink = unlink
+        self.commands = []
+        self.lock = threading.Lock()
+
+    def execute(self, args):
+        command = args[0].upper()
+        self.commands.append(command)
+        if self.loading:
+            return b'-LOADING Redis is loading the dataset in memory\r\n'
+        if command == b'PING':
+            return b'+PONG\r\n'
+        if command in (b'AUTH', b'SELECT'):
+            return b'+OK\r\n'
+        if command == b'SCAN':
+            # Pages of at most COUNT keys, the cursor is the index of the next page
+            cursor, pattern, count = int(args[1]), args[3].decode(), int(args[5])
+            names = sorted(self.keys)
+            page = names[cursor:cursor + count]
+            following = cursor + count if cursor + count < len(names) else 0
+            matched = [name for name in page if fnmatch.fnmatchcase(name.decode(), pattern)]
+            return (b'*2\r\n' + bulk(str(following).encode()) + b'*' + str(len(matched)).encode() + b'\r\n' +
+                    b''.join(bulk(name) for name in matched))
+        if command == b'EXISTS':
+            return b':' + str(sum(1 for name in args[1:] if name in self.keys)).encode() + b'\r\n'
+        if command == b'UNLINK' and not self.unlink:
+            # Redis older than 4
+            return b"-ERR unknown command 'UNLINK'\r\n"
+        if command in (b'UNLINK', b'DEL'):
+            deleted = sum(1 for name in args[1:] if self.keys.pop(name, None) is not None)
+            return b':' + str(deleted).encode() + b'\r\n'
+        return b"-ERR unknown command '" + command + b"'\r\n"
+
+
+def bulk(value):
+    return b'$' + str(len(value)).encode() + b'\r\n' + value + b'\r\n'
+
+
+def read_command(reader):
+    """
+    Arguments of one RESP array or inline command, None when the connection closed
+    """
+    line = reader.readline()
+    if not line:
+        return None
+    if not line.startswith(b'*'):
+        return line.split()
+    args = []
+    for _ in range(int(line[1:-2])):
+        length = int(reader.readline()[1:-2])
+        args.append(reader.read(length + 2)[:-2])
+    return args
+
+
+def redis(store):
+    """
+    Redis answering from store
+    """
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            while True:
+                args = read_command(self.rfile)
+                if not args:
+                    return
+                with store.lock:
+                    reply = store.execute(args)
+                self.wfile.write(reply)
+
+    return StandIn(ThreadingTCPServer(('127.0.0.1', 0), Handler))
+
+
+def ctfd(pages):
+    """
+    CTFd answering GET requests from pages, a path to (status, headers, body) dictionary
+    Requested paths and the cookies sent with them are collected in the requests and cookies lists
+    """
+    requests = []
+    cookies = []
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            requests.append(self.path)
+            cookies.append(self.headers.get('Cookie'))
+            status, headers, body = pages.get(self.path, (404, {}, b'not found'))
+            self.send_response(status)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    standIn = StandIn(server)
+    standIn.requests = requests
+    standIn.cookies = cookies
+    return standIn
@@ -0,0 +1,45 @@
+"""
+Bulk inserts write the same rows as the ORM
+"""
+from sqlalchemy import event as sqlalchemy_event
+from sqlalchemy.engine import Engine
+
+import benchmark
+from conftest import provision, SALTED
+
+
+def test_bulk_insert_matches_orm(event):
+    orm = provision('sqlite:///' + str(event / 'orm.db'))
+    bulk = provision('sqlite:///' + str(event / 'bulk.db'), {'bulk_insert': 1, 'batch_size': 7})
+
+    ormRows = benchmark.table_rows(orm, SALTED)
+    bulkRows = benchmark.table_rows(bulk, SALTED)
+    assert ormRows['users'] and ormRows['challenges'] and ormRows['ocd_fingerprints']
+    assert bulkRows == ormRows
+
+
+def test_bulk_insert_batches(event):
+    statements = []
+
+    def count(connection, cursor, statement, parameters, context, executemany):
+        if statement.startswith('INSERT INTO users'):
+            statements.append(statement)
+
+    sqlalchemy_event.listen(Engine, 'before_cursor_execute', count)
+    try:
+        engine = provision('sqlite:///' + str(event / 'bulk.db'), {'bulk_insert': 1, 'batch_size': 5})
+    finally:
+        sqlalchemy_event.remove(Engine, 'before_cursor_execute', count)
+
+    # 12 users in multi-row INSERTs of at most 5 rows
+    assert len(statements) == 3
+    assert len(benchmark.table_rows(engine, SALTED)['users']) == 12
+
+
+def test_hash_pool_matches_serial_hashing(event):
+    serial = provision('sqlite:///' + str(event / 'serial.db'), {'hash_workers': 1})
+    parallel = provision('sqlite:///' + str(event / 'parallel.db'), {'hash_workers': 2})
+
+    # 12 users hashed on forkserver workers, in the order the serial hashing gives them
+    assert len(benchmark.table_rows(parallel, SALTED)['users']) == 12
+    assert benchmark.table_rows(parallel, SALTED) == benchmark.table_rows(serial, SALTED)
@@ -0,0 +1,66 @@
+"""
+Errors check_yaml.py reports for setup.yml, with the path they are found under
+"""
+import check_yaml
+import OCD
+
+
+def validate():
+    """
+    Validate OCD/setup.yml of the working directory without the cache between runs
+    """
+    check_yaml.cache = check_yaml.Cache()
+    return check_yaml.validate({'CTFd': OCD.read_setup_yaml('OCD/setup.yml')})
+
+
+def test_generated_event_is_valid(event):
+    assert validate() == []
+
+
+def test_value_must_be_a_number(event):
+    with open('OCD/setup.yml', 'r') as setupFile:
+        content = setupFile.read()
+    with open('OCD/setup.yml', 'w') as setupFile:
+        setupFile.write(content.replace('value: 100', 'value: lots', 1))
+
+    errors = validate()
+
+    assert len(errors) == 1
+    assert errors[0]['message'] == 'value, must be a positive number'
+    assert errors[0]['path'][:2] == ['CTFd', 'challenges']
+
+
+def test_created_roster_is_checked_again(event):
+    with open('OCD/setup.yml', 'a') as setupFile:
+        setupFile.write('  users_file: roster.jsonl\n')
+
+    def cached_validate():
+        check_yaml.cache = check_yaml.Cache()
+        check_yaml.cache.load('OCD/.check_cache.json')
+        errors = check_yaml.validate({'CTFd': OCD.read_setup_yaml('OCD/setup.yml')})
+        check_yaml.cache.save()
+        return [pathError['message'] for pathError in errors]
+
+    assert cached_validate() == ['file does not exist, roster.jsonl']
+
+    with open('OCD/config_files/roster.jsonl', 'w') as rosterFile:
+        rosterFile.write('{"name": "late", "password": "late", "email": "late@bench.test", "type": "user"}\n')
+
+    assert cached_validate() == []
+
+
+def test_malformed_csv_rows_are_reported(event):
+    with open('OCD/setup.yml', 'a') as setupFile:
+        setupFile.write('  users_file: roster.csv\n')
+    with open('OCD/config_files/roster.csv', 'w') as rosterFile:
+        rosterFile.write('name,password,email,type\n'
+                         'late,late,late@bench.test,user\n'
+                         'extra,extra,extra@bench.test,user,surplus\n'
+                         'quoted,"open,quoted@bench.test,user\n')
+
+    errors = validate()
+
+    assert [(pathError['path'][-1], pathError['message']) for pathError in errors] == [
+        ('line 3', 'has more cells than the header'),
+        ('line 4', 'is not valid CSV, unexpected end of data'),
+    ]
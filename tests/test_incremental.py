@@ -0,0 +1,209 @@
+"""
+Incremental deploys of users, with and without a stable secret key, and of config, pages, and challenges
+"""
+import yaml
+from sqlalchemy import select
+from sqlalchemy.orm import sessionmaker
+
+import OCD
+from conftest import provision
+
+
+def edit_setup(change):
+    """
+    Apply change to the parsed OCD/setup.yml and write it back
+    """
+    with open('OCD/setup.yml', 'r') as setupFile:
+        setup = yaml.safe_load(setupFile)
+    change(setup['CTFd'])
+    with open('OCD/setup.yml', 'w') as setupFile:
+        yaml.safe_dump(setup, setupFile)
+
+
+def deploy_incremental(engine):
+    """
+    The incremental branch of OCD.main, returns the counts it printed
+    """
+    session = sessionmaker(bind=engine)()
+    setupYAML = OCD.read_setup_yaml('OCD/setup.yml')
+    configRows = OCD.config_rows(setupYAML['config'])
+    fingerprints = OCD.setup_fingerprints(setupYAML, configRows)
+    stored = OCD.load_fingerprints(session)
+    counts = OCD.incremental_users(session, setupYAML, stored['users'], fingerprints['users'])
+    OCD.save_fingerprints(session, fingerprints)
+    OCD.uploads.wait()
+    session.commit()
+    session.close()
+    OCD.uploads = OCD.Uploads()
+    return counts, fingerprints
+
+
+def deploy_setup(engine):
+    """
+    The whole incremental branch of OCD.main, returns the fingerprints it saved
+    """
+    session = sessionmaker(bind=engine)()
+    setupYAML = OCD.read_setup_yaml('OCD/setup.yml')
+    configRows = OCD.config_rows(setupYAML['config'])
+    fingerprints = OCD.setup_fingerprints(setupYAML, configRows)
+    OCD.incremental_setup(session, setupYAML, configRows, fingerprints)
+    OCD.save_fingerprints(session, fingerprints)
+    OCD.uploads.wait()
+    session.commit()
+    session.close()
+    OCD.uploads = OCD.Uploads()
+    return fingerprints
+
+
+def add_rows(engine, *rows):
+    """
+    Rows made in CTFd itself, outside of OCD.py
+    """
+    session = sessionmaker(bind=engine)()
+    session.add_all(rows)
+    session.commit()
+    session.close()
+
+
+def table_ids(engine, table):
+    with engine.connect() as connection:
+        return connection.execute(select([table.ID, table.challenge_id]).order_by(table.ID)).fetchall()
+
+
+def passwords(engine):
+    with engine.connect() as connection:
+        return dict(connection.execute(select([OCD.Users.name, OCD.Users.password])).fetchall())
+
+
+def test_changed_password_is_updated(event):
+    engine = provision('sqlite:///' + str(event / 'ctfd.db'))
+    before = passwords(engine)
+
+    edit_setup(lambda setup: setup['users']['user3'].update(password='changed'))
+    counts, fingerprints = deploy_incremental(engine)
+
+    assert counts == (0, 1, 0)
+    after = passwords(engine)
+    assert after['user3'] != before['user3']
+    assert all(after[name] == before[name] for name in before if name != 'user3')
+
+
+def test_without_secret_key_users_are_left_alone(event, monkeypatch):
+    monkeypatch.delenv('SECRET_KEY')
+    engine = provision('sqlite:///' + str(event / 'ctfd.db'))
+    before = passwords(engine)
+
+    def change(setup):
+        setup['users']['user3']['password'] = 'changed'
+        setup['users']['newcomer'] = dict(setup['users']['user3'], email='newcomer@bench.test')
+    edit_setup(change)
+    counts, fingerprints = deploy_incremental(engine)
+
+    # Nothing is rehashed or overwritten, new users are still added
+    assert counts == (1, 0, 0)
+    after = passwords(engine)
+    assert all(after[name] == before[name] for name in before)
+    assert 'newcomer' in after
+    assert set(fingerprints['users'].values()) == {OCD.UNKNOWN_FINGERPRINT}
+
+
+def test_user_made_in_ctfd_is_not_inserted_again(event):
+    engine = provision('sqlite:///' + str(event / 'ctfd.db'))
+    session = sessionmaker(bind=engine)()
+    session.add(OCD.Users('player', password_hash='made in CTFd', email='player@ctfd.test', type='user'))
+    session.commit()
+    session.close()
+
+    edit_setup(lambda setup: setup['users'].update(
+        player={'password': 'setup', 'email': 'player@bench.test', 'type': 'user', 'hidden': 0}))
+    counts, fingerprints = deploy_incremental(engine)
+
+    assert counts == (0, 0, 0)
+    assert 'player' not in fingerprints['users']
+    assert passwords(engine)['player'] == 'made in CTFd'
+    with engine.connect() as connection:
+        names = [name for name, in connection.execute(select([OCD.Users.name]))]
+    assert names.count('player') == 1
+
+
+def test_changed_challenge_keeps_its_extra_ids(event):
+    engine = provision('sqlite:///' + str(event / 'ctfd.db'))
+    before = {table: table_ids(engine, table) for table in (OCD.Flags, OCD.Tags, OCD.Hints, OCD.Files)}
+
+    edit_setup(lambda setup: setup['challenges']['category1']['challenge1'].update(value=250))
+    deploy_setup(engine)
+
+    # Unlocks point at hint ids, solves and submissions at the challenge
+    assert {table: table_ids(engine, table) for table in before} == before
+    with engine.connect() as connection:
+        assert connection.execute(select([OCD.Challenges.value])
+                                  .where(OCD.Challenges.name == 'challenge1')).scalar() == 250
+
+
+def test_removed_hint_is_the_only_one_deleted(event):
+    def add_hint(setup):
+        setup['challenges']['category1']['challenge1']['hint1'] = {'description': 'challenge1_hint0.md', 'cost': 5}
+    edit_setup(add_hint)
+    engine = provision('sqlite:///' + str(event / 'ctfd.db'))
+    before = table_ids(engine, OCD.Hints)
+
+    edit_setup(lambda setup: setup['challenges']['category1']['challenge1'].pop('hint1'))
+    deploy_setup(engine)
+
+    # The first hint keeps its id, only the one past it is deleted
+    challengeID = OCD.get_challenge_ids(sessionmaker(bind=engine)())['challenge1']
+    removed = [row for row in before if row[1] == challengeID][-1]
+    assert table_ids(engine, OCD.Hints) == [row for row in before if row != removed]
+
+
+def test_config_key_set_in_ctfd_is_replaced(event):
+    engine = provision('sqlite:///' + str(event / 'ctfd.db'))
+    add_rows(engine, OCD.Config('team_size', '4'))
+
+    edit_setup(lambda setup: setup['config'].update(team_size=5))
+    deploy_setup(engine)
+
+    with engine.connect() as connection:
+        assert connection.execute(select([OCD.Config.value])
+                                  .where(OCD.Config.key == 'team_size')).fetchall() == [('5',)]
+
+
+def test_page_made_in_ctfd_is_not_inserted_again(event):
+    engine = provision('sqlite:///' + str(event / 'ctfd.db'))
+    add_rows(engine, OCD.Pages('rules', 'made in CTFd'))
+
+    def add_page(setup):
+        setup['pages']['rules'] = {'page': 'index.html'}
+    edit_setup(add_page)
+    fingerprints = deploy_setup(engine)
+
+    assert 'rules' not in fingerprints['pages']
+    with engine.connect() as connection:
+        assert connection.execute(select([OCD.Pages.content])
+                                  .where(OCD.Pages.route == 'rules')).fetchall() == [('made in CTFd',)]
+
+
+def file_rows(engine):
+    with engine.connect() as connection:
+        return sorted(connection.execute(select([OCD.Files.TYPE, OCD.Files.location, OCD.Files.challenge_id,
+                                                 OCD.Files.page_id])).fetchall(), key=str)
+
+
+def test_files_match_a_full_deploy(event):
+    for filename, content in (('config_files/logo.png', b'logo'), ('pages_files/pic.png', b'picture'),
+                              ('pages_files/rules.html', b'<img src="pic.png">')):
+        (event / 'OCD' / filename).write_bytes(content)
+
+    def add_files(setup):
+        setup['config']['logo'] = 'logo.png'
+        setup['pages']['index']['file'] = ['pic.png']
+        setup['pages']['rules'] = {'page': 'rules.html', 'file': ['pic.png']}
+    edit_setup(add_files)
+    engine = provision('sqlite:///' + str(event / 'ctfd.db'))
+
+    edit_setup(lambda setup: setup['pages'].pop('rules'))
+    (event / 'OCD' / 'pages_files' / 'pic.png').write_bytes(b'new picture')
+    (event / 'OCD' / 'config_files' / 'logo.png').write_bytes(b'new logo')
+    deploy_setup(engine)
+
+    assert file_rows(engine) == file_rows(provision('sqlite:///' + str(event / 'full.db')))
@@ -0,0 +1,37 @@
+"""
+Stage reports of instrument.py
+"""
+import os
+import sys
+import json
+import subprocess
+
+import instrument
+
+
+# Peaks are process wide, so the stages run in a fresh process whatever earlier tests allocated
+STAGES = """
+import json
+import instrument
+
+report = instrument.Instrument()
+with report.stage('allocate'):
+    block = b'x' * (256 * 1024 * 1024)
+    del block
+with report.stage('small'):
+    small = b'x' * 1024
+    del small
+print(json.dumps(report.stages))
+"""
+
+
+def test_stage_reports_its_own_peak_growth():
+    environment = dict(os.environ, PYTHONPATH=os.path.dirname(instrument.__file__))
+    output = subprocess.run([sys.executable, '-c', STAGES], env=environment, check=True,
+                            stdout=subprocess.PIPE).stdout
+
+    allocate, small = json.loads(output)
+    assert allocate['peak_rss_growth_kb'] > 128 * 1024
+    # Below the peak of the earlier stage, which the process wide peak still shows
+    assert small['peak_rss_growth_kb'] == 0
+    assert small['process_peak_rss_kb'] >= allocate['process_peak_rss_kb']
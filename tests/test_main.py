@@ -0,0 +1,23 @@
+"""
+OCD.main on a CTFd which is already set up
+"""
+import pytest
+import sqlalchemy
+
+import OCD
+from conftest import provision
+
+
+def test_set_up_ctfd_hashes_no_files(event, monkeypatch):
+    database = 'sqlite:///' + str(event / 'ctfd.db')
+    provision(database)
+
+    prefetched = []
+    monkeypatch.setattr(OCD, 'create_engine', lambda url: sqlalchemy.create_engine(database))
+    monkeypatch.setattr(OCD.uploads, 'prefetch', prefetched.extend)
+
+    with pytest.raises(SystemExit) as exit:
+        OCD.main()
+
+    assert exit.value.code == 1
+    assert prefetched == []
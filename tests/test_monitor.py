@@ -0,0 +1,63 @@
+"""
+Limits the monitor applies again when a container lost them, and how often it retries a failed update
+"""
+import io
+
+import pytest
+
+import monitor
+
+
+class FakeCgroup:
+    def __init__(self, memoryLimit):
+        self.memoryLimit = memoryLimit
+
+    def sample(self):
+        return {'cpu_ns': None, 'memory': 1024, 'memory_limit': self.memoryLimit, 'pids': 1, 'oom_kills': 0}
+
+
+def limits_set(monkeypatch, configured, reported):
+    """
+    Containers the monitor set the limits of again after one sample
+    """
+    monkeypatch.setattr(monitor, 'cgroup_mounts', lambda: {})
+    settings = monitor.Settings()
+    settings.load({'limits': {'web': {'memory': configured}}})
+    watcher = monitor.Monitor('.', settings, monitor.read_limits({'web': {}}, settings), io.StringIO())
+    watcher.containers = {'abc': {'id': 'abc', 'service': 'web', 'running': True}}
+    watcher.cgroups = {'abc': FakeCgroup(reported)}
+    applied = []
+    monkeypatch.setattr(watcher, 'set_limits', applied.append)
+    watcher.sample()
+    return applied
+
+
+@pytest.mark.parametrize('configured', ['512m', 100000000, '1.3g'])
+def test_limit_rounded_by_the_kernel_is_kept(monkeypatch, configured):
+    size = monitor.parse_size(configured)
+    reported = size // monitor.PAGE_SIZE * monitor.PAGE_SIZE
+
+    assert limits_set(monkeypatch, configured, reported) == []
+
+
+def test_changed_limit_is_set_again(monkeypatch):
+    assert len(limits_set(monkeypatch, '512m', 1024 ** 3)) == 1
+
+
+def test_failed_update_backs_off(monkeypatch):
+    monkeypatch.setattr(monitor, 'cgroup_mounts', lambda: {})
+    updates = []
+    monkeypatch.setattr(monitor, 'docker', lambda *args: updates.append(args) or '')
+    settings = monitor.Settings()
+    settings.load({'limits': {'web': {'memory': '512m'}}})
+    output = io.StringIO()
+    watcher = monitor.Monitor('.', settings, monitor.read_limits({'web': {}}, settings), output)
+    watcher.containers = {'abc': {'id': 'abc', 'service': 'web', 'running': True}}
+    watcher.cgroups = {'abc': FakeCgroup(1024 ** 3)}
+
+    for _ in range(5):
+        watcher.sample()
+
+    # Only the first sample tries, the next ones wait for the backoff
+    assert len(updates) == 1
+    assert '"event": "limits_failed"' in output.getvalue()
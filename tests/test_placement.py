@@ -0,0 +1,45 @@
+"""
+A strategy which copies only part of a file falls back to the next one, auto leaves sources unlinked
+"""
+import os
+import shutil
+
+import pytest
+
+import placement
+
+
+@pytest.fixture
+def source(tmp_path):
+    sourceFile = tmp_path / 'handout.bin'
+    sourceFile.write_bytes(os.urandom(64 * 1024))
+    return sourceFile
+
+
+@pytest.mark.parametrize('strategy, syscall', [('copy_file_range', 'copy_file_range'), ('sendfile', 'sendfile')])
+def test_short_copy_falls_back(source, tmp_path, monkeypatch, strategy, syscall):
+    monkeypatch.setattr(os, syscall, lambda *args: 0, raising=False)
+    # shutil copies with sendfile as well, the plain copy has to stay working
+    monkeypatch.setattr(shutil, '_USE_CP_SENDFILE', False, raising=False)
+    target = tmp_path / 'target.bin'
+
+    used = placement.place_file(str(source), str(target), strategy)
+
+    assert used != strategy
+    assert target.read_bytes() == source.read_bytes()
+
+
+def test_short_copy_raises(source, tmp_path, monkeypatch):
+    monkeypatch.setattr(os, 'sendfile', lambda *args: 0)
+
+    with pytest.raises(OSError):
+        placement.send_file(str(source), str(tmp_path / 'target.bin'))
+
+
+def test_auto_never_hardlinks(source, tmp_path):
+    target = tmp_path / 'target.bin'
+
+    used = placement.place_file(str(source), str(target))
+
+    assert used != 'hardlink'
+    assert not os.path.samefile(str(source), str(target))
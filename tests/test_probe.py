@@ -0,0 +1,97 @@
+"""
+Exit codes of probe.py against local stand-ins for MySQL, Redis, and CTFd
+"""
+import socket
+import sys
+
+import pytest
+
+import probe
+import standins
+
+
+@pytest.fixture
+def services():
+    """
+    Ready MySQL and Redis stand-ins, stopped after the test
+    """
+    started = {'mysql': standins.mysql(), 'redis': standins.redis(standins.RedisStore())}
+    yield started
+    for standIn in started.values():
+        standIn.stop()
+
+
+def closed_port():
+    """
+    A port nothing listens on
+    """
+    with socket.socket() as unused:
+        unused.bind(('127.0.0.1', 0))
+        return unused.getsockname()[1]
+
+
+def run_probe(monkeypatch, mysql, redis, http, *args):
+    monkeypatch.setattr(sys, 'argv', ['probe.py', '--mysql', mysql, '--redis', redis, '--http', http,
+                                      '--deadline', '1', '--timeout', '1'] + list(args))
+    with pytest.raises(SystemExit) as exit:
+        probe.main()
+    return exit.value.code
+
+
+def test_set_up_ctfd(services, monkeypatch):
+    ctfd = standins.ctfd({'/': (200, {}, b'<h1>CTF</h1>')})
+    try:
+        code = run_probe(monkeypatch, services['mysql'].address, services['redis'].address, ctfd.address)
+    finally:
+        ctfd.stop()
+    assert code == 0
+
+
+def test_setup_form_after_redirect(services, monkeypatch):
+    ctfd = standins.ctfd({'/': (302, {'Location': 'http://ctf.example/setup'}, b''),
+                          '/setup': (200, {}, standins.SETUP_FORM_PAGE)})
+    try:
+        code = run_probe(monkeypatch, services['mysql'].address, services['redis'].address, ctfd.address)
+    finally:
+        ctfd.stop()
+    assert code == probe.SETUP_FORM == 3
+    assert ctfd.requests == ['/', '/setup']
+
+
+def test_mysql_down(services, monkeypatch):
+    ctfd = standins.ctfd({'/': (200, {}, b'')})
+    try:
+        code = run_probe(monkeypatch, '127.0.0.1:' + str(closed_port()), services['redis'].address,
+                         ctfd.address)
+    finally:
+        ctfd.stop()
+    assert code == 1
+
+
+def test_mysql_refusing(services, monkeypatch):
+    mysql = standins.mysql(standins.MYSQL_REFUSED)
+    try:
+        code = run_probe(monkeypatch, mysql.address, services['redis'].address, '127.0.0.1:1',
+                         '--skip', 'http')
+    finally:
+        mysql.stop()
+    assert code == 1
+
+
+def test_redis_loading(services, monkeypatch):
+    redis = standins.redis(standins.RedisStore(loading=True))
+    try:
+        code = run_probe(monkeypatch, services['mysql'].address, redis.address, '127.0.0.1:1',
+                         '--skip', 'http')
+    finally:
+        redis.stop()
+    assert code == 1
+
+
+def test_ctfd_error(services, monkeypatch):
+    ctfd = standins.ctfd({'/': (502, {}, b'bad gateway')})
+    try:
+        code = run_probe(monkeypatch, services['mysql'].address, services['redis'].address, ctfd.address)
+    finally:
+        ctfd.stop()
+    assert code == 1
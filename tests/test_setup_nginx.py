@@ -0,0 +1,135 @@
+"""
+nginx configs setup_nginx.py generates, parsed here and checked with nginx -t when docker is available
+"""
+import re
+import shutil
+import subprocess
+
+import pytest
+
+import setup_nginx
+
+
+# nginx image CTFd runs, only pulled for the nginx -t test
+NGINX_IMAGE = 'nginx:stable'
+
+SSL = ('ctf.example', 'cert.pem', 'key.pem')
+
+# SSL or plain HTTP, micro-cache on and off, keepalive on and off
+VARIANTS = [(ssl, cache, keepalive) for ssl in (SSL, None) for cache in (1, 0) for keepalive in (32, 0)]
+
+
+def config(ssl, cache, keepalive, static=True, uploads=True):
+    settings = setup_nginx.Settings()
+    settings.load({'cache': cache, 'keepalive': keepalive, 'worker_processes': 2})
+    return setup_nginx.generate(settings, ssl, static, uploads)
+
+
+def parse(text):
+    """
+    Statements of nginx config as (directive, arguments, block), block None for simple directives
+    """
+    tokens = re.findall(r"'[^']*'|\"[^\"]*\"|[;{}]|[^\s;{}'\"]+", re.sub(r'#[^\n]*', '', text))
+    statements = [[]]
+    words = []
+    for token in tokens:
+        if token == ';':
+            assert words, 'empty directive'
+            statements[-1].append((words[0], words[1:], None))
+            words = []
+        elif token == '{':
+            assert words, 'block without a directive'
+            block = []
+            statements[-1].append((words[0], words[1:], block))
+            statements.append(block)
+            words = []
+        elif token == '}':
+            assert not words, words[0] + ', missing ;'
+            assert len(statements) > 1, 'unexpected }'
+            statements.pop()
+        else:
+            words.append(token.strip('\'"') if token[0] in '\'"' else token)
+    assert not words and len(statements) == 1, 'missing ; or }'
+    return statements[0]
+
+
+def find(statements, directive):
+    return [statement for statement in statements if statement[0] == directive]
+
+
+def only(statements, directive, arguments=None):
+    found = [statement for statement in find(statements, directive) if arguments in (None, statement[1])]
+    assert len(found) == 1, directive
+    return found[0]
+
+
+@pytest.mark.parametrize('ssl, cache, keepalive', VARIANTS)
+def test_generated_config(ssl, cache, keepalive):
+    statements = parse(config(ssl, cache, keepalive))
+
+    assert only(statements, 'worker_processes')[1] == ['2']
+    assert only(only(statements, 'events')[2], 'worker_connections')[1] == ['4096']
+    http = only(statements, 'http')[2]
+
+    upstream = only(http, 'upstream', ['app_servers'])[2]
+    assert only(upstream, 'server')[1] == ['ctfd:8000']
+    assert bool(find(upstream, 'keepalive')) == bool(keepalive)
+    # Kept open connections need HTTP/1.1 without Connection: close
+    assert only(http, 'proxy_http_version')[1] == ['1.1']
+    assert ['Connection', ''] in [header[1] for header in find(http, 'proxy_set_header')]
+
+    zones = [argument.split('=')[1].split(':')[0] for cachePath in find(http, 'proxy_cache_path')
+             for argument in cachePath[1] if argument.startswith('keys_zone=')]
+    assert zones == (['ocd'] if cache else [])
+
+    servers = find(http, 'server')
+    assert [only(server[2], 'listen')[1] for server in servers] == ([['80'], ['443', 'ssl']] if ssl else [['80']])
+    if ssl:
+        assert only(servers[0][2], 'return')[1] == ['301', 'https://ctf.example$request_uri']
+        assert only(servers[1][2], 'ssl_certificate')[1] == ['/etc/nginx/cert.pem']
+        assert only(servers[1][2], 'ssl_certificate_key')[1] == ['/etc/nginx/key.pem']
+
+    locations = find(servers[-1][2], 'location')
+    paths = [tuple(location[1]) for location in locations]
+    assert len(paths) == len(set(paths))
+    assert ('/events',) in paths and ('/',) in paths and ('/files/',) in paths
+    assert (('=', '/scoreboard') in paths) == bool(cache)
+
+    # Every cache and named location used is defined
+    named = [path[0] for path in paths if path[0].startswith('@')]
+    for location in locations:
+        for proxyCache in find(location[2], 'proxy_cache'):
+            assert proxyCache[1] == ['off'] or proxyCache[1][0] in zones
+        for errorPage in find(location[2], 'error_page'):
+            assert errorPage[1][-1] in named
+
+
+def test_files_left_to_ctfd():
+    statements = parse(config(None, 1, 32, static=False, uploads=False))
+
+    server = only(only(statements, 'http')[2], 'server')[2]
+    paths = [location[1][-1] for location in find(server, 'location')]
+    assert '/files/' not in paths
+    assert not [path for path in paths if path.startswith('^/themes/')]
+
+
+def docker_available():
+    if shutil.which('docker') is None:
+        return False
+    return subprocess.run(['docker', 'info'], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+@pytest.mark.skipif(not docker_available(), reason='needs docker to run nginx -t')
+@pytest.mark.parametrize('ssl, cache, keepalive', VARIANTS)
+def test_nginx_accepts_config(tmp_path, ssl, cache, keepalive):
+    (tmp_path / 'nginx.conf').write_text(config(ssl, cache, keepalive))
+    if ssl:
+        subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+                        '-subj', '/CN=ctf.example', '-keyout', str(tmp_path / 'key.pem'),
+                        '-out', str(tmp_path / 'cert.pem')], check=True, capture_output=True)
+
+    # The folder is mounted like conf/nginx with SSL, ctfd is the CTFd service of docker-compose
+    result = subprocess.run(['docker', 'run', '--rm', '--add-host', 'ctfd:127.0.0.1',
+                             '-v', str(tmp_path) + ':/etc/nginx:ro', NGINX_IMAGE, 'nginx', '-t'],
+                            capture_output=True, text=True)
+    assert result.returncode == 0, result.stderr
@@ -0,0 +1,34 @@
+"""
+Identical files share their content but not their upload location
+"""
+import os
+import shutil
+
+from sqlalchemy import select
+
+import OCD
+from conftest import provision
+
+
+def test_identical_handouts_have_their_own_folder(event):
+    setupYAML = OCD.read_setup_yaml('OCD/setup.yml')
+    handouts = [handout for category in setupYAML['challenges'].values()
+                for challenge in category.values() for handout in challenge.get('file', [])]
+    shutil.copyfile('OCD/challenge_files/' + handouts[0], 'OCD/challenge_files/' + handouts[1])
+
+    engine = provision('sqlite:///' + str(event / 'ctfd.db'))
+    with engine.connect() as connection:
+        locations = dict(connection.execute(select([OCD.Files.location, OCD.Files.challenge_id])
+                                            .where(OCD.Files.TYPE == 'challenge')).fetchall())
+    first, second = [location for location in locations
+                     if os.path.basename(location) in (os.path.basename(handouts[0]), os.path.basename(handouts[1]))]
+
+    assert os.path.dirname(first) != os.path.dirname(second)
+    firstPath = os.path.join(OCD.UPLOAD_FOLDER, first)
+    secondPath = os.path.join(OCD.UPLOAD_FOLDER, second)
+    assert os.path.samefile(firstPath, secondPath)
+
+    # Deleting a file in CTFd removes its whole folder
+    shutil.rmtree(os.path.dirname(firstPath))
+    with open(secondPath, 'rb') as handout, open('OCD/challenge_files/' + handouts[0], 'rb') as source:
+        assert handout.read() == source.read()
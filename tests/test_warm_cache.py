@@ -0,0 +1,109 @@
+"""
+Invalidating the CTFd cache against a local Redis stand-in, and warming it against a CTFd stand-in
+"""
+import warm_cache
+import standins
+
+
+def cached_keys(pages):
+    """
+    Keys of a CTFd with players logged in, next to keys of another application
+    """
+    keys = {b'flask_cache_page_%d' % page: b'cached' for page in range(pages)}
+    keys.update({b'flask_cache_session_%d' % player: b'logged in' for player in range(3)})
+    keys.update({b'other_app_key': b'kept', b'flask_other': b'kept'})
+    return keys
+
+
+def invalidate(store, keepSessions, kinds=None):
+    redis = standins.redis(store)
+    try:
+        client = warm_cache.connect('redis://:secret@' + redis.address + '/1')
+        deleted = warm_cache.invalidate(client, keepSessions, kinds)
+        client.close()
+    finally:
+        redis.stop()
+    return deleted
+
+
+def test_incremental_deploy_keeps_sessions():
+    # More keys than one SCAN page and one UNLINK chunk
+    store = standins.RedisStore(cached_keys(1200))
+
+    deleted = invalidate(store, keepSessions=True)
+
+    assert deleted == 1200
+    assert sorted(store.keys) == [b'flask_cache_session_0', b'flask_cache_session_1', b'flask_cache_session_2',
+                                  b'flask_other', b'other_app_key']
+    assert store.commands[:2] == [b'AUTH', b'SELECT']
+    assert store.commands.count(b'UNLINK') == 3
+
+
+def test_full_deploy_removes_sessions():
+    store = standins.RedisStore(cached_keys(10))
+
+    deleted = invalidate(store, keepSessions=False)
+
+    assert deleted == 13
+    assert sorted(store.keys) == [b'flask_other', b'other_app_key']
+
+
+def test_redis_without_unlink():
+    store = standins.RedisStore(cached_keys(10), unlink=False)
+
+    deleted = invalidate(store, keepSessions=True)
+
+    assert deleted == 10
+    assert b'DEL' in store.commands
+    assert len(store.keys) == 5
+
+
+def test_incremental_deploy_removes_only_what_changed():
+    store = standins.RedisStore(cached_keys(3))
+    store.keys.update({b'flask_cache_CTFd.utils._get_config_memver': b'1',
+                       b'flask_cache_CTFd.utils.config.pages.get_pages_memver': b'1',
+                       b'flask_cache_CTFd.utils.scores.get_standings_memver': b'1',
+                       b'flask_cache_view/api.scoreboard_scoreboard_list': b'cached'})
+
+    deleted = invalidate(store, keepSessions=True, kinds=['config', 'challenges'])
+
+    assert deleted == 3
+    assert b'flask_cache_CTFd.utils.config.pages.get_pages_memver' in store.keys
+    assert b'flask_cache_page_0' in store.keys
+    assert b'flask_cache_session_0' in store.keys
+
+
+def test_warming_reuses_one_session():
+    # Signed like the cookies of CTFd, the key in Redis only has the id
+    page = (200, {'Set-Cookie': 'session=warming.c2lnbmF0dXJl; HttpOnly; Path=/'}, b'cached')
+    ctfd = standins.ctfd({'/': page, '/scoreboard': page, '/users': (302, {}, b'')})
+    try:
+        host, port = ctfd.address.split(':')
+        statuses, sessions = warm_cache.warm(host, int(port), ['/', '/scoreboard', '/users'], 1, 5)
+    finally:
+        ctfd.stop()
+
+    assert statuses == {'/': 200, '/scoreboard': 200, '/users': 302}
+    assert ctfd.cookies == [None, 'session=warming.c2lnbmF0dXJl', 'session=warming.c2lnbmF0dXJl']
+
+    store = standins.RedisStore(cached_keys(2))
+    store.keys[b'flask_cache_sessionwarming'] = b'warming'
+    redis = standins.redis(store)
+    try:
+        client = warm_cache.connect('redis://' + redis.address)
+        deleted = warm_cache.remove_sessions(client, sessions)
+        client.close()
+    finally:
+        redis.stop()
+
+    assert deleted == 1
+    assert b'flask_cache_sessionwarming' not in store.keys
+    assert b'flask_cache_session_0' in store.keys
+
+
+def test_only_public_paths_are_warmed():
+    paths = warm_cache.warm_paths({'config': {'user_mode': 'users'},
+                                   'pages': {'index': {}, 'rules': {}, 'team': {'auth_required': 1}}})
+
+    assert '/api/v1/challenges' not in paths and '/teams' not in paths
+    assert '/rules' in paths and '/team' not in paths
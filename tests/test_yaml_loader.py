@@ -0,0 +1,51 @@
+"""
+The parsed setup.yml cache only loads documents of the same setup.yml
+"""
+import marshal
+import pickle
+
+import pytest
+
+import yaml_loader
+
+
+@pytest.fixture
+def setup_file(tmp_path):
+    setupFile = tmp_path / 'setup.yml'
+    setupFile.write_text('CTFd:\n  config:\n    name: Cached\n  challenges:\n    1: {value: 100}\n')
+    return str(setupFile)
+
+
+def test_cache_round_trip(setup_file):
+    parsed = yaml_loader.read_setup(setup_file)
+
+    # Integer keys survive, which a JSON cache would turn into strings
+    assert yaml_loader.read_setup(setup_file) == parsed
+    assert 1 in parsed['CTFd']['challenges']
+
+
+def test_cache_of_other_content_is_not_loaded(setup_file, monkeypatch):
+    yaml_loader.read_setup(setup_file)
+    with open(setup_file, 'a') as setup:
+        setup.write('  pages: {}\n')
+
+    def refuse(cacheFile):
+        raise AssertionError('stale cache was deserialized')
+    monkeypatch.setattr(marshal, 'load', refuse)
+
+    assert yaml_loader.read_cache(setup_file, 'another hash') is None
+
+
+def test_pickled_cache_is_ignored(setup_file):
+    with open(yaml_loader.cache_filename(setup_file), 'wb') as cacheFile:
+        pickle.dump({'format': 1, 'hash': 'x', 'document': {'CTFd': {}}}, cacheFile)
+
+    assert yaml_loader.read_setup(setup_file)['CTFd']['config']['name'] == 'Cached'
+
+
+def test_timestamps_are_not_cached(tmp_path):
+    setupFile = tmp_path / 'setup.yml'
+    setupFile.write_text('CTFd:\n  config:\n    start: 2030-01-01\n')
+
+    assert yaml_loader.read_setup(str(setupFile))['CTFd']['config']['start'].year == 2030
+    assert not (tmp_path / '.setup.yml.cache').exists()